@@ -0,0 +1,87 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+
+class BlockDeviceIndex(object):
+    """Index of host block devices, attached to VMs as real disks.
+
+    Maps host device path to (VE uuid, device index). The index is
+    built once by walking all VMs, which needs a ploop call for each
+    disk, and then is kept up to date by volume drivers on attach
+    and detach. Entries of deleted VEs are dropped on dispatcher
+    events. After invalidate() the index is rebuilt on next use.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._devices = {}
+        self._stale = True
+        driver.events.subscribe([pc.PET_DSP_EVT_VM_UNREGISTERED,
+                                 pc.PET_DSP_EVT_VM_DELETED],
+                                self._on_removed)
+
+    def _on_removed(self, ve_event):
+        for path, (uuid, index) in self._devices.items():
+            if uuid == ve_event.uuid:
+                del self._devices[path]
+
+    def rebuild(self):
+        devices = {}
+        for info in self.driver.inventory.list_ves(vm_type=pc.PVT_VM):
+            sdk_ve = info.sdk_ve
+            n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
+            for i in xrange(n):
+                dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
+                if dev.get_emulated_type() == pc.PDT_USE_REAL_HDD:
+                    path = self.driver.get_disk_dev_path(dev)
+                    devices[path] = (info.uuid, dev.get_index())
+        self._devices = devices
+        self._stale = False
+        LOG.debug("Block device index rebuilt, %d devices" % len(devices))
+
+    def invalidate(self):
+        self._stale = True
+
+    def _get_devices(self):
+        self.driver.events.dispatch_pending()
+        if self._stale:
+            self.rebuild()
+        return self._devices
+
+    def add(self, path, sdk_ve, hdd):
+        uuid = pcsutils.strip_uuid(sdk_ve.get_uuid())
+        self._devices[path] = (uuid, hdd.get_index())
+
+    def remove(self, path):
+        self._devices.pop(path, None)
+
+    def find(self, path, sdk_ve):
+        """Return index of the device, attached to given VE, or None."""
+        entry = self._get_devices().get(path)
+        if entry and entry[0] == pcsutils.strip_uuid(sdk_ve.get_uuid()):
+            return entry[1]
+        return None
+
+    def list_devices(self):
+        return self._get_devices().keys()
@@ -0,0 +1,144 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import time
+
+from nova.openstack.common import jsonutils
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class CacheIndex(object):
+    """Metadata of cached images, stored in a JSON file.
+
+    Maps image id to a dict of fields. The file is replaced
+    atomically on every change, so a crash leaves either the old or
+    the new version. Changes are made under an external lock and
+    on top of the latest version of the file, so processes, sharing
+    the cache, don't lose each other's changes. Reads are served
+    from memory and the file is reloaded, when it's changed.
+
+    Uses of images (last_used and hits) are frequent, so touch()
+    only records them in memory, and flush() writes them all at
+    once. Reads of this process include unwritten uses.
+    """
+
+    def __init__(self, path, lock_path):
+        self.path = path
+        self.lock_path = lock_path
+        self._version = None
+        self._entries = {}
+        # image id -> [last used, hits], not written yet
+        self._usage = {}
+
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._version = None
+            self._entries = {}
+            return
+        version = (st.st_mtime, st.st_ino, st.st_size)
+        if version == self._version:
+            return
+        with open(self.path) as f:
+            try:
+                self._entries = jsonutils.loads(f.read())
+            except ValueError:
+                LOG.warn("Image cache index %s is corrupted, starting "
+                         "a new one" % self.path)
+                self._entries = {}
+        self._version = version
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(jsonutils.dumps(self._entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self._version = None
+
+    def _with_usage(self, image_id, entry, usage=None):
+        "Copy of the entry with unwritten uses of the image."
+        entry = dict(entry)
+        if usage is None:
+            usage = self._usage.get(image_id)
+        if usage is not None:
+            entry['last_used'] = max(entry.get('last_used', 0), usage[0])
+            entry['hits'] = entry.get('hits', 0) + usage[1]
+        return entry
+
+    def get(self, image_id):
+        self._load()
+        entry = self._entries.get(image_id)
+        if entry is None:
+            return None
+        return self._with_usage(image_id, entry)
+
+    def list(self):
+        self._load()
+        return self._entries.keys()
+
+    def get_all(self):
+        self._load()
+        return dict((k, self._with_usage(k, v))
+                    for k, v in self._entries.iteritems())
+
+    def update(self, image_id, **fields):
+        with lockutils.lock('cache-index', external=True,
+                            lock_path=self.lock_path):
+            self._load()
+            self._entries.setdefault(image_id, {}).update(fields)
+            self._save()
+
+    def touch(self, image_id, hit=True):
+        """Record use of the image until flush(). Hits are counted
+        only if hit is True.
+        """
+        usage = self._usage.setdefault(image_id, [0, 0])
+        usage[0] = time.time()
+        if hit:
+            usage[1] += 1
+
+    def flush(self):
+        "Write uses of images, recorded by touch(), to the index."
+        if not self._usage:
+            return
+        with lockutils.lock('cache-index', external=True,
+                            lock_path=self.lock_path):
+            self._load()
+            usage, self._usage = self._usage, {}
+            for image_id in usage:
+                # uses of removed images are dropped
+                if image_id in self._entries:
+                    self._entries[image_id] = self._with_usage(
+                            image_id, self._entries[image_id],
+                            usage[image_id])
+            self._save()
+
+    def remove(self, image_id):
+        self._usage.pop(image_id, None)
+        with lockutils.lock('cache-index', external=True,
+                            lock_path=self.lock_path):
+            self._load()
+            if self._entries.pop(image_id, None) is not None:
+                self._save()
@@ -13,11 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
 import os
+import platform
+import shutil
 import socket
 import tempfile
 import time
 
+from eventlet import greenthread
 from oslo.config import cfg
 
 from nova.compute import power_state
@@ -33,10 +37,22 @@ from nova.virt.disk import api as disk
 from nova.virt import driver
 from nova.virt import netutils
 
+from pcsnovadriver.pcs import blockdevs
+from pcsnovadriver.pcs import events
 from pcsnovadriver.pcs import imagecache
+from pcsnovadriver.pcs import imageconv
+from pcsnovadriver.pcs import inventory
+from pcsnovadriver.pcs import locks
+from pcsnovadriver.pcs import perfstats
+from pcsnovadriver.pcs import pipeline
+from pcsnovadriver.pcs import ploop
+from pcsnovadriver.pcs import prewarm
 from pcsnovadriver.pcs import prlsdkapi_proxy
 from pcsnovadriver.pcs import template
 from pcsnovadriver.pcs import utils as pcsutils
+from pcsnovadriver.pcs import vecache
+from pcsnovadriver.pcs import veconfig
+from pcsnovadriver.pcs import vestate
 from pcsnovadriver.pcs.vif import PCSVIFDriver
 
 pc = prlsdkapi_proxy.consts
@@ -76,6 +92,14 @@ pcs_opts = [
                 help='The partition to inject to : '
                      '-2 => disable, -1 => inspect (libguestfs only), '
                      '0 => not partitioned, >0 => partition number'),
+    cfg.IntOpt('pcs_host_memory_stats_ttl',
+                default=10,
+                help='Time in seconds, for which host memory statistics '
+                     'are cached.'),
+    cfg.IntOpt('pcs_host_fs_stats_ttl',
+                default=60,
+                help='Time in seconds, for which host disk space '
+                     'statistics are cached.'),
     ]
 
 CONF = cfg.CONF
@@ -84,45 +108,34 @@ CONF.register_opts(pcs_opts)
 # FIXME: add this constant to prlsdkapi
 PRL_PRIVILEGED_GUEST_OS_SESSION = "531582ac-3dce-446f-8c26-dd7e3384dcf4"
 
-PCS_POWER_STATE = {
-    pc.VMS_COMPACTING: power_state.NOSTATE,
-    pc.VMS_CONTINUING: power_state.NOSTATE,
-    pc.VMS_DELETING_STATE: power_state.NOSTATE,
-    pc.VMS_MIGRATING: power_state.NOSTATE,
-    pc.VMS_PAUSED: power_state.PAUSED,
-    pc.VMS_PAUSING: power_state.RUNNING,
-    pc.VMS_RESETTING: power_state.RUNNING,
-    pc.VMS_RESTORING: power_state.NOSTATE,
-    pc.VMS_RESUMING: power_state.NOSTATE,
-    pc.VMS_RUNNING: power_state.RUNNING,
-    pc.VMS_SNAPSHOTING: power_state.RUNNING,
-    pc.VMS_STARTING: power_state.RUNNING,
-    pc.VMS_STOPPED: power_state.SHUTDOWN,
-    pc.VMS_STOPPING: power_state.RUNNING,
-    pc.VMS_SUSPENDED: power_state.SUSPENDED,
-    pc.VMS_SUSPENDING: power_state.RUNNING,
-    pc.VMS_SUSPENDING_SYNC: power_state.NOSTATE,
-}
-
-PCS_STATE_NAMES = {
-    pc.VMS_COMPACTING: 'COMPACTING',
-    pc.VMS_CONTINUING: 'CONTINUING',
-    pc.VMS_DELETING_STATE: 'DELETING_STATE',
-    pc.VMS_MIGRATING: 'MIGRATING',
-    pc.VMS_PAUSED: 'PAUSED',
-    pc.VMS_PAUSING: 'PAUSING',
-    pc.VMS_RESETTING: 'RESETTING',
-    pc.VMS_RESTORING: 'RESTORING',
-    pc.VMS_RESUMING: 'RESUMING',
-    pc.VMS_RUNNING: 'RUNNING',
-    pc.VMS_SNAPSHOTING: 'SNAPSHOTING',
-    pc.VMS_STARTING: 'STARTING',
-    pc.VMS_STOPPED: 'STOPPED',
-    pc.VMS_STOPPING: 'STOPPING',
-    pc.VMS_SUSPENDED: 'SUSPENDED',
-    pc.VMS_SUSPENDING: 'SUSPENDING',
-    pc.VMS_SUSPENDING_SYNC: 'SUSPENDING_SYNC',
-}
+# VE states and corresponding nova power states. Tables, keyed by
+# SDK constants, are built on the first use, so that importing the
+# driver doesn't import the SDK.
+_PCS_STATES = [
+    ('COMPACTING', power_state.NOSTATE),
+    ('CONTINUING', power_state.NOSTATE),
+    ('DELETING_STATE', power_state.NOSTATE),
+    ('MIGRATING', power_state.NOSTATE),
+    ('PAUSED', power_state.PAUSED),
+    ('PAUSING', power_state.RUNNING),
+    ('RESETTING', power_state.RUNNING),
+    ('RESTORING', power_state.NOSTATE),
+    ('RESUMING', power_state.NOSTATE),
+    ('RUNNING', power_state.RUNNING),
+    ('SNAPSHOTING', power_state.RUNNING),
+    ('STARTING', power_state.RUNNING),
+    ('STOPPED', power_state.SHUTDOWN),
+    ('STOPPING', power_state.RUNNING),
+    ('SUSPENDED', power_state.SUSPENDED),
+    ('SUSPENDING', power_state.RUNNING),
+    ('SUSPENDING_SYNC', power_state.NOSTATE),
+]
+
+PCS_POWER_STATE = pcsutils.LazyDict(lambda: dict(
+    (getattr(pc, 'VMS_' + name), state) for name, state in _PCS_STATES))
+
+PCS_STATE_NAMES = pcsutils.LazyDict(lambda: dict(
+    (getattr(pc, 'VMS_' + name), name) for name, state in _PCS_STATES))
 
 
 def get_sdk_errcode(strerr):
@@ -170,9 +183,17 @@ class PCSDriver(driver.ComputeDriver):
             raise NotImplementedError(firewall_msg)
         self.vif_driver = PCSVIFDriver()
         self.image_cache_manager = imagecache.ImageCacheManager(self)
-        self.image_cache = template.LZRWImageCache()
+        self.image_cache = template.get_image_cache()
+        self.image_scrubber = imagecache.ImageScrubber(self)
         self.volume_drivers = driver.driver_dict_from_config(
                                 CONF.pcs_volume_drivers, self)
+        self.locks = locks.LockManager()
+        self.events = events.EventDispatcher()
+        self.ve_cache = vecache.VECache(self.events)
+        self.state_watcher = vestate.StateWatcher(self.events)
+        self.inventory = inventory.Inventory(self)
+        self.perf_sampler = perfstats.PerfSampler(self)
+        self.blockdevs = blockdevs.BlockDeviceIndex(self)
 
     @property
     def host_state(self):
@@ -186,31 +207,46 @@ class PCSDriver(driver.ComputeDriver):
             self.host = host
 
         prlsdkapi_proxy.sdk.init_server_sdk()
-        self.psrv = prlsdkapi_proxy.sdk.Server()
-        self.psrv.login('localhost', CONF.pcs_login, CONF.pcs_password).wait()
-        self
+        self.sessions = prlsdkapi_proxy.SessionPool(self._login,
+                                CONF.pcs_session_pool_size)
+        self.sessions.subscribe(self._on_reconnect)
+        self.sessions.start()
+        self.psrv = prlsdkapi_proxy.PooledServer(self.sessions)
+        self.events.start(self.sessions.primary)
+        self.inventory.refresh()
+        self.blockdevs.rebuild()
+        self.perf_sampler.start()
+        self.image_scrubber.start()
+
+    def _login(self):
+        psrv = prlsdkapi_proxy.sdk.Server()
+        psrv.login('localhost', CONF.pcs_login, CONF.pcs_password).wait()
+        return psrv
+
+    def _on_reconnect(self, primary):
+        LOG.info("Reconnected to dispatcher, dropping VE handles")
+        if primary:
+            self.events.attach(primary)
+        self.ve_cache.clear()
+        self.inventory.invalidate()
+        self.blockdevs.invalidate()
 
     def list_instances(self):
         LOG.info("list_instances")
-        flags = pc.PVTF_CT | pc.PVTF_VM
-        ves = self.psrv.get_vm_list_ex(nFlags=flags).wait()
-        return map(lambda x: x.get_name(), ves)
+        return self.inventory.list_names()
 
     def list_instance_uuids(self):
         LOG.info("list_instance_uuids")
-        flags = pc.PVTF_CT | pc.PVTF_VM
-        ves = self.psrv.get_vm_list_ex(nFlags=flags).wait()
-        return map(lambda x: x.get_uuid()[1:-1], ves)
+        return self.inventory.list_uuids()
 
     def instance_exists(self, instance_id):
         LOG.info("instance_exists: %s" % instance_id)
-        try:
-            self._get_ve_by_name(instance_id)
-            return True
-        except exception.InstanceNotFound:
-            return False
+        return self.inventory.exists(instance_id)
 
     def _get_ve_by_name(self, name):
+        ve = self.ve_cache.get_by_name(name)
+        if ve is not None:
+            return ve
         try:
             ve = self.psrv.get_vm_config(name,
                         pc.PGVC_SEARCH_BY_NAME).wait()[0]
@@ -218,6 +254,7 @@ class PCSDriver(driver.ComputeDriver):
             if e.error_code == get_sdk_errcode('PRL_ERR_VM_UUID_NOT_FOUND'):
                 raise exception.InstanceNotFound(instance_id=name)
             raise
+        self.ve_cache.add(ve)
         return ve
 
     def _start(self, sdk_ve):
@@ -246,6 +283,9 @@ class PCSDriver(driver.ComputeDriver):
         return vm_info.get_state()
 
     def _wait_intermediate_state(self, sdk_ve):
+        """Wait until VE leaves any intermediate state and return
+        the state it has switched to.
+        """
         intermediate_states = [
             pc.VMS_COMPACTING,
             pc.VMS_CONTINUING,
@@ -262,17 +302,12 @@ class PCSDriver(driver.ComputeDriver):
             pc.VMS_SUSPENDING_SYNC,
             ]
 
-        while True:
-            state = self._get_state(sdk_ve)
-            if state not in intermediate_states:
-                break
-            LOG.info('VE "%s" is in %s state, waiting' %
-                     (sdk_ve.get_name(), PCS_STATE_NAMES[state]))
-            time.sleep(1)
+        return self.state_watcher.wait(sdk_ve, self._get_state,
+                    lambda state: state not in intermediate_states,
+                    PCS_STATE_NAMES)
 
     def _set_started_state(self, sdk_ve):
-        self._wait_intermediate_state(sdk_ve)
-        state = self._get_state(sdk_ve)
+        state = self._wait_intermediate_state(sdk_ve)
         LOG.info("Switch VE to RUNNING state, current is %s" %
                                         PCS_STATE_NAMES[state])
         if state == pc.VMS_STOPPED:
@@ -283,8 +318,7 @@ class PCSDriver(driver.ComputeDriver):
             self._unpause(sdk_ve)
 
     def _set_stopped_state(self, sdk_ve, kill):
-        self._wait_intermediate_state(sdk_ve)
-        state = self._get_state(sdk_ve)
+        state = self._wait_intermediate_state(sdk_ve)
         LOG.info("Switch VE to STOPPED state, current is %s" %
                                         PCS_STATE_NAMES[state])
         if state == pc.VMS_RUNNING:
@@ -297,8 +331,7 @@ class PCSDriver(driver.ComputeDriver):
             self._stop(sdk_ve, kill)
 
     def _set_paused_state(self, sdk_ve):
-        self._wait_intermediate_state(sdk_ve)
-        state = self._get_state(sdk_ve)
+        state = self._wait_intermediate_state(sdk_ve)
         LOG.info("Switch VE to PAUSED state, current is %s" %
                                         PCS_STATE_NAMES[state])
         if state == pc.VMS_RUNNING:
@@ -311,8 +344,7 @@ class PCSDriver(driver.ComputeDriver):
             self._pause(sdk_ve)
 
     def _set_suspended_state(self, sdk_ve):
-        self._wait_intermediate_state(sdk_ve)
-        state = self._get_state(sdk_ve)
+        state = self._wait_intermediate_state(sdk_ve)
         LOG.info("Switch VE to SUSPENDED state, current is %s" %
                                         PCS_STATE_NAMES[state])
         if state == pc.VMS_RUNNING:
@@ -343,6 +375,7 @@ class PCSDriver(driver.ComputeDriver):
         for vif in network_info:
             self.vif_driver.plug(self, instance, sdk_ve, vif)
 
+    @locks.instance_operation
     def plug_vifs(self, instance, network_info):
         LOG.info("plug_vifs: %s" % instance['name'])
         if not self.instance_exists(instance['name']):
@@ -355,32 +388,30 @@ class PCSDriver(driver.ComputeDriver):
         for vif in network_info:
             self.vif_driver.unplug(self, instance, sdk_ve, vif)
 
+    @locks.instance_operation
     def unplug_vifs(self, instance, network_info):
         LOG.info("unplug_vifs: %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
         self._unplug_vifs(instance, sdk_ve, network_info)
 
-    def _apply_flavor(self, instance, sdk_ve, resize_root_disk):
+    def _apply_flavor(self, instance, sdk_ve):
         metadata = instance.system_metadata
-        sdk_ve.begin_edit().wait()
-
-        sdk_ve.set_cpu_count(int(metadata['instance_type_vcpus']))
+        with veconfig.edit(sdk_ve):
+            sdk_ve.set_cpu_count(int(metadata['instance_type_vcpus']))
 
-        sdk_ve.set_ram_size(int(metadata['instance_type_memory_mb']))
-        if sdk_ve.get_vm_type() == pc.PVT_CT:
-            # Can't tune physpages and swappages for VMs
-            physpages = int(metadata['instance_type_memory_mb']) << 8
-            sdk_ve.set_resource(pc.PCR_PHYSPAGES, physpages, physpages)
+            sdk_ve.set_ram_size(int(metadata['instance_type_memory_mb']))
+            if sdk_ve.get_vm_type() == pc.PVT_CT:
+                # Can't tune physpages and swappages for VMs
+                physpages = int(metadata['instance_type_memory_mb']) << 8
+                sdk_ve.set_resource(pc.PCR_PHYSPAGES, physpages, physpages)
 
-            swappages = int(metadata['instance_type_swap']) << 8
-            sdk_ve.set_resource(pc.PCR_SWAPPAGES, swappages, swappages)
-        sdk_ve.commit().wait()
+                swappages = int(metadata['instance_type_swap']) << 8
+                sdk_ve.set_resource(pc.PCR_SWAPPAGES, swappages, swappages)
 
         # TODO(dguryanov): tune swap size in VMs
 
-        if not resize_root_disk:
-            return
-
+    def _resize_root_disk(self, instance, sdk_ve):
+        metadata = instance.system_metadata
         ndisks = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
         if ndisks != 1:
             raise Exception("More than one disk in container")
@@ -466,48 +497,116 @@ class PCSDriver(driver.ComputeDriver):
                               instance=instance)
 
     def _set_boot_device(self, sdk_ve, hdd):
-        sdk_ve.begin_edit().wait()
-        b = sdk_ve.create_boot_dev()
-        b.set_type(pc.PDE_HARD_DISK)
-        b.set_index(hdd.get_index())
-        b.set_sequence_index(0)
-        b.set_in_use(1)
-        sdk_ve.commit().wait()
+        with veconfig.edit(sdk_ve):
+            b = sdk_ve.create_boot_dev()
+            b.set_type(pc.PDE_HARD_DISK)
+            b.set_index(hdd.get_index())
+            b.set_sequence_index(0)
+            b.set_in_use(1)
+
+    def _get_disk_info(self, vol):
+        return {'dev': vol['mount_device'],
+                'mount_device': vol['mount_device']}
 
-    def spawn(self, context, instance, image_meta, injected_files,
-            admin_password, network_info=None, block_device_info=None):
-        LOG.info("spawn: %s" % (instance['name']))
+    def _create_ve(self, context, instance, image_meta):
+        if instance['image_ref']:
+            tmpl = template.get_template(self, context, instance, image_meta)
+            return tmpl.create_instance()
+        else:
+            return self._create_blank_vm(instance)
 
+    def _prepare_volumes(self, block_device_mapping):
+        paths = []
+        try:
+            for vol in block_device_mapping:
+                paths.append(self.volume_driver_method('connect_host',
+                        vol['connection_info'], self._get_disk_info(vol)))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._cleanup_volumes(block_device_mapping, paths)
+        return paths
+
+    def _cleanup_volumes(self, block_device_mapping, paths):
+        "Disconnect volumes, connected by _prepare_volumes."
+        for vol in block_device_mapping[:len(paths)]:
+            try:
+                self.volume_driver_method('disconnect_host',
+                        vol['connection_info'], self._get_disk_info(vol))
+            except Exception:
+                LOG.exception("Failed to disconnect volume %s" %
+                              vol['mount_device'])
+
+    def _prepare_network(self, instance, network_info):
+        for vif in network_info:
+            self.vif_driver.prepare(self, instance, vif)
+
+    def _cleanup_network(self, instance, network_info):
+        for vif in network_info:
+            try:
+                self.vif_driver.cleanup(self, instance, vif)
+            except Exception:
+                LOG.exception("Failed to clean up vif %s" % vif['devname'])
+
+    def _setup_ve(self, instance, network_info, block_device_mapping,
+                  sdk_ve, volume_paths):
+        """Configure VE, created by spawn. Returns VE, its boot
+        disk and flag, whether boot disk is a volume.
+        """
         boot_hdd = None
         booted_from_volume = False
-
         if instance['image_ref']:
-            tmpl = template.get_template(self, context, instance, image_meta)
-            sdk_ve = tmpl.create_instance()
             boot_hdd = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, 0)
-        else:
-            sdk_ve = self._create_blank_vm(instance)
 
-        self._apply_flavor(instance, sdk_ve,
-                resize_root_disk=bool(instance['image_ref']))
-        self._reset_network(sdk_ve)
-        for vif in network_info:
-            self.vif_driver.setup_dev(self, instance, sdk_ve, vif)
+        # All config changes are written to dispatcher with one commit
+        with veconfig.ConfigTransaction(sdk_ve):
+            self._apply_flavor(instance, sdk_ve)
+            self._reset_network(sdk_ve)
+            for vif in network_info:
+                self.vif_driver.setup_dev(self, instance, sdk_ve, vif)
+
+            for vol, path in zip(block_device_mapping, volume_paths):
+                hdd = self.volume_driver_method('attach_to_ve',
+                                    vol['connection_info'], sdk_ve, path,
+                                    self._get_disk_info(vol))
+                if instance['root_device_name'] == vol['mount_device']:
+                    self._set_boot_device(sdk_ve, hdd)
+                    boot_hdd = hdd
+                    booted_from_volume = True
+
+        if instance['image_ref']:
+            self._resize_root_disk(instance, sdk_ve)
+
+        return sdk_ve, boot_hdd, booted_from_volume
+
+    @locks.instance_operation
+    def spawn(self, context, instance, image_meta, injected_files,
+            admin_password, network_info=None, block_device_info=None):
+        LOG.info("spawn: %s" % (instance['name']))
 
         block_device_mapping = driver.block_device_info_get_mapping(
             block_device_info)
 
-        for vol in block_device_mapping:
-            connection_info = vol['connection_info']
-            disk_info = {
-                'dev': vol['mount_device'],
-                'mount_device': vol['mount_device']}
-            hdd = self.volume_driver_method('connect_volume',
-                                connection_info, sdk_ve, disk_info)
-            if instance['root_device_name'] == vol['mount_device']:
-                self._set_boot_device(sdk_ve, hdd)
-                boot_hdd = hdd
-                booted_from_volume = True
+        # Image download and unpacking, volume connections and host
+        # network devices don't depend on each other, so prepare them
+        # concurrently and join before configuring the VE. If spawn
+        # fails, connected volumes and created bridges are released,
+        # since destroy() can't find them without the VE.
+        spawn_pipeline = pipeline.Pipeline('spawn %s' % instance['name'])
+        spawn_pipeline.add_stage('create_ve', functools.partial(
+                self._create_ve, context, instance, image_meta))
+        spawn_pipeline.add_stage('prepare_volumes', functools.partial(
+                self._prepare_volumes, block_device_mapping),
+                undo=functools.partial(self._cleanup_volumes,
+                                       block_device_mapping))
+        spawn_pipeline.add_stage('prepare_network', functools.partial(
+                self._prepare_network, instance, network_info),
+                undo=lambda result: self._cleanup_network(instance,
+                                                          network_info))
+        spawn_pipeline.add_stage('setup_ve', functools.partial(
+                self._setup_ve, instance, network_info, block_device_mapping),
+                requires=['create_ve', 'prepare_volumes'])
+        results = spawn_pipeline.run()
+        sdk_ve, boot_hdd, booted_from_volume = results['setup_ve']
 
         if not boot_hdd:
             raise Exception("Boot disk is missing")
@@ -527,6 +626,7 @@ class PCSDriver(driver.ComputeDriver):
         self._plug_vifs(instance, sdk_ve, network_info)
         self._set_admin_password(sdk_ve, admin_password)
 
+    @locks.instance_operation
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True):
         LOG.info("destroy: %s" % instance['name'])
@@ -551,17 +651,51 @@ class PCSDriver(driver.ComputeDriver):
 
         sdk_ve.delete().wait()
 
+    def _get_ve_info(self, name):
+        info = self.inventory.get_by_name(name)
+        if info is None:
+            raise exception.InstanceNotFound(instance_id=name)
+        return info
+
     def get_info(self, instance):
         LOG.info("get_info: %s %s" % (instance['id'], instance['name']))
-        sdk_ve = self._get_ve_by_name(instance['name'])
-        vm_info = sdk_ve.get_state().wait().get_param()
+        info = self._get_ve_info(instance['name'])
+        sdk_ve = info.sdk_ve
+        sample = self.perf_sampler.get(info.uuid)
 
         data = {}
-        data['state'] = PCS_POWER_STATE[vm_info.get_state()]
+        data['state'] = PCS_POWER_STATE[info.state]
         data['max_mem'] = sdk_ve.get_ram_size()
-        data['mem'] = data['max_mem']
+        if sample and sample.mem is not None:
+            data['mem'] = sample.mem
+        else:
+            data['mem'] = data['max_mem']
         data['num_cpu'] = sdk_ve.get_cpu_count()
-        data['cpu_time'] = 1000
+        data['cpu_time'] = sample.cpu_time if sample else 0
+        return data
+
+    def get_diagnostics(self, instance):
+        LOG.info("get_diagnostics: %s" % instance['name'])
+        info = self._get_ve_info(instance['name'])
+        sample = self.perf_sampler.get(info.uuid)
+
+        data = {'memory': info.sdk_ve.get_ram_size()}
+        if not sample:
+            return data
+
+        data['cpu_time'] = sample.cpu_time
+        if sample.mem is not None:
+            data['memory-rss'] = sample.mem
+        for dev, counters in sample.disks.iteritems():
+            data[dev + '_read_req'] = counters[0]
+            data[dev + '_read'] = counters[1]
+            data[dev + '_write_req'] = counters[2]
+            data[dev + '_write'] = counters[3]
+        for dev, counters in sample.nics.iteritems():
+            data[dev + '_rx'] = counters[0]
+            data[dev + '_rx_packets'] = counters[1]
+            data[dev + '_tx'] = counters[2]
+            data[dev + '_tx_packets'] = counters[3]
         return data
 
     def get_host_stats(self, refresh=False):
@@ -570,12 +704,14 @@ class PCSDriver(driver.ComputeDriver):
 
     def get_available_resource(self, nodename):
         LOG.info("get_available_resource")
+        LOG.debug("VE cache: %s" % self.ve_cache.get_stats())
         return self.host_state.get_host_stats(refresh=True)
 
     @staticmethod
     def get_host_ip_addr():
         return CONF.my_ip
 
+    @locks.instance_operation
     def reboot(self, context, instance, network_info, reboot_type='SOFT',
             block_device_info=None, bad_volumes_callback=None):
         LOG.info("reboot %s" % instance['name'])
@@ -590,17 +726,20 @@ class PCSDriver(driver.ComputeDriver):
             self._set_started_state(sdk_ve)
         self._plug_vifs(instance, sdk_ve, network_info)
 
+    @locks.instance_operation
     def suspend(self, instance):
         LOG.info("suspend %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
         self._set_suspended_state(sdk_ve)
 
+    @locks.instance_operation
     def resume(self, resume, instance, network_info, block_device_info=None):
         LOG.info("resume %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
         self._set_started_state(sdk_ve)
         self._plug_vifs(instance, sdk_ve, network_info)
 
+    @locks.instance_operation
     def pause(self, instance):
         LOG.info("suspend %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
@@ -608,6 +747,7 @@ class PCSDriver(driver.ComputeDriver):
             raise NotImplementedError()
         self._set_paused_state(sdk_ve)
 
+    @locks.instance_operation
     def unpause(self, instance, network_info, block_device_info=None):
         LOG.info("resume %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
@@ -615,11 +755,13 @@ class PCSDriver(driver.ComputeDriver):
             raise NotImplementedError()
         self._set_started_state(sdk_ve)
 
+    @locks.instance_operation
     def power_off(self, instance):
         LOG.info("power_off %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
         self._set_stopped_state(sdk_ve, kill=False)
 
+    @locks.instance_operation
     def power_on(self, context, instance, network_info,
                     block_device_info=None):
         LOG.info("power_on %s" % instance['name'])
@@ -633,9 +775,8 @@ class PCSDriver(driver.ComputeDriver):
         sdk_ve = self._get_ve_by_name(instance['name'])
 
         if sdk_ve.get_vncmode() != pc.PRD_AUTO:
-            sdk_ve.begin_edit().wait()
-            sdk_ve.set_vncmode(pc.PRD_AUTO)
-            sdk_ve.commit().wait()
+            with veconfig.edit(sdk_ve):
+                sdk_ve.set_vncmode(pc.PRD_AUTO)
             sdk_ve.refresh_config()
 
         sleep_time = 0.5
@@ -657,12 +798,12 @@ class PCSDriver(driver.ComputeDriver):
         """
         ndevs = sdk_ve.get_devs_count_by_type(
                     pc.PDE_GENERIC_NETWORK_ADAPTER)
-        sdk_ve.begin_edit().wait()
-        for i in xrange(ndevs):
-            dev = sdk_ve.get_dev_by_type(pc.PDE_GENERIC_NETWORK_ADAPTER, i)
-            if dev.get_emulated_type() != pc.PNA_ROUTED:
-                dev.remove()
-        sdk_ve.commit().wait()
+        with veconfig.edit(sdk_ve):
+            for i in xrange(ndevs):
+                dev = sdk_ve.get_dev_by_type(
+                        pc.PDE_GENERIC_NETWORK_ADAPTER, i)
+                if dev.get_emulated_type() != pc.PNA_ROUTED:
+                    dev.remove()
 
     def _snapshot_ve(self, context, instance, image_id, update_task_state, ve):
         def upload(context, image_service, image_id, metadata, f):
@@ -697,34 +838,53 @@ class PCSDriver(driver.ComputeDriver):
         hdd_path = hdd.get_image_path()
 
         props['pcs_ostemplate'] = ve.get_os_template()
-        if disk_format == 'ploop':
-            xml_path = os.path.join(hdd_path, "DiskDescriptor.xml")
-            cmd = ['ploop', 'snapshot-list', '-H', '-o', 'fname', xml_path]
-            out, err = utils.execute(*cmd, run_as_root=True)
-            image_path = out.strip()
-
-            with open(xml_path) as f:
-                props['pcs_disk_descriptor'] = f.read().replace('\n', '')
-
-            with open(image_path) as f:
-                upload(context, snapshot_image_service, image_id, metadata, f)
-        elif disk_format == 'cploop':
-            uploader = pcsutils.CPloopUploader(hdd_path)
-            f = uploader.start()
+        if disk_format in ('ploop', 'cploop'):
+            flat_path = None
+            if len(ploop.get_descriptor(hdd_path).images) > 1:
+                # Linked clone or disk with snapshots, images below the
+                # top delta may be outside of the disk directory.
+                flat_path = tempfile.mkdtemp(dir=os.path.dirname(hdd_path))
+                LOG.info("Flattening disk %s to %s" % (hdd_path, flat_path))
+                imageconv.flatten_ploop(hdd_path, flat_path)
+                hdd_path = flat_path
             try:
-                upload(context, snapshot_image_service, image_id, metadata, f)
+                if disk_format == 'ploop':
+                    xml_path = os.path.join(hdd_path, "DiskDescriptor.xml")
+                    image_path = ploop.get_descriptor(hdd_path).top_image
+
+                    with open(xml_path) as f:
+                        props['pcs_disk_descriptor'] = \
+                                f.read().replace('\n', '')
+
+                    with open(image_path) as f:
+                        upload(context, snapshot_image_service, image_id,
+                               metadata, f)
+                else:
+                    uploader = pcsutils.CPloopUploader(hdd_path)
+                    f = uploader.start()
+                    try:
+                        upload(context, snapshot_image_service, image_id,
+                               metadata, f)
+                    finally:
+                        uploader.wait()
             finally:
-                uploader.wait()
+                if flat_path:
+                    shutil.rmtree(flat_path)
         else:
             dst = tempfile.mktemp(dir=os.path.dirname(hdd_path))
             LOG.info("Convert image %s to %s format ..." %
                      (image_id, disk_format))
-            pcsutils.convert_image(hdd_path, dst, disk_format,
-                                   root_helper=utils._get_root_helper())
+            if (CONF.pcs_native_image_conversion and
+                    disk_format in imageconv.FORMATS):
+                imageconv.convert_from_ploop(hdd_path, dst, disk_format)
+            else:
+                pcsutils.convert_image(hdd_path, dst, disk_format,
+                                       root_helper=utils._get_root_helper())
             with open(dst) as f:
                 upload(context, snapshot_image_service, image_id, metadata, f)
             os.unlink(dst)
 
+    @locks.instance_operation
     def snapshot(self, context, instance, image_id, update_task_state):
         LOG.info("snapshot %s" % instance['name'])
         sdk_ve = self._get_ve_by_name(instance['name'])
@@ -758,6 +918,16 @@ class PCSDriver(driver.ComputeDriver):
         LOG.info("manage_image_cache")
         self.image_cache_manager.update(context, all_instances)
 
+    def prewarm_images(self, context, image_ids, concurrency=None,
+                       bandwidth=None, callback=None):
+        """Fill image cache with given images in background. Returns
+        greenthread, which results in prewarm.Progress.
+        """
+        LOG.info("Pre-warming images %s" % ', '.join(image_ids))
+        return greenthread.spawn(prewarm.prewarm_images, self.image_cache,
+                                 context, image_ids, concurrency,
+                                 bandwidth, callback)
+
     def volume_driver_method(self, method_name, connection_info,
                              *args, **kwargs):
         driver_type = connection_info.get('driver_volume_type')
@@ -783,23 +953,12 @@ class PCSDriver(driver.ComputeDriver):
         return connector
 
     def get_disk_dev_path(self, hdd):
-        #FIXME: add snapshots support
-        xml_path = os.path.join(hdd.get_sys_name(), "DiskDescriptor.xml")
-        cmd = ['ploop', 'snapshot-list', '-H', '-o', 'fname', xml_path]
-        out, err = utils.execute(*cmd, run_as_root=True)
-        return out.strip()
+        return ploop.get_descriptor(hdd.get_sys_name()).top_image
 
     def get_used_block_devices(self):
-        ves = self.psrv.get_vm_list_ex(nFlags=pc.PVTF_VM).wait()
-        devices = []
-        for sdk_ve in ves:
-            n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
-            for i in xrange(n):
-                dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
-                if dev.get_emulated_type() == pc.PDT_USE_REAL_HDD:
-                    devices.append(self.get_disk_dev_path(dev))
-        return devices
+        return self.blockdevs.list_devices()
 
+    @locks.instance_operation
     def attach_volume(self, context, connection_info, instance, mountpoint,
                       encryption=None):
         LOG.info("attach_volume %s" % instance['name'])
@@ -813,6 +972,7 @@ class PCSDriver(driver.ComputeDriver):
         hdd = self.volume_driver_method('connect_volume',
                             connection_info, sdk_ve, disk_info)
 
+    @locks.instance_operation
     def detach_volume(self, connection_info, instance, mountpoint,
                       encryption=None):
         LOG.info("detach_volume %s" % instance['name'])
@@ -829,10 +989,24 @@ class PCSDriver(driver.ComputeDriver):
         self.volume_driver_method('disconnect_volume',
                             connection_info, sdk_ve, disk_info, True)
 
+
 class HostState(object):
+    """Host resources, reported to nova.
+
+    Facts, which don't change while the service runs (CPU count,
+    product version, VE directory), are fetched once. Memory and
+    disk space statistics are fetched again, when they are older
+    than pcs_host_memory_stats_ttl and pcs_host_fs_stats_ttl.
+    Resources, used by VEs, are computed from the VE inventory.
+    """
+
     def __init__(self, driver):
         super(HostState, self).__init__()
         self._stats = {}
+        self._static = None
+        # name -> (timestamp, value)
+        self._dynamic = {}
+        self._vm_folder = None
         self.driver = driver
         self.update_status()
 
@@ -845,42 +1019,80 @@ class HostState(object):
         pver = pver.split('.')
         return int(pver[0]) * 10000 + int(pver[1]) * 100
 
-    def get_fs_info(self):
-        fsinfo = {}
+    def _get_static(self):
+        if self._static:
+            return self._static
 
-        uinfo = self.driver.psrv.get_user_profile().wait()[0]
-        vm_folder = uinfo.get_default_vm_folder()
-        if not vm_folder:
-            vm_folder = "/var/parallels"
-        s = os.statvfs(vm_folder)
-        fsinfo['total'] = s.f_frsize * s.f_blocks
-        fsinfo['used'] = s.f_frsize * (s.f_blocks - s.f_bfree)
-        return fsinfo
-
-    def update_status(self):
-        stat = self.driver.psrv.get_statistics().wait()[0]
         cfg = self.driver.psrv.get_srv_config().wait()[0]
         info = self.driver.psrv.get_server_info()
-        fsinfo = self.get_fs_info()
-        data = {}
+        uinfo = self.driver.psrv.get_user_profile().wait()[0]
 
-        data = dict()
+        data = {}
         data['vcpus'] = cfg.get_cpu_count()
-        # TODO(dguryanov): think, how we can provide used CPUs
-        data['vcpus_used'] = 0
-        data['cpu_info'] = 0
-        data['memory_mb'] = stat.get_total_ram_size() >> 20
-        data['memory_mb_used'] = stat.get_usage_ram_size() >> 20
-        data['local_gb'] = fsinfo['total'] >> 30
-        data['local_gb_used'] = fsinfo['used'] >> 30
+        data['cpu_info'] = jsonutils.dumps({
+                'arch': platform.machine(),
+                'model': cfg.get_cpu_model(),
+            })
         data['hypervisor_type'] = 'PCS'
-        version = self._format_ver(info.get_product_version())
-        data['hypervisor_version'] = version
+        data['hypervisor_version'] = self._format_ver(
+                                        info.get_product_version())
         data['hypervisor_hostname'] = self.driver.host
         data["supported_instances"] = jsonutils.dumps([('i686', 'pcs', 'hvm'),
                                        ('x86_64', 'pcs', 'hvm'),
                                        ('i686', 'pcs', 'exe'),
                                        ('x86_64', 'pcs', 'exe')])
+        self._vm_folder = uinfo.get_default_vm_folder() or "/var/parallels"
+        self._static = data
+        return data
+
+    def _get_dynamic(self, name, ttl, fetch):
+        timestamp, value = self._dynamic.get(name, (0, None))
+        if time.time() - timestamp >= ttl:
+            value = fetch()
+            self._dynamic[name] = (time.time(), value)
+        return value
+
+    def _get_memory_info(self):
+        stat = self.driver.psrv.get_statistics().wait()[0]
+        return {'total': stat.get_total_ram_size() >> 20,
+                'used': stat.get_usage_ram_size() >> 20}
+
+    def get_fs_info(self):
+        fsinfo = {}
+        s = os.statvfs(self._vm_folder)
+        fsinfo['total'] = s.f_frsize * s.f_blocks
+        fsinfo['used'] = s.f_frsize * (s.f_blocks - s.f_bfree)
+        return fsinfo
+
+    def _get_ve_usage(self):
+        """Return number of CPUs and memory in megabytes, committed
+        to running VEs.
+        """
+        vcpus = 0
+        memory_mb = 0
+        for info in self.driver.inventory.list_ves():
+            if PCS_POWER_STATE.get(info.state) not in [power_state.RUNNING,
+                                                       power_state.PAUSED]:
+                continue
+            vcpus += info.sdk_ve.get_cpu_count()
+            memory_mb += info.sdk_ve.get_ram_size()
+        return vcpus, memory_mb
+
+    def update_status(self):
+        data = dict(self._get_static())
+        meminfo = self._get_dynamic('memory',
+                CONF.pcs_host_memory_stats_ttl, self._get_memory_info)
+        fsinfo = self._get_dynamic('fs',
+                CONF.pcs_host_fs_stats_ttl, self.get_fs_info)
+        vcpus_used, memory_committed = self._get_ve_usage()
+
+        data['vcpus_used'] = vcpus_used
+        data['memory_mb'] = meminfo['total']
+        # Report committed memory, if it's above the actual usage,
+        # so that the scheduler doesn't overcommit the host.
+        data['memory_mb_used'] = max(meminfo['used'], memory_committed)
+        data['local_gb'] = fsinfo['total'] >> 30
+        data['local_gb_used'] = fsinfo['used'] >> 30
 
         self._stats = data
 
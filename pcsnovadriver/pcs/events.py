@@ -0,0 +1,121 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import fcntl
+import os
+
+import eventlet
+from eventlet import greenio
+from eventlet import patcher
+
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+native_Queue = patcher.original("Queue")
+# os.write of monkey-patched os waits in the hub on EAGAIN
+native_os = patcher.original("os")
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+
+class VEEvent(object):
+    """Snapshot of a dispatcher event, taken in the SDK thread."""
+
+    def __init__(self, event_type, uuid, state=None):
+        self.event_type = event_type
+        self.uuid = uuid
+        self.state = state
+
+
+class EventDispatcher(object):
+    """Delivers dispatcher events to driver subsystems.
+
+    SDK calls event handlers from its own native thread, so
+    events are put to a native queue there and handed over to
+    subscribers from a green thread, woken up through a pipe.
+    The native thread writes to the raw non-blocking pipe fd,
+    green objects are used only on the reading side.
+    Subscribers, which need an up-to-date view, can also drain
+    the queue synchronously with dispatch_pending().
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._queue = native_Queue.Queue()
+        self._notify_fd = None
+        self._notify_recv = None
+
+    def subscribe(self, event_types, callback):
+        self._subscribers.append((frozenset(event_types), callback))
+
+    def start(self, psrv):
+        rpipe, wpipe = os.pipe()
+        flags = fcntl.fcntl(wpipe, fcntl.F_GETFL)
+        fcntl.fcntl(wpipe, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._notify_fd = wpipe
+        self._notify_recv = greenio.GreenPipe(rpipe, 'rb', 0)
+        eventlet.spawn_n(self._dispatch_thread)
+        self.attach(psrv)
+
+    def attach(self, psrv):
+        """Receive events from given session, used after the previous
+        one has been lost.
+        """
+        psrv.reg_event_handler(self._queue_event, None)
+
+    def _queue_event(self, event, user_data):
+        event_type = event.get_event_type()
+        state = None
+        if event_type == pc.PET_DSP_EVT_VM_STATE_CHANGED:
+            state = event.get_param_by_name('vminfo_vm_state').to_int32()
+        ve_event = VEEvent(event_type,
+                           pcsutils.strip_uuid(event.get_issuer_id()),
+                           state)
+        self._queue.put(ve_event)
+        if self._notify_fd is not None:
+            try:
+                native_os.write(self._notify_fd, ' ')
+            except OSError as e:
+                # pipe is full, so the reader will wake up anyway
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _dispatch_thread(self):
+        while True:
+            try:
+                self._notify_recv.read(1)
+            except ValueError:
+                return
+            self.dispatch_pending()
+
+    def dispatch_pending(self):
+        while True:
+            try:
+                ve_event = self._queue.get(block=False)
+            except native_Queue.Empty:
+                return
+            for event_types, callback in self._subscribers:
+                if ve_event.event_type not in event_types:
+                    continue
+                try:
+                    callback(ve_event)
+                except Exception:
+                    LOG.exception("Failed to handle event %s for VE %s" %
+                                  (ve_event.event_type, ve_event.uuid))
@@ -13,22 +13,157 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import time
+
+from oslo.config import cfg
+
 from nova.openstack.common import log as logging
+from nova.openstack.common import loopingcall
+
+from pcsnovadriver.pcs import utils as pcsutils
 
 LOG = logging.getLogger(__name__)
 
+imagecache_opts = [
+    cfg.IntOpt('pcs_image_cache_max_size',
+               default=0,
+               help='Size budget of the image cache in MB. Unused images '
+                    'are evicted in LRU order only while the cache is '
+                    'over budget. If neither budget nor '
+                    'pcs_image_cache_min_free is set, all unused images '
+                    'are evicted.'),
+    cfg.IntOpt('pcs_image_cache_min_free',
+               default=0,
+               help='Free space in MB to keep on the filesystem of '
+                    'the image cache. Unused images are evicted in LRU '
+                    'order while there is less free space.'),
+    cfg.IntOpt('pcs_image_cache_min_age',
+               default=3600,
+               help='Number of seconds since the last use of an image, '
+                    'during which it is not evicted. Images, used by '
+                    'instances, are marked as used on each cache update, '
+                    'so with pcs_image_cache_shared_dir it must be longer '
+                    'than image_cache_manager_interval, otherwise nodes '
+                    'evict images, used by instances of other nodes.'),
+    cfg.IntOpt('pcs_image_scrub_interval',
+               default=86400,
+               help='Interval in seconds between checks of cached image '
+                    'files against their recorded checksums, 0 disables '
+                    'checks.'),
+    cfg.IntOpt('pcs_image_scrub_rate',
+               default=10240,
+               help='Read rate of cached image checks in KB/s.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(imagecache_opts)
+
 
 class ImageCacheManager(object):
     def __init__(self, driver):
         self.driver = driver
 
+    def _get_free_space(self):
+        st = os.statvfs(self.driver.image_cache.path)
+        return st.f_bavail * st.f_frsize
+
     def update(self, context, all_instances):
         LOG.info("ImageCacheManager.update")
+        cache = self.driver.image_cache
         used_images = map(lambda x: x['image_ref'], all_instances)
         used_images = set(used_images)
 
-        cached_images = self.driver.image_cache.list_images()
-        for image in cached_images:
-            if image not in used_images:
-                LOG.info("ImageCacheManager: removing image %s" % image)
-                self.driver.image_cache.delete_image(image)
+        now = time.time()
+        total = 0
+        candidates = []
+        for image in cache.list_images():
+            size = cache.get_size(image)
+            total += size
+            if image in used_images:
+                cache.mark_used(image)
+                continue
+            last_used = cache.get_last_used(image)
+            if now - last_used < CONF.pcs_image_cache_min_age:
+                continue
+            if cache.in_use(image):
+                LOG.info("ImageCacheManager: image %s backs existing disks"
+                         % image)
+                continue
+            candidates.append((last_used, image, size))
+        candidates.sort()
+        # uses of images by this node, for other nodes sharing the cache
+        cache.flush_usage()
+
+        budget = CONF.pcs_image_cache_max_size << 20
+        min_free = CONF.pcs_image_cache_min_free << 20
+        free = self._get_free_space()
+        for last_used, image, size in candidates:
+            if budget or min_free:
+                over_budget = budget and total > budget
+                low_space = min_free and free < min_free
+                if not over_budget and not low_space:
+                    break
+            LOG.info("ImageCacheManager: removing image %s, last used "
+                     "%d seconds ago" % (image, now - last_used))
+            if not cache.delete_image(image):
+                continue
+            cache.stats['evictions'] += 1
+            total -= size
+            free += size
+
+        stats = cache.get_stats()
+        LOG.info("ImageCacheManager: %d images, cache size %d MB, "
+                 "hits %d, misses %d, evictions %d" %
+                 (stats['images'], stats['size'] >> 20, stats['hits'],
+                  stats['misses'], stats['evictions']))
+
+
+class ImageScrubber(object):
+    """Periodically re-reads cached image files and checks them
+    against checksums, recorded in the cache index, when they were
+    downloaded. Corrupted images are removed from the cache. Reads
+    are throttled to pcs_image_scrub_rate.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._timer = None
+
+    def start(self):
+        if CONF.pcs_image_scrub_interval <= 0:
+            return
+        self._timer = loopingcall.FixedIntervalLoopingCall(self._run)
+        self._timer.start(interval=CONF.pcs_image_scrub_interval,
+                          initial_delay=CONF.pcs_image_scrub_interval)
+
+    def _run(self):
+        try:
+            self.scrub()
+        except Exception:
+            LOG.exception("Failed to check cached images")
+
+    def scrub(self):
+        cache = self.driver.image_cache
+        throttle = pcsutils.Throttle(CONF.pcs_image_scrub_rate << 10)
+        corrupted = []
+        for image_id in cache.index.list():
+            entry = cache.index.get(image_id)
+            path = cache._get_cached_file(image_id)
+            if not entry or not entry.get('file_md5') or \
+                    not os.path.exists(path):
+                continue
+            # skip images, checked by other nodes, sharing the cache
+            if time.time() - entry.get('verified_at', 0) < \
+                    CONF.pcs_image_scrub_interval / 2:
+                continue
+            digest = pcsutils.file_digest(path, throttle=throttle)
+            if digest != entry['file_md5']:
+                LOG.error("Cached image %s is corrupted: md5 %s, "
+                          "expected %s, removing it" %
+                          (image_id, digest, entry['file_md5']))
+                cache.delete_image(image_id)
+                corrupted.append(image_id)
+            else:
+                cache.index.update(image_id, verified_at=time.time())
+        return corrupted
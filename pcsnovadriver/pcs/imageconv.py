@@ -0,0 +1,450 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Userspace conversion of disk images to and from ploop.
+
+Readers yield allocated data of an image as (offset, data) pairs in
+increasing order of offset, writers take data in the same order. So
+conversion is one sequential pass over the source, which needs
+neither root, nor a ploop device, nor qemu-img:
+
+    reader = Qcow2Reader(open('disk.qcow2', 'rb'))
+    writer = PloopWriter(open('root.hds', 'wb'), reader.size)
+    copy_image(reader, writer)
+
+Only ploop format v2 images are written. qcow2 images with backing
+files or encryption are not supported.
+
+Conversion is CPU-bound and runs in the calling green thread, so
+copy_image() yields to other green threads after every block.
+"""
+
+import os
+import struct
+import zlib
+
+from eventlet import greenthread
+
+from pcsnovadriver.pcs import ploop
+
+FORMATS = ('raw', 'qcow2')
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+PLOOP_SIG_V1 = 'WithoutFreeSpace'
+PLOOP_SIG_V2 = 'WithouFreSpacExt'
+PLOOP_IMAGE_COMPRESSED = 2
+# signature, type, heads, cylinders, sectors per block, number of
+# BAT entries, size in sectors, in use flag, offset of the first data
+# block in sectors, flags, reserved
+PLOOP_HEADER = struct.Struct('<16sIIIIIQIII8s')
+
+QCOW2_MAGIC = 'QFI\xfb'
+# magic, version, backing file offset and size, cluster bits, size,
+# encryption method, L1 size and offset, refcount table offset and
+# clusters, number of snapshots and their offset
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COPIED = 1 << 63
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+QCOW2_INCOMPAT_DIRTY = 1
+
+
+def _is_zero(data):
+    return data.count('\0') == len(data)
+
+
+def _read_at(f, offset, length):
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError('Unexpected end of image at offset %d' % offset)
+    return data
+
+
+class RawReader(object):
+    """Reads raw image. Source can be a pipe, if size is given."""
+
+    def __init__(self, f, size=None, chunk_size=DEFAULT_BLOCK_SIZE):
+        self.f = f
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def iter_data(self):
+        offset = 0
+        while offset < self.size:
+            data = self.f.read(min(self.chunk_size, self.size - offset))
+            if not data:
+                raise ValueError('Unexpected end of image at offset %d' %
+                                 offset)
+            if not _is_zero(data):
+                yield offset, data
+            offset += len(data)
+
+
+class Qcow2Reader(object):
+    "Reads qcow2 image of version 2 or 3."
+
+    def __init__(self, f):
+        self.f = f
+        header = QCOW2_HEADER.unpack(_read_at(f, 0, QCOW2_HEADER.size))
+        (magic, self.version, backing_offset, backing_size,
+         self.cluster_bits, self.size, crypt_method, self.l1_size,
+         self.l1_offset) = header[:9]
+        if magic != QCOW2_MAGIC:
+            raise ValueError('Not a qcow2 image')
+        if self.version not in (2, 3):
+            raise ValueError('Unsupported qcow2 version %d' % self.version)
+        if backing_offset:
+            raise ValueError('qcow2 images with backing files '
+                             'are not supported')
+        if crypt_method:
+            raise ValueError('Encrypted qcow2 images are not supported')
+        if self.version == 3:
+            incompat, = struct.unpack('>Q', _read_at(f, QCOW2_HEADER.size,
+                                                     8))
+            if incompat & ~QCOW2_INCOMPAT_DIRTY:
+                raise ValueError('Unsupported qcow2 features: %x' %
+                                 incompat)
+        self.cluster_size = 1 << self.cluster_bits
+
+    def _read_compressed(self, entry):
+        shift = 62 - (self.cluster_bits - 8)
+        offset = entry & ((1 << shift) - 1)
+        sectors = ((entry >> shift) & ((1 << (self.cluster_bits - 8)) - 1))
+        length = (sectors + 1) * SECTOR_SIZE - (offset & (SECTOR_SIZE - 1))
+        self.f.seek(offset)
+        data = self.f.read(length)
+        data = zlib.decompressobj(-12).decompress(data, self.cluster_size)
+        if len(data) != self.cluster_size:
+            raise ValueError('Invalid compressed cluster at offset %d' %
+                             offset)
+        return data
+
+    def iter_data(self):
+        l2_entries = self.cluster_size // 8
+        l1 = struct.unpack('>%dQ' % self.l1_size,
+                           _read_at(self.f, self.l1_offset, self.l1_size * 8))
+        for l1_index, l1_entry in enumerate(l1):
+            l2_offset = l1_entry & QCOW2_OFFSET_MASK
+            if not l2_offset:
+                continue
+            l2 = struct.unpack('>%dQ' % l2_entries,
+                               _read_at(self.f, l2_offset, self.cluster_size))
+            for l2_index, entry in enumerate(l2):
+                offset = (l1_index * l2_entries + l2_index) * self.cluster_size
+                if offset >= self.size:
+                    return
+                if entry & QCOW2_COMPRESSED:
+                    data = self._read_compressed(entry)
+                elif entry & QCOW2_ZERO or not entry & QCOW2_OFFSET_MASK:
+                    continue
+                else:
+                    data = _read_at(self.f, entry & QCOW2_OFFSET_MASK,
+                                    self.cluster_size)
+                yield offset, data[:self.size - offset]
+
+
+class PloopReader(object):
+    """Reads ploop from its image files, listed from the top delta
+    to the base image, as in ploop.DiskDescriptor.image_files.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.bats = []
+        self.block_size = None
+        for f in files:
+            header = PLOOP_HEADER.unpack(_read_at(f, 0, PLOOP_HEADER.size))
+            sig, sectors, bat_size, size = (header[0], header[4],
+                                            header[5], header[6])
+            if sig == PLOOP_SIG_V2:
+                unit = sectors * SECTOR_SIZE
+            elif sig == PLOOP_SIG_V1:
+                unit = SECTOR_SIZE
+                size &= 0xffffffff
+            else:
+                raise ValueError('Not a ploop image')
+            if self.block_size is None:
+                self.block_size = sectors * SECTOR_SIZE
+                self.size = size * SECTOR_SIZE
+            elif self.block_size != sectors * SECTOR_SIZE:
+                raise ValueError('Images of ploop have different '
+                                 'block sizes')
+            bat = struct.unpack('<%dI' % bat_size,
+                                _read_at(f, PLOOP_HEADER.size, bat_size * 4))
+            self.bats.append((bat, unit))
+
+    def iter_data(self):
+        nblocks = (self.size + self.block_size - 1) // self.block_size
+        for index in xrange(nblocks):
+            offset = index * self.block_size
+            for f, (bat, unit) in zip(self.files, self.bats):
+                if index < len(bat) and bat[index]:
+                    length = min(self.block_size, self.size - offset)
+                    data = _read_at(f, bat[index] * unit, length)
+                    if not _is_zero(data):
+                        yield offset, data
+                    break
+
+
+class _BlockWriter(object):
+    """Base class of writers of block based formats. Collects data
+    into blocks and passes complete non-zero blocks to _write_block.
+    """
+
+    def __init__(self, size, block_size):
+        self.size = size
+        self.block_size = block_size
+        self._index = None
+        self._block = None
+        self._zero = bytearray(block_size)
+
+    def write(self, offset, data):
+        while data:
+            index = offset // self.block_size
+            pos = offset % self.block_size
+            n = min(len(data), self.block_size - pos)
+            if index != self._index:
+                if self._index is not None and index < self._index:
+                    raise ValueError('Image data must be written in order')
+                self._flush()
+                self._index = index
+                self._block = bytearray(self.block_size)
+            self._block[pos:pos + n] = data[:n]
+            offset += n
+            data = data[n:]
+
+    def _flush(self):
+        if self._block is not None and self._block != self._zero:
+            self._write_block(self._index, self._block)
+        self._block = None
+
+    def _write_block(self, index, data):
+        raise NotImplementedError()
+
+
+class PloopWriter(_BlockWriter):
+    "Writes ploop image file of format v2."
+
+    def __init__(self, f, size, block_size=DEFAULT_BLOCK_SIZE):
+        size = (size + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+        super(PloopWriter, self).__init__(size, block_size)
+        self.f = f
+        self.bat = [0] * ((size + block_size - 1) // block_size)
+        bat_bytes = PLOOP_HEADER.size + 4 * len(self.bat)
+        # data blocks follow header and BAT, in block size units
+        self.first_block = (bat_bytes + block_size - 1) // block_size
+        self.next_block = self.first_block
+
+    def _write_block(self, index, data):
+        self.f.seek(self.next_block * self.block_size)
+        self.f.write(data)
+        self.bat[index] = self.next_block
+        self.next_block += 1
+
+    def close(self):
+        self._flush()
+        sectors = self.block_size // SECTOR_SIZE
+        size_sectors = self.size // SECTOR_SIZE
+        cylinders = (size_sectors + 16 * sectors - 1) // (16 * sectors)
+        header = PLOOP_HEADER.pack(PLOOP_SIG_V2, PLOOP_IMAGE_COMPRESSED,
+                                   16, cylinders, sectors, len(self.bat),
+                                   size_sectors, 0,
+                                   self.first_block * sectors, 0, '\0' * 8)
+        self.f.seek(0)
+        self.f.write(header)
+        self.f.write(struct.pack('<%dI' % len(self.bat), *self.bat))
+        self.f.truncate(self.next_block * self.block_size)
+
+
+class RawWriter(_BlockWriter):
+    "Writes sparse raw image."
+
+    def __init__(self, f, size, block_size=DEFAULT_BLOCK_SIZE):
+        super(RawWriter, self).__init__(size, block_size)
+        self.f = f
+
+    def _write_block(self, index, data):
+        offset = index * self.block_size
+        self.f.seek(offset)
+        self.f.write(data[:self.size - offset])
+
+    def close(self):
+        self._flush()
+        self.f.truncate(self.size)
+
+
+class Qcow2Writer(_BlockWriter):
+    """Writes qcow2 image of version 2. Data clusters are written
+    as they come, L2 tables and refcounts - on close.
+    """
+
+    def __init__(self, f, size, cluster_bits=16):
+        super(Qcow2Writer, self).__init__(size, 1 << cluster_bits)
+        self.f = f
+        self.cluster_bits = cluster_bits
+        self.l2_entries = self.block_size // 8
+        self.l1_size = ((size + self.block_size * self.l2_entries - 1) //
+                        (self.block_size * self.l2_entries))
+        # header is in cluster 0, L1 table follows it
+        self.l1_offset = self.block_size
+        self.next_cluster = 1 + self._clusters(self.l1_size * 8)
+        # L1 index -> L2 table
+        self.l2_tables = {}
+
+    def _clusters(self, nbytes):
+        return (nbytes + self.block_size - 1) // self.block_size
+
+    def _alloc(self):
+        offset = self.next_cluster * self.block_size
+        self.next_cluster += 1
+        return offset
+
+    def _write_block(self, index, data):
+        offset = self._alloc()
+        self.f.seek(offset)
+        self.f.write(data)
+        l2 = self.l2_tables.setdefault(index // self.l2_entries,
+                                       [0] * self.l2_entries)
+        l2[index % self.l2_entries] = offset | QCOW2_COPIED
+
+    def _write_refcounts(self):
+        "Write refcount table and blocks after all other clusters."
+        per_block = self.block_size // 2
+        table_clusters = blocks = 0
+        while True:
+            total = self.next_cluster + table_clusters + blocks
+            new_blocks = (total + per_block - 1) // per_block
+            new_table = self._clusters(new_blocks * 8)
+            if (new_blocks, new_table) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = new_blocks, new_table
+
+        table_offset = self.next_cluster * self.block_size
+        first_block = self.next_cluster + table_clusters
+        table = [(first_block + i) * self.block_size for i in xrange(blocks)]
+        self.f.seek(table_offset)
+        self.f.write(struct.pack('>%dQ' % blocks, *table).ljust(
+                                    table_clusters * self.block_size, '\0'))
+        refcounts = struct.pack('>H', 1) * total
+        self.f.write(refcounts.ljust(blocks * self.block_size, '\0'))
+        return table_offset, table_clusters
+
+    def close(self):
+        self._flush()
+        l1 = [0] * self.l1_size
+        for index in sorted(self.l2_tables):
+            offset = self._alloc()
+            self.f.seek(offset)
+            self.f.write(struct.pack('>%dQ' % self.l2_entries,
+                                     *self.l2_tables[index]))
+            l1[index] = offset | QCOW2_COPIED
+        self.f.seek(self.l1_offset)
+        self.f.write(struct.pack('>%dQ' % self.l1_size, *l1))
+
+        table_offset, table_clusters = self._write_refcounts()
+        header = QCOW2_HEADER.pack(QCOW2_MAGIC, 2, 0, 0, self.cluster_bits,
+                                   self.size, 0, self.l1_size,
+                                   self.l1_offset, table_offset,
+                                   table_clusters, 0, 0)
+        self.f.seek(0)
+        self.f.write(header)
+
+
+class StreamWriter(object):
+    """File-like object for sequential data, like glance download,
+    which passes it to an image writer.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.offset = 0
+
+    def write(self, data):
+        self.writer.write(self.offset, data)
+        self.offset += len(data)
+
+
+def get_reader(f, disk_format, size=None):
+    if disk_format == 'raw':
+        return RawReader(f, size)
+    elif disk_format == 'qcow2':
+        return Qcow2Reader(f)
+    raise ValueError("Unsupported disk format '%s'" % disk_format)
+
+
+def get_writer(f, disk_format, size):
+    if disk_format == 'raw':
+        return RawWriter(f, size)
+    elif disk_format == 'qcow2':
+        return Qcow2Writer(f, size)
+    raise ValueError("Unsupported disk format '%s'" % disk_format)
+
+
+def copy_image(reader, writer):
+    for offset, data in reader.iter_data():
+        writer.write(offset, data)
+        greenthread.sleep(0)
+    writer.close()
+
+
+def write_descriptor(path, size, block_size=DEFAULT_BLOCK_SIZE,
+                     image='root.hds'):
+    "Write DiskDescriptor.xml of ploop with one image to path."
+    with open(os.path.join(path, 'DiskDescriptor.xml'), 'w') as f:
+        f.write(ploop.make_descriptor(size, block_size, image))
+
+
+def convert_to_ploop(src, disk_format, dst, block_size=DEFAULT_BLOCK_SIZE):
+    "Make ploop in dst directory from raw or qcow2 image file."
+    with open(src, 'rb') as f:
+        reader = get_reader(f, disk_format)
+        with open(os.path.join(dst, 'root.hds'), 'wb') as out:
+            writer = PloopWriter(out, reader.size, block_size)
+            copy_image(reader, writer)
+    write_descriptor(dst, writer.size, block_size)
+
+
+def flatten_ploop(src, dst):
+    """Copy ploop in src directory, which can be a chain of images,
+    like a linked clone, to ploop with one image in dst directory.
+    """
+    files = [open(x, 'rb') for x in ploop.get_descriptor(src).image_files]
+    try:
+        reader = PloopReader(files)
+        with open(os.path.join(dst, 'root.hds'), 'wb') as out:
+            writer = PloopWriter(out, reader.size, reader.block_size)
+            copy_image(reader, writer)
+    finally:
+        for f in files:
+            f.close()
+    write_descriptor(dst, writer.size, reader.block_size)
+
+
+def convert_from_ploop(src, dst, disk_format):
+    "Convert ploop in src directory to raw or qcow2 image file."
+    files = [open(x, 'rb') for x in ploop.get_descriptor(src).image_files]
+    try:
+        reader = PloopReader(files)
+        with open(dst, 'wb') as out:
+            copy_image(reader, get_writer(out, disk_format, reader.size))
+    finally:
+        for f in files:
+            f.close()
@@ -0,0 +1,160 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+inventory_opts = [
+    cfg.IntOpt('pcs_inventory_refresh_interval',
+                default=60,
+                help='Maximum age in seconds of the host VE inventory '
+                     'snapshot. Snapshot is also refreshed after VE '
+                     'events.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(inventory_opts)
+
+
+class VEInfo(object):
+    "Inventory record of one VE."
+
+    __slots__ = ('name', 'uuid', 'vm_type', 'env_id', 'state', 'sdk_ve')
+
+    def __init__(self, sdk_ve, state=None):
+        self.name = sdk_ve.get_name()
+        self.uuid = pcsutils.strip_uuid(sdk_ve.get_uuid())
+        self.vm_type = sdk_ve.get_vm_type()
+        self.env_id = sdk_ve.get_env_id()
+        self.state = state
+        self.sdk_ve = sdk_ve
+
+
+class Inventory(object):
+    """Snapshot of all VEs on the host.
+
+    Snapshot is fetched with a single get_vm_list_ex call and is
+    refreshed not more often than once per
+    pcs_inventory_refresh_interval seconds, unless dispatcher reports,
+    that some VE was added, removed or reconfigured. VE states are
+    kept up to date from state change events between periodic
+    refreshes, which query states of all VEs again, so a lost event
+    doesn't leave a wrong state.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._ves = []
+        self._by_name = {}
+        self._by_uuid = {}
+        self._timestamp = 0
+        self._stale = True
+
+        driver.events.subscribe([pc.PET_DSP_EVT_VM_CONFIG_CHANGED,
+                                 pc.PET_DSP_EVT_VM_ADDED,
+                                 pc.PET_DSP_EVT_VM_UNREGISTERED,
+                                 pc.PET_DSP_EVT_VM_DELETED],
+                                self._on_changed)
+        driver.events.subscribe([pc.PET_DSP_EVT_VM_STATE_CHANGED],
+                                self._on_state_changed)
+
+    def _on_changed(self, ve_event):
+        self._stale = True
+
+    def invalidate(self):
+        "Drop the snapshot, VE handles in it are no longer valid."
+        self._stale = True
+        self._by_uuid = {}
+
+    def _on_state_changed(self, ve_event):
+        info = self._by_uuid.get(ve_event.uuid)
+        if info:
+            info.state = ve_event.state
+
+    def _get_states(self, ves):
+        """Query states of given VEs. All requests are sent before
+        waiting for the first reply.
+        """
+        jobs = [sdk_ve.get_state() for sdk_ve in ves]
+        return [job.wait().get_param().get_state() for job in jobs]
+
+    def refresh(self, query_states=True):
+        """Fetch the VE list. States, known from events, are kept,
+        unless query_states is True.
+        """
+        flags = pc.PVTF_CT | pc.PVTF_VM
+        ves = self.driver.psrv.get_vm_list_ex(nFlags=flags).wait()
+        self._stale = False
+        self._timestamp = time.time()
+
+        by_uuid = {}
+        unknown = []
+        for sdk_ve in ves:
+            old = None
+            if not query_states:
+                old = self._by_uuid.get(
+                        pcsutils.strip_uuid(sdk_ve.get_uuid()))
+            info = VEInfo(sdk_ve, old and old.state)
+            by_uuid[info.uuid] = info
+            if info.state is None:
+                unknown.append(info)
+        for info, state in zip(unknown,
+                    self._get_states([x.sdk_ve for x in unknown])):
+            info.state = state
+
+        self._ves = [by_uuid[pcsutils.strip_uuid(x.get_uuid())]
+                     for x in ves]
+        self._by_uuid = by_uuid
+        self._by_name = dict((x.name, x) for x in self._ves)
+        self.driver.ve_cache.populate(ves)
+        LOG.debug("Inventory refreshed, %d VEs" % len(self._ves))
+
+    def _snapshot(self):
+        self.driver.events.dispatch_pending()
+        age = time.time() - self._timestamp
+        if age >= CONF.pcs_inventory_refresh_interval:
+            self.refresh()
+        elif self._stale:
+            self.refresh(query_states=False)
+        return self._ves
+
+    def list_ves(self, vm_type=None):
+        ves = self._snapshot()
+        if vm_type is None:
+            return list(ves)
+        return [x for x in ves if x.vm_type == vm_type]
+
+    def list_names(self):
+        return [x.name for x in self._snapshot()]
+
+    def list_uuids(self):
+        return [x.uuid for x in self._snapshot()]
+
+    def get_by_name(self, name):
+        self._snapshot()
+        return self._by_name.get(name)
+
+    def exists(self, name):
+        return self.get_by_name(name) is not None
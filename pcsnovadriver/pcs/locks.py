@@ -0,0 +1,76 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import functools
+import inspect
+import time
+
+from eventlet import semaphore
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class LockManager(object):
+    """Named locks of the driver.
+
+    Every instance and every shared host resource (iSCSI target,
+    bridge, PStorage cluster mount) has its own lock, so operations
+    on unrelated objects never wait for each other. Host tools with
+    global state, like iscsiadm, are serialized by plain named locks.
+    Locks are created on demand and dropped, when nobody holds or
+    waits for them.
+    """
+
+    def __init__(self):
+        # name -> [semaphore, number of holders and waiters]
+        self._locks = {}
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        entry = self._locks.setdefault(name, [semaphore.Semaphore(), 0])
+        entry[1] += 1
+        start = time.time()
+        try:
+            with entry[0]:
+                waited = time.time() - start
+                if waited > 1:
+                    LOG.debug("Waited %.2f seconds for lock %s" %
+                              (waited, name))
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[name]
+
+    def instance(self, instance_uuid):
+        return self.lock('instance-%s' % instance_uuid)
+
+    def resource(self, kind, name):
+        return self.lock('%s-%s' % (kind, name))
+
+
+def instance_operation(f):
+    """Decorator for driver methods, which runs the method under
+    the lock of its instance argument.
+    """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        instance = inspect.getcallargs(f, self, *args, **kwargs)['instance']
+        with self.locks.instance(instance['uuid']):
+            return f(self, *args, **kwargs)
+    return wrapper
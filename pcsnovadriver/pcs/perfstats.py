@@ -0,0 +1,139 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import log as logging
+from nova.openstack.common import loopingcall
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+perfstats_opts = [
+    cfg.IntOpt('pcs_perf_stats_interval',
+                default=60,
+                help='Interval in seconds between samplings of VE '
+                     'performance counters, 0 disables sampling.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(perfstats_opts)
+
+# guest.cpu.time is reported in microseconds, nova wants nanoseconds
+CPU_TIME_SCALE = 1000
+
+
+class PerfSample(object):
+    """Performance counters of one VE.
+
+    disks maps device name to (read_requests, read_bytes,
+    write_requests, write_bytes), nics maps interface name to
+    (rx_bytes, rx_packets, tx_bytes, tx_packets).
+    """
+
+    __slots__ = ('timestamp', 'cpu_time', 'mem', 'disks', 'nics')
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.cpu_time = 0
+        self.mem = None
+        self.disks = {}
+        self.nics = {}
+
+
+DISK_COUNTERS = ['read_requests', 'read_total',
+                 'write_requests', 'write_total']
+NIC_COUNTERS = ['bytes_in', 'pkts_in', 'bytes_out', 'pkts_out']
+
+
+def _set_counter(table, dev, counters, counter, value):
+    if counter not in counters:
+        return
+    row = table.setdefault(dev, [0] * len(counters))
+    row[counters.index(counter)] = value
+
+
+def parse_perf_stats(stats, timestamp):
+    """Convert event with performance counters to PerfSample."""
+    sample = PerfSample(timestamp)
+    for i in xrange(stats.get_params_count()):
+        param = stats.get_param(i)
+        name = param.get_name()
+        parts = name.split('.')
+        if name == 'guest.cpu.time':
+            sample.cpu_time = param.to_uint64() * CPU_TIME_SCALE
+        elif name == 'guest.ram.usage':
+            sample.mem = param.to_uint64()
+        elif parts[0] == 'devices' and len(parts) == 3:
+            _set_counter(sample.disks, parts[1], DISK_COUNTERS,
+                         parts[2], param.to_uint64())
+        elif parts[0] == 'net' and len(parts) == 3:
+            _set_counter(sample.nics, parts[1], NIC_COUNTERS,
+                         parts[2], param.to_uint64())
+    for table in sample.disks, sample.nics:
+        for dev in table:
+            table[dev] = tuple(table[dev])
+    return sample
+
+
+class PerfSampler(object):
+    """Periodically samples performance counters of all running VEs.
+
+    Requests for all VEs are sent in one pass and only then replies
+    are waited for, so a pass costs about one dispatcher round trip.
+    get_info and get_diagnostics are served from the last pass.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._samples = {}
+        self._timer = None
+
+    def start(self):
+        if CONF.pcs_perf_stats_interval <= 0:
+            return
+        self._timer = loopingcall.FixedIntervalLoopingCall(self._run)
+        self._timer.start(interval=CONF.pcs_perf_stats_interval)
+
+    def _run(self):
+        try:
+            self.sample()
+        except Exception:
+            LOG.exception("Failed to sample VE performance counters")
+
+    def sample(self):
+        ves = [x for x in self.driver.inventory.list_ves()
+               if x.state == pc.VMS_RUNNING]
+        jobs = [(x.uuid, x.sdk_ve.get_perf_stats('*')) for x in ves]
+
+        samples = {}
+        for uuid, job in jobs:
+            try:
+                stats = job.wait().get_param()
+            except prlsdkapi_proxy.sdk.PrlSDKError as e:
+                LOG.debug("Can't get performance counters of VE %s: %s" %
+                          (uuid, e))
+                continue
+            samples[uuid] = parse_perf_stats(stats, time.time())
+        self._samples = samples
+
+    def get(self, uuid):
+        return self._samples.get(pcsutils.strip_uuid(uuid))
@@ -0,0 +1,100 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+import time
+
+import eventlet
+import six
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Pipeline(object):
+    """Runs stages of an operation concurrently in green threads.
+
+    Each stage starts as soon as all stages it requires have
+    finished and gets their results as arguments, in the order
+    they are listed in requires. A stage, which requires a failed
+    stage, fails with the same error. run() waits for all stages
+    and raises the error of the first failed stage in the order
+    they were added. Before that, undo(result) of every finished
+    stage, which has it, is called in reverse order, so stages
+    can release host resources, nobody is going to use.
+
+    pipeline = Pipeline('spawn')
+    pipeline.add_stage('a', get_a)
+    pipeline.add_stage('b', get_b)
+    pipeline.add_stage('c', lambda a, b: a + b, requires=['a', 'b'])
+    result = pipeline.run()['c']
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = {}
+        self._stages = []
+        # stage name -> undo function
+        self._undo = {}
+
+    def add_stage(self, name, func, requires=(), undo=None):
+        self._stages.append((name, func, list(requires)))
+        if undo is not None:
+            self._undo[name] = undo
+
+    def _run_stage(self, name, func, deps):
+        args = [dep.wait() for dep in deps]
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[name] = time.time() - start
+            LOG.info("%s: stage %s took %.2f seconds" %
+                     (self.name, name, self.timings[name]))
+
+    def run(self):
+        start = time.time()
+        threads = {}
+        for name, func, requires in self._stages:
+            deps = [threads[x] for x in requires]
+            threads[name] = eventlet.spawn(self._run_stage, name, func, deps)
+
+        results = {}
+        exc_info = None
+        for name, func, requires in self._stages:
+            try:
+                results[name] = threads[name].wait()
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+
+        LOG.info("%s: finished in %.2f seconds" %
+                 (self.name, time.time() - start))
+        if exc_info:
+            self._rollback(results)
+            six.reraise(*exc_info)
+        return results
+
+    def _rollback(self, results):
+        for name, func, requires in reversed(self._stages):
+            if name not in results or name not in self._undo:
+                continue
+            LOG.info("%s: undoing stage %s" % (self.name, name))
+            try:
+                self._undo[name](results[name])
+            except Exception:
+                LOG.exception("%s: failed to undo stage %s" %
+                              (self.name, name))
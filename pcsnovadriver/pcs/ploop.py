@@ -0,0 +1,221 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Helpers for ploop metadata (DiskDescriptor.xml)."""
+
+import errno
+import os
+import uuid
+from xml.etree import cElementTree as etree
+
+from nova import utils
+
+SECTOR_SIZE = 512
+NULL_GUID = '{00000000-0000-0000-0000-000000000000}'
+
+# ploop directory -> ((mtime, inode, size), DiskDescriptor)
+_cache = {}
+
+
+class DiskDescriptor(object):
+    """Parsed DiskDescriptor.xml.
+
+    size and block_size are in bytes. images maps snapshot GUID to
+    image file name, as written in the descriptor, parents maps
+    snapshot GUID to GUID of its parent.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.size = 0
+        self.block_size = 0
+        self.images = {}
+        self.parents = {}
+        self.top_guid = None
+
+    def image_path(self, guid):
+        fname = self.images[guid]
+        if self.path is None:
+            return fname
+        return os.path.join(self.path, fname)
+
+    @property
+    def chain(self):
+        "GUIDs of snapshots from the top delta to the base image."
+        chain = []
+        guid = self.top_guid
+        while guid and guid != NULL_GUID:
+            chain.append(guid)
+            guid = self.parents.get(guid)
+        return chain
+
+    @property
+    def top_image(self):
+        return self.image_path(self.top_guid)
+
+    @property
+    def image_files(self):
+        return [self.image_path(x) for x in self.chain]
+
+
+DESCRIPTOR_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Parallels_disk_image Version="1.0">
+  <Disk_Parameters>
+    <Disk_size>%(sectors)d</Disk_size>
+    <Cylinders>%(cylinders)d</Cylinders>
+    <Heads>16</Heads>
+    <Sectors>63</Sectors>
+    <Padding>0</Padding>
+  </Disk_Parameters>
+  <StorageData>
+    <Storage>
+      <Start>0</Start>
+      <End>%(sectors)d</End>
+      <Blocksize>%(block_sectors)d</Blocksize>
+      <Image>
+        <GUID>%(guid)s</GUID>
+        <Type>Compressed</Type>
+        <File>%(image)s</File>
+      </Image>
+    </Storage>
+  </StorageData>
+  <Snapshots>
+    <TopGUID>%(guid)s</TopGUID>
+    <Shot>
+      <GUID>%(guid)s</GUID>
+      <ParentGUID>%(parent)s</ParentGUID>
+    </Shot>
+  </Snapshots>
+</Parallels_disk_image>
+"""
+
+
+def make_descriptor(size, block_size, image):
+    """Return DiskDescriptor.xml of a ploop, which consists of one
+    image file. size and block_size are in bytes.
+    """
+    sectors = size // SECTOR_SIZE
+    return DESCRIPTOR_TEMPLATE % {
+        'sectors': sectors,
+        'cylinders': sectors // (16 * 63),
+        'block_sectors': block_size // SECTOR_SIZE,
+        'guid': '{%s}' % uuid.uuid4(),
+        'image': image,
+        'parent': NULL_GUID,
+    }
+
+
+def _get_text(elem, path):
+    node = elem.find(path)
+    if node is None or node.text is None:
+        raise ValueError('Invalid DiskDescriptor.xml: no %s' % path)
+    return node.text.strip()
+
+
+def parse(data, path=None):
+    """Parse contents of DiskDescriptor.xml. path is the ploop
+    directory, image paths are relative to it.
+    """
+    root = etree.fromstring(data)
+    dd = DiskDescriptor(path)
+    dd.size = int(_get_text(root, 'Disk_Parameters/Disk_size')) * SECTOR_SIZE
+
+    storages = root.findall('StorageData/Storage')
+    if not storages:
+        raise ValueError('Invalid DiskDescriptor.xml: no Storage')
+    dd.block_size = int(_get_text(storages[0], 'Blocksize')) * SECTOR_SIZE
+    for storage in storages:
+        for image in storage.findall('Image'):
+            dd.images[_get_text(image, 'GUID')] = _get_text(image, 'File')
+
+    for shot in root.findall('Snapshots/Shot'):
+        dd.parents[_get_text(shot, 'GUID')] = _get_text(shot, 'ParentGUID')
+    if root.find('Snapshots/TopGUID') is not None:
+        dd.top_guid = _get_text(root, 'Snapshots/TopGUID')
+    elif len(dd.images) == 1:
+        dd.top_guid = dd.images.keys()[0]
+    else:
+        raise ValueError('Invalid DiskDescriptor.xml: no TopGUID')
+    return dd
+
+
+def _read(dd_path):
+    try:
+        with open(dd_path) as f:
+            return f.read()
+    except IOError as e:
+        if e.errno != errno.EACCES:
+            raise
+    return utils.read_file_as_root(dd_path)
+
+
+def get_descriptor(path):
+    """Return DiskDescriptor of ploop in given directory. Results
+    are cached until DiskDescriptor.xml is modified. Descriptors,
+    which only root can access, are read as root and not cached.
+    """
+    dd_path = os.path.join(path, 'DiskDescriptor.xml')
+    try:
+        st = os.stat(dd_path)
+    except OSError as e:
+        if e.errno != errno.EACCES:
+            raise
+        return parse(utils.read_file_as_root(dd_path), path)
+    version = (st.st_mtime, st.st_ino, st.st_size)
+    cached = _cache.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    dd = parse(_read(dd_path), path)
+    _cache[path] = (version, dd)
+    return dd
+
+
+def read_descriptor(path):
+    "Return contents of DiskDescriptor.xml of ploop in given directory."
+    return _read(os.path.join(path, 'DiskDescriptor.xml'))
+
+
+def link_descriptor(base_data, base_path, delta_data):
+    """Make DiskDescriptor.xml of a linked clone.
+
+    Takes descriptor of the base ploop in base_path and descriptor
+    of a new empty delta with the same geometry and returns
+    descriptor of a ploop, where the delta is on top of the base
+    images. Base images are referenced by absolute paths.
+    """
+    base_top = parse(base_data).top_guid
+    root = etree.fromstring(base_data)
+    for image in root.findall('StorageData/Storage/Image'):
+        node = image.find('File')
+        node.text = os.path.join(base_path, node.text.strip())
+
+    delta_image = etree.fromstring(delta_data).find(
+                                        'StorageData/Storage/Image')
+    if delta_image is None:
+        raise ValueError('Invalid DiskDescriptor.xml: no Image')
+    guid = _get_text(delta_image, 'GUID')
+    root.find('StorageData/Storage').append(delta_image)
+
+    snapshots = root.find('Snapshots')
+    if snapshots is None:
+        snapshots = etree.SubElement(root, 'Snapshots')
+    top = snapshots.find('TopGUID')
+    if top is None:
+        top = etree.SubElement(snapshots, 'TopGUID')
+    top.text = guid
+    shot = etree.SubElement(snapshots, 'Shot')
+    etree.SubElement(shot, 'GUID').text = guid
+    etree.SubElement(shot, 'ParentGUID').text = base_top
+    return etree.tostring(root)
@@ -0,0 +1,113 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Filling image cache ahead of spawns."""
+
+from eventlet import greenpool
+from oslo.config import cfg
+
+from nova.image import glance
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import utils as pcsutils
+
+LOG = logging.getLogger(__name__)
+
+prewarm_opts = [
+    cfg.IntOpt('pcs_prewarm_concurrency',
+               default=2,
+               help='Number of images, downloaded in parallel by image '
+                    'cache pre-warming.'),
+    cfg.IntOpt('pcs_prewarm_bandwidth',
+               default=0,
+               help='Limit of total download rate of image cache '
+                    'pre-warming in KB/s, 0 means no limit.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(prewarm_opts)
+
+
+class Progress(object):
+    """Progress of pre-warming. callback(progress, image_id, error)
+    is called, when an image is cached or has failed.
+    """
+
+    def __init__(self, image_ids, throttle, callback=None):
+        self.image_ids = list(image_ids)
+        self.throttle = throttle
+        self.callback = callback
+        self.cached = []
+        self.failed = {}
+
+    @property
+    def total(self):
+        return len(self.image_ids)
+
+    @property
+    def finished(self):
+        return len(self.cached) + len(self.failed)
+
+    @property
+    def downloaded(self):
+        "Number of bytes, downloaded so far."
+        return self.throttle.transferred
+
+    def report(self, image_id, error=None):
+        if error is None:
+            self.cached.append(image_id)
+        else:
+            self.failed[image_id] = error
+        LOG.info("Pre-warming: %d of %d images done, %d failed" %
+                 (self.finished, self.total, len(self.failed)))
+        if self.callback:
+            self.callback(self, image_id, error)
+
+
+def _prefetch(image_cache, context, image_id, progress):
+    try:
+        image_service, image_id = glance.get_remote_image_service(context,
+                                                                  image_id)
+        image_meta = image_service.show(context, image_id)
+        if image_meta['disk_format'] == 'ez-template':
+            LOG.info("Image %s is an ez template, skipping" % image_id)
+        else:
+            image_cache.prefetch(context, image_id, image_meta,
+                                 progress.throttle)
+    except Exception as e:
+        LOG.exception("Failed to pre-warm image %s" % image_id)
+        progress.report(image_id, e)
+    else:
+        progress.report(image_id)
+
+
+def prewarm_images(image_cache, context, image_ids, concurrency=None,
+                   bandwidth=None, callback=None):
+    """Put given images to the image cache, running at most
+    concurrency downloads with total rate up to bandwidth KB/s.
+    Returns Progress, when all images are processed.
+    """
+    if concurrency is None:
+        concurrency = CONF.pcs_prewarm_concurrency
+    if bandwidth is None:
+        bandwidth = CONF.pcs_prewarm_bandwidth
+
+    progress = Progress(image_ids, pcsutils.Throttle(bandwidth << 10),
+                        callback)
+    pool = greenpool.GreenPool(concurrency)
+    for image_id in progress.image_ids:
+        pool.spawn_n(_prefetch, image_cache, context, image_id, progress)
+    pool.waitall()
+    return progress
@@ -13,26 +13,275 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import functools
+import time
+
+from eventlet import semaphore
+from eventlet import tpool
+from oslo.config import cfg
+
+from nova.openstack.common import excutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import loopingcall
+
+LOG = logging.getLogger(__name__)
+
+proxy_opts = [
+    cfg.IntOpt('pcs_sdk_thread_pool_size',
+                default=20,
+                help='Number of native threads, which wait for SDK jobs, '
+                     'so that long operations on one VE don\'t block '
+                     'the whole compute service. 0 makes SDK jobs '
+                     'to be waited for in the calling thread.'),
+    cfg.IntOpt('pcs_session_pool_size',
+                default=4,
+                help='Number of dispatcher sessions, used for '
+                     'concurrent SDK calls.'),
+    cfg.IntOpt('pcs_session_connect_retries',
+                default=5,
+                help='Number of attempts to log in to dispatcher.'),
+    cfg.IntOpt('pcs_session_retry_interval',
+                default=1,
+                help='Initial interval in seconds between login attempts, '
+                     'doubled after each failed attempt.'),
+    cfg.IntOpt('pcs_session_retry_max_interval',
+                default=30,
+                help='Maximum interval in seconds between login '
+                     'attempts.'),
+    cfg.IntOpt('pcs_session_check_interval',
+                default=30,
+                help='Interval in seconds between health checks of idle '
+                     'dispatcher sessions, 0 disables checks.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(proxy_opts)
+
 prlsdkapi = None
 
 
+def _execute_in_tpool(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return tpool.execute(func, *args, **kwargs)
+    wrapper.in_tpool = True
+    return wrapper
+
+
+def init_execution(module):
+    """Make Job.wait() of given SDK module run in native threads.
+
+    Job.wait() is a blocking native call, which would stop eventlet
+    hub and all green threads until the dispatcher replies.
+    """
+    if CONF.pcs_sdk_thread_pool_size <= 0:
+        return
+    if getattr(module.Job.wait, 'in_tpool', False):
+        return
+    tpool.set_num_threads(CONF.pcs_sdk_thread_pool_size)
+    module.Job.wait = _execute_in_tpool(module.Job.wait)
+
+
+class SessionPool(object):
+    """Pool of logged in dispatcher sessions.
+
+    Sessions are checked out for a call and checked in after it,
+    so calls from different green threads don't contend on one
+    session. Session is checked with is_connected() on checkout
+    and periodically while idle. A dead session means dispatcher
+    has been restarted, so all sessions are checked, dead ones are
+    dropped, and subscribers are notified, that VE handles got
+    before are no longer valid.
+
+    Primary session is never checked out, it is for long-living
+    things like event handlers. Subscribers get the new primary
+    session, if it has been replaced, or None.
+    """
+
+    def __init__(self, connect, size):
+        self._connect = connect
+        self._idle = []
+        self._slots = semaphore.Semaphore(size)
+        self._recover_lock = semaphore.Semaphore()
+        self._subscribers = []
+        self._timer = None
+        self.primary = None
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def start(self):
+        self.primary = self._login()
+        if CONF.pcs_session_check_interval > 0:
+            self._timer = loopingcall.FixedIntervalLoopingCall(self.check)
+            self._timer.start(interval=CONF.pcs_session_check_interval,
+                              initial_delay=CONF.pcs_session_check_interval)
+
+    def _login(self):
+        interval = CONF.pcs_session_retry_interval
+        attempt = 1
+        while True:
+            try:
+                return self._connect()
+            except sdk.PrlSDKError as e:
+                if attempt >= CONF.pcs_session_connect_retries:
+                    raise
+                LOG.warn("Failed to log in to dispatcher (%s), "
+                         "retrying in %d seconds" % (e, interval))
+            time.sleep(interval)
+            interval = min(interval * 2, CONF.pcs_session_retry_max_interval)
+            attempt += 1
+
+    def _is_healthy(self, srv):
+        try:
+            return bool(srv.is_connected())
+        except sdk.PrlSDKError:
+            return False
+
+    def _recover(self):
+        with self._recover_lock:
+            LOG.warn("Lost dispatcher session, dropping dead sessions")
+            self._idle = [x for x in self._idle if self._is_healthy(x)]
+            primary = None
+            if not self._is_healthy(self.primary):
+                self.primary = primary = self._login()
+        for callback in self._subscribers:
+            callback(primary)
+
+    def check(self):
+        sessions = [self.primary] + self._idle
+        if not all(self._is_healthy(x) for x in sessions):
+            self._recover()
+
+    def checkout(self):
+        self._slots.acquire()
+        try:
+            while self._idle:
+                srv = self._idle.pop()
+                if self._is_healthy(srv):
+                    return srv
+                self._recover()
+            return self._login()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._slots.release()
+
+    def checkin(self, srv, healthy=True):
+        if healthy:
+            self._idle.append(srv)
+        self._slots.release()
+
+    def checkin_failed(self, srv):
+        "Check in session after a failed call and recover, if it's dead."
+        healthy = self._is_healthy(srv)
+        self.checkin(srv, healthy)
+        if not healthy:
+            self._recover()
+
+    @contextlib.contextmanager
+    def session(self):
+        srv = self.checkout()
+        try:
+            yield srv
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.checkin_failed(srv)
+        else:
+            self.checkin(srv)
+
+
+class PooledJob(object):
+    """Job, which keeps the session, it was started in, checked out
+    until it finishes, so long operations have their session to
+    themselves, and errors of wait() are checked for a dead session.
+    """
+
+    def __init__(self, job, pool, srv):
+        self._job = job
+        self._pool = pool
+        self._srv = srv
+
+    def _checkin(self, failed=False):
+        srv, self._srv = self._srv, None
+        if srv is None:
+            return
+        if failed:
+            self._pool.checkin_failed(srv)
+        else:
+            self._pool.checkin(srv)
+
+    def wait(self, *args, **kwargs):
+        try:
+            result = self._job.wait(*args, **kwargs)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._checkin(failed=True)
+        self._checkin()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def __del__(self):
+        # job, which is never waited for
+        self._checkin()
+
+
+class PooledServer(object):
+    """Server-like object, which makes each call in a session from
+    the pool. Returned jobs hold the session until they finish.
+    VE handles stay bound to the session, they were got from.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            srv = self._pool.checkout()
+            try:
+                result = getattr(srv, name)(*args, **kwargs)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._pool.checkin_failed(srv)
+            if isinstance(result, sdk.Job):
+                return PooledJob(result, self._pool, srv)
+            self._pool.checkin(srv)
+            return result
+        return call
+
+
 class Sdk(object):
+    """Proxy for prlsdkapi module, which is imported on the first
+    attribute lookup. Looked up attributes are memoized in the
+    instance, so further lookups don't get to __getattr__.
+    """
 
     def _import_prlsdkapi(self):
         global prlsdkapi
         if not prlsdkapi:
-            prlsdkapi = __import__('prlsdkapi')
+            module = __import__('prlsdkapi')
+            init_execution(module)
+            prlsdkapi = module
         return prlsdkapi
 
     _prlsdkapi = property(_import_prlsdkapi)
 
-    def __getattr__(self, name):
+    def _lookup(self, name):
         return getattr(self._prlsdkapi, name)
 
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = self._lookup(name)
+        setattr(self, name, value)
+        return value
+
 
 class Consts(Sdk):
 
-    def __getattr__(self, name):
+    def _lookup(self, name):
         return getattr(self._prlsdkapi.consts, name)
 
 consts = Consts()
@@ -13,15 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import hashlib
 import os
-import re
 import shutil
 import tempfile
-from xml.dom import minidom
+import time
 
+from eventlet import event
 from oslo.config import cfg
 
+from nova import exception
 from nova.image import glance
+from nova.openstack.common import excutils
 from nova.openstack.common import jsonutils
 from nova.openstack.common import lockutils
 from nova.openstack.common import log as logging
@@ -29,13 +33,57 @@ from nova.openstack.common import processutils
 from nova import utils
 from nova.virt import images
 
+from pcsnovadriver.pcs import cacheindex
+from pcsnovadriver.pcs import imageconv
+from pcsnovadriver.pcs import ploop
 from pcsnovadriver.pcs import prlsdkapi_proxy
 from pcsnovadriver.pcs import utils as pcsutils
+from pcsnovadriver.pcs import veconfig
 
 pc = prlsdkapi_proxy.consts
 
 LOG = logging.getLogger(__name__)
+
+template_opts = [
+    cfg.StrOpt('pcs_image_cache_mode',
+               default='compressed',
+               help='How cached images are stored and deployed: '
+                    '"compressed" - unpack compressed image for every '
+                    'instance, "uncompressed" - keep images unpacked '
+                    'and make reflink or sparse copies of them, '
+                    '"linked" - keep one unpacked read-only '
+                    'base per image and create instance disks as '
+                    'ploop deltas on top of it.'),
+    cfg.BoolOpt('pcs_native_image_conversion',
+                default=False,
+                help='Convert raw and qcow2 images to and from ploop '
+                     'in userspace, without mounting ploop devices and '
+                     'running qemu-img.'),
+    cfg.BoolOpt('pcs_image_cache_sha256',
+                default=False,
+                help='Compute SHA-256 of downloaded images in addition '
+                     'to MD5 and check it against pcs_sha256 image '
+                     'property, if the image has it.'),
+    cfg.StrOpt('pcs_image_cache_codec',
+               default='lzrw',
+               help='Compression of images in the cache: "lzrw" '
+                    '(prlcompress), "zstd" (multi-threaded) or "lz4". '
+                    'Images, cached with another codec, stay usable. '
+                    'Images in cploop format are always cached as they '
+                    'are downloaded, in lzrw.'),
+    cfg.StrOpt('pcs_image_cache_shared_dir',
+               help='Directory on a cluster filesystem (PStorage), '
+                    'mounted at the same path on all compute nodes, to '
+                    'keep the image cache in instead of '
+                    'pcs_template_dir. Nodes fill the cache under file '
+                    'locks on this filesystem, so every image is '
+                    'downloaded once per cluster. Not supported in '
+                    '"uncompressed" mode.'),
+    ]
+
 CONF = cfg.CONF
+CONF.register_opts(template_opts)
+CONF.import_opt('host', 'nova.netconf')
 
 
 def get_template(driver, context, instance, image_meta):
@@ -205,18 +253,15 @@ class DiskTemplate(PCSTemplate):
 
         # add hard disk to VM config and set is as boot device
         srv_cfg = self.driver.psrv.get_srv_config().wait().get_param()
-        sdk_ve.begin_edit().wait()
-
-        hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
-        hdd.set_image_path(disk_path)
-
-        b = sdk_ve.create_boot_dev()
-        b.set_type(pc.PDE_HARD_DISK)
-        b.set_index(hdd.get_index())
-        b.set_sequence_index(0)
-        b.set_in_use(1)
+        with veconfig.edit(sdk_ve):
+            hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
+            hdd.set_image_path(disk_path)
 
-        sdk_ve.commit().wait()
+            b = sdk_ve.create_boot_dev()
+            b.set_type(pc.PDE_HARD_DISK)
+            b.set_index(hdd.get_index())
+            b.set_sequence_index(0)
+            b.set_in_use(1)
 
         return sdk_ve
 
@@ -231,6 +276,10 @@ class DiskTemplate(PCSTemplate):
             return self._create_ct()
 
 
+def get_cache_dir():
+    return CONF.pcs_image_cache_shared_dir or CONF.pcs_template_dir
+
+
 class ImageCache(object):
     """Base class for image cache handlers. There is only one
     operation: put image to the specified destination. If image
@@ -239,6 +288,55 @@ class ImageCache(object):
     def put_image(self, context, image_ref, image_meta, dst):
         raise NotImplementedError()
 
+    def prefetch(self, context, image_ref, image_meta, throttle=None):
+        """Put image to cache without deploying it. Downloads
+        are limited by throttle (pcsutils.Throttle), if given.
+        """
+        raise NotImplementedError()
+
+    def in_use(self, image_id):
+        "Whether cached image is needed by existing disks."
+        return False
+
+    def delete_image(self, image_id):
+        "Remove image from cache. Return True, if it was removed."
+        raise NotImplementedError()
+
+    def mark_used(self, image_id):
+        "Record that instances of this node use the image."
+        pass
+
+    def flush_usage(self):
+        "Save uses of images, recorded since the last call."
+        pass
+
+
+class CacheFill(object):
+    """Caching of an image, shared by all requests of the image in
+    this process. Downloads go through a throttle of the fill, which
+    counts progress of this image only and passes writes to throttle
+    of the request, if any.
+    """
+
+    def __init__(self, image_id, throttle=None):
+        self.image_id = image_id
+        self.throttle = pcsutils.Throttle(parent=throttle)
+        self.started = time.time()
+        self.waiters = 0
+        self.done = event.Event()
+
+    @property
+    def downloaded(self):
+        return self.throttle.transferred
+
+    def wait(self):
+        "Wait for the fill to complete, raises error of the fill."
+        self.waiters += 1
+        try:
+            return self.done.wait()
+        finally:
+            self.waiters -= 1
+
 
 class LZRWImageCache(ImageCache):
     """Class for retrieving from cache of LZRW images.
@@ -271,33 +369,84 @@ class LZRWImageCache(ImageCache):
     Several remove operations can be a problem. We need to check if
     manage_image_cache can be called from several threads
     simultaneously.
+
+    Within a process, requests for an image, which is being cached,
+    don't queue on the file lock, but wait for the CacheFill of the
+    first request. So there is one download per image, and if it
+    fails, all waiting requests fail with the same error.
+
+    Size, origin format, fill and last use times, hit count and
+    checksums of cached images are kept in the cache index, so
+    listing and eviction don't look at the files. The index is
+    synchronized with files on disk once, when the cache is created.
+
+    Cache can be shared by compute nodes, when it's in
+    pcs_image_cache_shared_dir on a cluster filesystem. Lock files
+    are on the same filesystem, and PStorage makes their POSIX locks
+    cluster-wide, so the above works across nodes as it works
+    across processes of one node: one node fills the image, others
+    wait for the lock and then find the file.
     """
 
     def __init__(self):
-        if not os.path.exists(CONF.pcs_template_dir):
-            utils.execute('mkdir', '-p', CONF.pcs_template_dir,
-                          run_as_root=True)
-            utils.execute('chown', 'nova:nova', CONF.pcs_template_dir,
-                          run_as_root=True)
-
-        self.images_dir = os.path.join(CONF.pcs_template_dir, 'images')
-        self.locks_dir = os.path.join(CONF.pcs_template_dir, 'locks')
-        self.tmp_dir = os.path.join(CONF.pcs_template_dir, 'tmp')
-
-        for d in self.images_dir, self.locks_dir, self.tmp_dir:
+        self.path = get_cache_dir()
+        for path in set([self.path, CONF.pcs_template_dir]):
+            if not os.path.exists(path):
+                utils.execute('mkdir', '-p', path, run_as_root=True)
+                utils.execute('chown', 'nova:nova', path, run_as_root=True)
+
+        self.images_dir = os.path.join(self.path, 'images')
+        self.locks_dir = os.path.join(self.path, 'locks')
+        self.tmp_dir = os.path.join(self.path, 'tmp')
+
+        # images are downloaded and converted in local tmp directory
+        local_tmp_dir = os.path.join(CONF.pcs_template_dir, 'tmp')
+        for d in set([self.images_dir, self.locks_dir, self.tmp_dir,
+                      local_tmp_dir]):
             if not os.path.exists(d):
                 os.mkdir(d)
 
-        self.name_suffix = '.tar.lzrw'
-
-    def _get_cached_file(self, image_id):
-        return os.path.join(self.images_dir, image_id + self.name_suffix)
-
-    def _cache_image(self, context, image_ref, image_meta, dst):
-        downloader = get_downloader(image_meta['disk_format'])
+        self.codec = pcsutils.get_codec(CONF.pcs_image_cache_codec).name
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        # image id -> CacheFill of this process
+        self._fills = {}
+        self.index = cacheindex.CacheIndex(
+                    os.path.join(self.path, 'index.json'), self.locks_dir)
+        self._sync_index()
+
+    def _get_codec(self, image_id):
+        "Codec of the cached image file, lzrw if it's not known."
+        entry = self.index.get(image_id) or {}
+        return entry.get('codec') or 'lzrw'
+
+    def _get_cached_file(self, image_id, codec=None):
+        codec = pcsutils.get_codec(codec or self._get_codec(image_id))
+        return os.path.join(self.images_dir, image_id + codec.suffix)
+
+    def _cache_image(self, context, image_ref, image_meta, dst,
+                     throttle=None, unpack_to=None):
+        """Download image to dst file and return fields of its index
+        entry.
+        """
+        downloader = get_downloader(image_meta['disk_format'], throttle,
+                                    self.codec)
         LOG.info('Downloading image %s (%s) from glance' %
                  (image_meta['name'], image_ref))
-        downloader.fetch_to_lzrw(context, image_ref, image_meta, dst)
+        downloader.fetch_to_lzrw(context, image_ref, image_meta, dst,
+                                 unpack_to)
+
+        checksums = downloader.checksums
+        now = time.time()
+        return dict(size=os.stat(dst).st_blocks * 512,
+                    disk_format=image_meta['disk_format'],
+                    cached_at=now,
+                    last_used=now,
+                    hits=0,
+                    codec=downloader.codec,
+                    checksum=checksums['md5'],
+                    sha256=checksums.get('sha256'),
+                    file_md5=downloader.file_md5,
+                    verified_at=now)
 
     def _open(self, path):
         try:
@@ -308,44 +457,495 @@ class LZRWImageCache(ImageCache):
                 raise
             return None
 
-    def _open_cached_file(self, context, image_ref, image_meta, dst):
-        image_id = image_meta['id']
-        fpath = self._get_cached_file(image_id)
+    def _open_cached_file(self, context, image_ref, image_meta, dst,
+                          throttle=None, unpack_to=None):
+        """Open cached image file, caching the image, if needed.
 
-        f = self._open(fpath)
+        If unpack_to is given and this request caches the image, the
+        image is unpacked there from the download stream, while it's
+        written to cache, and None is returned.
+        """
+        image_id = image_meta['id']
+        f = self._open(self._get_cached_file(image_id))
         if f:
+            self._record_hit(image_id)
             return f
 
+        fill = self._fills.get(image_id)
+        if fill is not None:
+            LOG.info("Waiting for image %s being cached" % image_id)
+            fill.wait()
+            f = self._open(self._get_cached_file(image_id))
+            if f:
+                self._record_hit(image_id)
+                return f
+
+        fill = CacheFill(image_id, throttle)
+        self._fills[image_id] = fill
+        try:
+            f = self._fill_cached_file(context, image_ref, image_meta,
+                                       fill.throttle, unpack_to)
+        except Exception as e:
+            with excutils.save_and_reraise_exception():
+                fill.done.send_exception(e)
+        else:
+            fill.done.send(None)
+        finally:
+            del self._fills[image_id]
+        return f
+
+    def _fill_cached_file(self, context, image_ref, image_meta, throttle,
+                          unpack_to):
+        image_id = image_meta['id']
         with lockutils.lock(image_id, external=True, lock_path=self.locks_dir):
-            f = self._open(fpath)
+            f = self._open(self._get_cached_file(image_id))
             if f:
+                self._record_hit(image_id)
                 return f
 
-            tmp = tempfile.mktemp(dir=self.tmp_dir)
-            self._cache_image(context, image_ref, image_meta, tmp)
-            f = open(tmp)
-            os.rename(tmp, fpath)
+            self.stats['misses'] += 1
+            fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+            os.close(fd)
+            try:
+                entry = self._cache_image(context, image_ref, image_meta,
+                                          tmp, throttle, unpack_to)
+                f = None
+                if unpack_to is None:
+                    f = open(tmp)
+                os.rename(tmp, self._get_cached_file(image_id,
+                                                     entry.get('codec')))
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+            # image is listed only once its file is in place
+            self.index.update(image_id, **entry)
             return f
 
+    def get_fills(self):
+        "Return images, being cached now, as {image id: CacheFill}."
+        return dict(self._fills)
+
+    def _scan_images(self):
+        "Return images, cached on disk, as {image id: codec}."
+        images = {}
+        for name in os.listdir(self.images_dir):
+            for codec in pcsutils.CODECS.values():
+                if name.endswith(codec.suffix):
+                    images[name[:-len(codec.suffix)]] = codec.name
+        return images
+
+    def _sync_index(self):
+        """Add images, cached without the index, to it and drop
+        entries of images, which are not on disk.
+        """
+        indexed = set(self.index.list())
+        on_disk = self._scan_images()
+        for image_id in set(on_disk) - indexed:
+            LOG.info("Adding cached image %s to the index" % image_id)
+            self.index.update(image_id, codec=on_disk[image_id])
+            mtimes = [os.stat(x).st_mtime
+                      for x in self._get_paths(image_id)]
+            mtime = max(mtimes or [0])
+            self.index.update(image_id,
+                              size=self._measure_size(image_id),
+                              cached_at=mtime,
+                              last_used=mtime,
+                              hits=0)
+        for image_id in indexed - set(on_disk):
+            # the image may be being cached by another node or process
+            with lockutils.lock(image_id, external=True,
+                                lock_path=self.locks_dir):
+                if self._get_paths(image_id):
+                    continue
+                LOG.info("Cached image %s is missing, removing it from "
+                         "the index" % image_id)
+                self.index.remove(image_id)
+
+    def _record_hit(self, image_id):
+        "Record request, served from cache. Misses create the entry."
+        self.stats['hits'] += 1
+        self.index.touch(image_id)
+
+    def mark_used(self, image_id):
+        # Shared index tells other nodes, that the image is not
+        # unused, though their instances don't need it.
+        self.index.touch(image_id, hit=False)
+
+    def flush_usage(self):
+        self.index.flush()
+
+    def get_last_used(self, image_id):
+        entry = self.index.get(image_id) or {}
+        return entry.get('last_used') or entry.get('cached_at', 0)
+
+    def _get_paths(self, image_id):
+        "Existing files and directories of the cached image."
+        return filter(os.path.exists, [self._get_cached_file(image_id)])
+
+    def get_size(self, image_id):
+        "Disk space, used by cached image, in bytes."
+        entry = self.index.get(image_id) or {}
+        if 'size' in entry:
+            return entry['size']
+        return self._measure_size(image_id)
+
+    def get_stats(self):
+        "Return statistics of this process and of the cached images."
+        stats = dict(self.stats)
+        entries = self.index.get_all().values()
+        stats['images'] = len(entries)
+        stats['size'] = sum([x.get('size', 0) for x in entries])
+        stats['image_hits'] = sum([x.get('hits', 0) for x in entries])
+        return stats
+
+    def _measure_size(self, image_id):
+        size = 0
+        for path in self._get_paths(image_id):
+            if not os.path.isdir(path):
+                size += os.stat(path).st_blocks * 512
+                continue
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    st = os.lstat(os.path.join(root, name))
+                    size += st.st_blocks * 512
+        return size
+
     def put_image(self, context, image_ref, image_meta, dst):
         utils.execute('mkdir', dst, run_as_root=True)
 
-        f = self._open_cached_file(context, image_ref, image_meta, dst)
+        try:
+            f = self._open_cached_file(context, image_ref, image_meta, dst,
+                                       unpack_to=dst)
+        except Exception:
+            # dst may be partially filled while caching
+            with excutils.save_and_reraise_exception():
+                utils.execute('rm', '-rf', dst, run_as_root=True)
+        if f is None:
+            LOG.info("Image %s was unpacked to %s while caching" %
+                     (image_meta['id'], dst))
+            return
         try:
             LOG.info("Unpacking image %s to %s" %
                     (self._get_cached_file(image_meta['id']), dst))
             pcsutils.uncompress_ploop(None, dst, src_file=f,
-                                  root_helper=utils._get_root_helper())
+                                  root_helper=utils._get_root_helper(),
+                                  codec=self._get_codec(image_meta['id']))
         finally:
             f.close()
 
+    def prefetch(self, context, image_ref, image_meta, throttle=None):
+        f = self._open_cached_file(context, image_ref, image_meta, None,
+                                   throttle)
+        f.close()
+
+    def _unpack_to_tmp(self, context, image_ref, image_meta, throttle=None):
+        "Unpack cached image to a new temporary directory."
+        tmp = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            f = self._open_cached_file(context, image_ref, image_meta, None,
+                                       throttle, unpack_to=tmp)
+            if f is None:
+                return tmp
+            LOG.info("Unpacking image %s to %s" %
+                     (self._get_cached_file(image_meta['id']), tmp))
+            pcsutils.uncompress_ploop(None, tmp, src_file=f,
+                                      root_helper=utils._get_root_helper(),
+                                      codec=self._get_codec(image_meta['id']))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                utils.execute('rm', '-rf', tmp, run_as_root=True)
+        return tmp
+
     def list_images(self):
-        files = os.listdir(self.images_dir)
-        images = map(lambda x: x[:-len(self.name_suffix)], files)
-        return images
+        return self.index.list()
 
     def delete_image(self, image_id):
+        try:
+            os.unlink(self._get_cached_file(image_id))
+        except OSError as e:
+            # other node can evict the image at the same time
+            if e.errno != os.errno.ENOENT:
+                raise
+            self.index.remove(image_id)
+            return False
+        self.index.remove(image_id)
+        return True
+
+
+class LinkedCloneImageCache(LZRWImageCache):
+    """Image cache, which creates instance disks as linked clones.
+
+    Every image is unpacked once to bases/<image id>/image and is
+    made read-only. Disk of an instance is a ploop with an empty
+    delta on top of the base images, so spawn doesn't copy image
+    data and instances share the base in page cache.
+
+    Each linked disk has a reference in bases/<image id>/refs/<host>,
+    a file with the path of the disk directory. Reference is stale,
+    when the directory is removed along with the instance. Base is
+    not removed, while it has live references. References are
+    added and checked under the base lock of the image. References
+    of other nodes, sharing the cache, can't be checked, so they
+    are considered live, until their nodes drop them.
+    """
+
+    def __init__(self):
+        self.bases_dir = os.path.join(get_cache_dir(), 'bases')
+        super(LinkedCloneImageCache, self).__init__()
+        if not os.path.exists(self.bases_dir):
+            os.mkdir(self.bases_dir)
+
+    def _base_lock(self, image_id):
+        return lockutils.lock('base-' + image_id, external=True,
+                              lock_path=self.locks_dir)
+
+    def _get_base_dir(self, image_id):
+        return os.path.join(self.bases_dir, image_id)
+
+    def _get_base(self, image_id):
+        return os.path.join(self._get_base_dir(image_id), 'image')
+
+    def _get_refs_dir(self, image_id):
+        return os.path.join(self._get_base_dir(image_id), 'refs')
+
+    def _ensure_base(self, context, image_ref, image_meta, throttle=None):
+        image_id = image_meta['id']
+        base = self._get_base(image_id)
+        if os.path.exists(base):
+            self._record_hit(image_id)
+            return base
+
+        tmp = self._unpack_to_tmp(context, image_ref, image_meta, throttle)
+        try:
+            dd = ploop.get_descriptor(tmp)
+            utils.execute('chmod', 'a-w', *dd.image_files, run_as_root=True)
+            if not os.path.exists(self._get_refs_dir(image_id)):
+                os.makedirs(self._get_refs_dir(image_id))
+            os.rename(tmp, base)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                utils.execute('rm', '-rf', tmp, run_as_root=True)
+
+        # Compressed image is needed only to make the base.
         os.unlink(self._get_cached_file(image_id))
+        self.index.update(image_id, size=self._measure_size(image_id))
+        return base
+
+    def _add_ref(self, image_id, dst):
+        refs_dir = os.path.join(self._get_refs_dir(image_id), CONF.host)
+        if not os.path.exists(refs_dir):
+            os.mkdir(refs_dir)
+        ref = os.path.join(refs_dir, hashlib.md5(dst).hexdigest())
+        with open(ref, 'w') as f:
+            f.write(dst)
+        return ref
+
+    def _check_ref(self, image_id, ref):
+        "Return disk of a local reference or drop it, if it's stale."
+        with open(ref) as f:
+            dst = f.read()
+        if os.path.isdir(dst):
+            return dst
+        LOG.debug("Dropping stale reference of image %s to %s" %
+                  (image_id, dst))
+        os.unlink(ref)
+
+    def _get_live_refs(self, image_id):
+        "Return disks, linked to the base, and drop stale references."
+        refs_dir = self._get_refs_dir(image_id)
+        if not os.path.exists(refs_dir):
+            return []
+        disks = []
+        for name in os.listdir(refs_dir):
+            path = os.path.join(refs_dir, name)
+            if not os.path.isdir(path):
+                # reference, created before they were kept per host
+                refs = [path]
+            elif name == CONF.host:
+                refs = [os.path.join(path, x) for x in os.listdir(path)]
+            else:
+                disks.extend(['%s:%s' % (name, x) for x in os.listdir(path)])
+                continue
+            for ref in refs:
+                dst = self._check_ref(image_id, ref)
+                if dst:
+                    disks.append(dst)
+        return disks
+
+    def _create_delta(self, base, dst):
+        dd = ploop.get_descriptor(base)
+        delta = os.path.join(dst, 'root.hds')
+        utils.execute('ploop', 'init', '-t', 'none',
+                      '-s', '%dK' % (dd.size >> 10),
+                      '-b', str(dd.block_size / ploop.SECTOR_SIZE),
+                      delta, run_as_root=True)
+        data = ploop.link_descriptor(ploop.read_descriptor(base), base,
+                                     ploop.read_descriptor(dst))
+        utils.execute('tee', os.path.join(dst, 'DiskDescriptor.xml'),
+                      process_input=data, run_as_root=True)
+
+    def put_image(self, context, image_ref, image_meta, dst):
+        image_id = image_meta['id']
+        utils.execute('mkdir', dst, run_as_root=True)
+
+        with self._base_lock(image_id):
+            base = self._ensure_base(context, image_ref, image_meta)
+            ref = self._add_ref(image_id, dst)
+
+        LOG.info("Creating linked clone of %s in %s" % (base, dst))
+        try:
+            self._create_delta(base, dst)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                os.unlink(ref)
+
+    def prefetch(self, context, image_ref, image_meta, throttle=None):
+        with self._base_lock(image_meta['id']):
+            self._ensure_base(context, image_ref, image_meta, throttle)
+
+    def _scan_images(self):
+        images = super(LinkedCloneImageCache, self)._scan_images()
+        if os.path.exists(self.bases_dir):
+            for image_id in os.listdir(self.bases_dir):
+                images.setdefault(image_id, None)
+        return images
+
+    def _get_paths(self, image_id):
+        paths = super(LinkedCloneImageCache, self)._get_paths(image_id)
+        if os.path.exists(self._get_base_dir(image_id)):
+            paths.append(self._get_base_dir(image_id))
+        return paths
+
+    def in_use(self, image_id):
+        with self._base_lock(image_id):
+            return bool(self._get_live_refs(image_id))
+
+    def delete_image(self, image_id):
+        with self._base_lock(image_id):
+            disks = self._get_live_refs(image_id)
+            if disks:
+                LOG.info("Image %s is used by %d disks, not removing" %
+                         (image_id, len(disks)))
+                return False
+            if os.path.exists(self._get_cached_file(image_id)):
+                os.unlink(self._get_cached_file(image_id))
+            utils.execute('rm', '-rf', self._get_base_dir(image_id),
+                          run_as_root=True)
+            self.index.remove(image_id)
+            return True
+
+
+class UncompressedImageCache(LZRWImageCache):
+    """Image cache, which keeps images unpacked.
+
+    Image is unpacked once to unpacked/<image id>, and disks of
+    instances are copies of this directory. Copies are reflinks on
+    filesystems, which support them, and sparse copies otherwise,
+    so spawn doesn't spend CPU on decompression.
+
+    Unpacked image is removed by renaming it first, so a copy
+    started after that unpacks the image again. Images, being
+    copied, are not removed.
+    """
+
+    def __init__(self):
+        self.unpacked_dir = os.path.join(get_cache_dir(), 'unpacked')
+        super(UncompressedImageCache, self).__init__()
+        if not os.path.exists(self.unpacked_dir):
+            os.mkdir(self.unpacked_dir)
+        # image id -> number of running copies
+        self._copying = {}
+
+    def _get_unpacked(self, image_id):
+        return os.path.join(self.unpacked_dir, image_id)
+
+    def _ensure_unpacked(self, context, image_ref, image_meta,
+                         throttle=None):
+        image_id = image_meta['id']
+        path = self._get_unpacked(image_id)
+        if os.path.exists(path):
+            self._record_hit(image_id)
+            return path
+
+        with lockutils.lock('unpacked-' + image_id, external=True,
+                            lock_path=self.locks_dir):
+            if os.path.exists(path):
+                self._record_hit(image_id)
+                return path
+            tmp = self._unpack_to_tmp(context, image_ref, image_meta,
+                                      throttle)
+            os.rename(tmp, path)
+            os.unlink(self._get_cached_file(image_id))
+            self.index.update(image_id, size=self._measure_size(image_id))
+        return path
+
+    def put_image(self, context, image_ref, image_meta, dst):
+        image_id = image_meta['id']
+        utils.execute('mkdir', dst, run_as_root=True)
+
+        self._copying[image_id] = self._copying.get(image_id, 0) + 1
+        try:
+            src = self._ensure_unpacked(context, image_ref, image_meta)
+            LOG.info("Copying image %s to %s" % (src, dst))
+            utils.execute('cp', '-a', '--reflink=auto', '--sparse=always',
+                          os.path.join(src, '.'), dst, run_as_root=True)
+        finally:
+            self._copying[image_id] -= 1
+            if not self._copying[image_id]:
+                del self._copying[image_id]
+
+    def prefetch(self, context, image_ref, image_meta, throttle=None):
+        self._ensure_unpacked(context, image_ref, image_meta, throttle)
+
+    def _scan_images(self):
+        images = super(UncompressedImageCache, self)._scan_images()
+        if os.path.exists(self.unpacked_dir):
+            for image_id in os.listdir(self.unpacked_dir):
+                images.setdefault(image_id, None)
+        return images
+
+    def _get_paths(self, image_id):
+        paths = super(UncompressedImageCache, self)._get_paths(image_id)
+        if os.path.exists(self._get_unpacked(image_id)):
+            paths.append(self._get_unpacked(image_id))
+        return paths
+
+    def in_use(self, image_id):
+        return image_id in self._copying
+
+    def delete_image(self, image_id):
+        if image_id in self._copying:
+            return False
+        path = self._get_unpacked(image_id)
+        if os.path.exists(path):
+            # rename into a new empty dir, so that the image
+            # disappears at once
+            tmp = tempfile.mkdtemp(dir=self.tmp_dir)
+            try:
+                os.rename(path, os.path.join(tmp, image_id))
+            finally:
+                utils.execute('rm', '-rf', tmp, run_as_root=True)
+        if os.path.exists(self._get_cached_file(image_id)):
+            os.unlink(self._get_cached_file(image_id))
+        self.index.remove(image_id)
+        return True
+
+
+def get_image_cache():
+    mode = CONF.pcs_image_cache_mode
+    if mode == 'compressed':
+        return LZRWImageCache()
+    elif mode == 'uncompressed':
+        if CONF.pcs_image_cache_shared_dir:
+            # copies, running on other nodes, are not tracked
+            raise Exception("Shared image cache is not supported in "
+                            "uncompressed mode")
+        return UncompressedImageCache()
+    elif mode == 'linked':
+        return LinkedCloneImageCache()
+    else:
+        raise Exception("Unknown image cache mode '%s'" % mode)
 
 
 class ImageDownloader(object):
@@ -353,7 +953,77 @@ class ImageDownloader(object):
     to local image cache with all needed conversions.
     """
 
-    def fetch_to_lzrw(self, context, image_ref, image_meta, dst):
+    def __init__(self, throttle=None, codec='lzrw'):
+        self.throttle = throttle
+        # codec of the cache file, created by fetch_to_lzrw()
+        self.codec = codec
+        # stage name -> (bytes written, seconds)
+        self.metrics = {}
+        self._checksum_writer = None
+        # set by subclasses, which don't cache downloaded data as is
+        self._file_writer = None
+
+    def _wrap_dst(self, f):
+        "Wrap file object, which receives data downloaded from glance."
+        algorithms = ['md5']
+        if CONF.pcs_image_cache_sha256:
+            algorithms.append('sha256')
+        f = self._checksum_writer = pcsutils.ChecksumWriter(f, algorithms)
+        if self.throttle:
+            return pcsutils.ThrottledWriter(f, self.throttle)
+        return f
+
+    @property
+    def checksums(self):
+        "Digests of downloaded data as {algorithm: hex digest}."
+        if self._checksum_writer is None:
+            return {}
+        return self._checksum_writer.hexdigests()
+
+    @property
+    def file_md5(self):
+        "md5 of the cache file, created by fetch_to_lzrw()."
+        if self._file_writer is None:
+            return self.checksums['md5']
+        return self._file_writer.hexdigests()['md5']
+
+    def _verify_checksums(self, image_meta):
+        expected = {'md5': image_meta.get('checksum'),
+                    'sha256': image_meta.get('properties',
+                                             {}).get('pcs_sha256')}
+        if not expected['md5']:
+            LOG.warn("Image %s has no checksum in glance" % image_meta['id'])
+        for algorithm, digest in self.checksums.items():
+            if expected.get(algorithm) and expected[algorithm] != digest:
+                reason = ("%s checksum mismatch: expected %s, got %s" %
+                          (algorithm, expected[algorithm], digest))
+                raise exception.ImageUnacceptable(image_id=image_meta['id'],
+                                                  reason=reason)
+
+    def _open_dst(self, path):
+        "Open file for downloaded data."
+        return self._wrap_dst(open(path, 'w'))
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """Measure a stage of fetching. Caller sets number of bytes,
+        written by the stage, in 'bytes' of the yielded dict.
+        """
+        stats = {'bytes': 0}
+        start = time.time()
+        yield stats
+        self.metrics[name] = (stats['bytes'], time.time() - start)
+
+    def _log_metrics(self, image_meta):
+        for name, (nbytes, elapsed) in sorted(self.metrics.items()):
+            LOG.info("Image %s: %s wrote %d MB in %.2f seconds" %
+                     (image_meta['id'], name, nbytes >> 20, elapsed))
+
+    def fetch_to_lzrw(self, context, image_ref, image_meta, dst,
+                      unpack_to=None):
+        """Download image to dst file in cploop format. If unpack_to is
+        given, also unpack the image to this directory.
+        """
         raise NotImplementedError()
 
 
@@ -363,7 +1033,8 @@ class BasePloopDownloader(ImageDownloader):
                         image_meta, image_service, dst):
         raise NotImplementedError()
 
-    def fetch_to_lzrw(self, context, image_ref, image_meta, dst):
+    def fetch_to_lzrw(self, context, image_ref, image_meta, dst,
+                      unpack_to=None):
         tmpl_dir = os.path.join(CONF.pcs_template_dir,
                                 'tmp', image_meta['id'])
 
@@ -371,53 +1042,49 @@ class BasePloopDownloader(ImageDownloader):
             shutil.rmtree(tmpl_dir)
         os.mkdir(tmpl_dir)
 
-        image_service = glance.get_remote_image_service(context, image_ref)[0]
-        self._download_ploop(context, image_ref, image_meta,
-                             image_service, tmpl_dir)
-        LOG.info("Packing image to %s" % dst)
-        pcsutils.compress_ploop(tmpl_dir, dst)
-        shutil.rmtree(tmpl_dir)
+        try:
+            image_service = glance.get_remote_image_service(context,
+                                                            image_ref)[0]
+            self._download_ploop(context, image_ref, image_meta,
+                                 image_service, tmpl_dir)
+            self._verify_checksums(image_meta)
+            with self._stage('compress') as stats:
+                # md5 of the cache file is computed while packing
+                self._file_writer = pcsutils.ChecksumWriter(open(dst, 'w'))
+                with self._file_writer as f:
+                    if unpack_to is None:
+                        LOG.info("Packing image to %s" % dst)
+                        pcsutils.compress_ploop(tmpl_dir, f, self.codec)
+                    else:
+                        LOG.info("Packing image to %s and copying it "
+                                 "to %s" % (dst, unpack_to))
+                        pcsutils.tee_compress_ploop(tmpl_dir, f, unpack_to,
+                                    root_helper=utils._get_root_helper(),
+                                    codec=self.codec)
+                stats['bytes'] = os.path.getsize(dst)
+        finally:
+            shutil.rmtree(tmpl_dir, ignore_errors=True)
+        self._log_metrics(image_meta)
 
 
 class PloopDownloader(BasePloopDownloader):
     "Dowload images in ploop format."
 
     def _get_image_name(self, disk_descriptor):
-        doc = minidom.parseString(disk_descriptor)
-        disk_image = doc.firstChild
-
-        items = disk_image.getElementsByTagName('StorageData')
-        if len(items) != 1:
-            raise Exception('Invalid DiskDescriptor.xml')
-        storage_data = items[0]
-
-        items = storage_data.getElementsByTagName('Storage')
-        if len(items) != 1:
-            raise Exception('Invalid DiskDescriptor.xml')
-        storage = items[0]
-
-        images = storage.getElementsByTagName('Image')
-        if len(images) != 1:
+        dd = ploop.parse(disk_descriptor)
+        if len(dd.images) != 1:
             raise Exception('Ploop contains spapshots')
-        image = images[0]
-
-        files = image.getElementsByTagName('File')
-        if len(files) != 1:
-            raise Exception('Invalid DiskDescriptor.xml')
-        file = files[0]
-
-        text = file.firstChild
-        if text.nodeType != text.TEXT_NODE:
-            raise Exception('Invalid DiskDescriptor.xml')
-
-        return text.nodeValue
+        return dd.top_image
 
     def _download_ploop(self, context, image_ref,
                         image_meta, image_service, dst):
         dd = image_meta['properties']['pcs_disk_descriptor']
         image_name = self._get_image_name(dd)
-        with open(os.path.join(dst, image_name), 'w') as f:
-            image_service.download(context, image_ref, f)
+        image_path = os.path.join(dst, image_name)
+        with self._stage('download') as stats:
+            with self._open_dst(image_path) as f:
+                image_service.download(context, image_ref, f)
+            stats['bytes'] = os.path.getsize(image_path)
         with open(os.path.join(dst, 'DiskDescriptor.xml'), 'w') as f:
             f.write(image_meta['properties']['pcs_disk_descriptor'])
 
@@ -425,53 +1092,152 @@ class PloopDownloader(BasePloopDownloader):
 class QemuDownloader(BasePloopDownloader):
     """This class downloads images in formats, which
     qemu-img supports.
+
+    Raw images of known size are streamed from glance right to
+    the mounted ploop device. Other formats need random access,
+    so they are downloaded to a file and converted by qemu-img.
+    With pcs_native_image_conversion raw and qcow2 images are
+    converted by imageconv instead, without a ploop device.
     """
-    def _download_ploop(self, context, image_ref,
-                        image_meta, image_service, dst):
+
+    def _init_ploop(self, dst, size):
+        with self._stage('init'):
+            # Filesystem would be overwritten by image data anyway.
+            utils.execute('ploop', 'init', '-t', 'none',
+                          '-s', '%dK' % ((size + 1023) >> 10),
+                          os.path.join(dst, 'root.hds'))
+
+    def _mount(self, dst):
+        return pcsutils.PloopMount(dst, chown=True,
+                                   root_helper=utils._get_root_helper())
+
+    def _stream_raw(self, context, image_ref, image_meta,
+                    image_service, dst):
+        self._init_ploop(dst, int(image_meta['size']))
+        with self._mount(dst) as ploop_dev:
+            LOG.info("Writing image to %s ..." % ploop_dev)
+            with self._stage('download') as stats:
+                with open(ploop_dev, 'w') as f:
+                    writer = pcsutils.SparseWriter(f)
+                    image_service.download(context, image_ref,
+                                           self._wrap_dst(writer))
+                stats['bytes'] = writer.written
+
+    def _convert(self, context, image_ref, image_meta,
+                 image_service, dst):
         glance_img = 'glance.img'
         glance_path = os.path.join(dst, glance_img)
-        with open(glance_path, 'w') as f:
-            image_service.download(context, image_ref, f)
-
-        out, err = utils.execute('qemu-img', 'info',
-                                 '--output=json', glance_path)
-        img_info = jsonutils.loads(out)
-        size = int(img_info['virtual-size'])
-
-        utils.execute('ploop', 'init', '-s',
-                      '%dK' % (size >> 10), os.path.join(dst, 'root.hds'))
-
-        dd_path = os.path.join(dst, 'DiskDescriptor.xml')
-        out, err = utils.execute('ploop', 'mount', dd_path, run_as_root=True)
+        try:
+            with self._stage('download') as stats:
+                with self._open_dst(glance_path) as f:
+                    image_service.download(context, image_ref, f)
+                stats['bytes'] = os.path.getsize(glance_path)
+
+            out, err = utils.execute('qemu-img', 'info',
+                                     '--output=json', glance_path)
+            img_info = jsonutils.loads(out)
+            size = int(img_info['virtual-size'])
+
+            self._init_ploop(dst, size)
+            with self._mount(dst) as ploop_dev:
+                LOG.info("Convert to ploop format ...")
+                with self._stage('convert') as stats:
+                    utils.execute('qemu-img', 'convert', '-O', 'raw',
+                                  glance_path, ploop_dev)
+                    stats['bytes'] = size
+        finally:
+            if os.path.exists(glance_path):
+                os.unlink(glance_path)
+
+    def _stream_native(self, context, image_ref, image_meta,
+                       image_service, dst):
+        size = int(image_meta['size'])
+        with self._stage('download') as stats:
+            with open(os.path.join(dst, 'root.hds'), 'wb') as f:
+                writer = imageconv.PloopWriter(f, size)
+                image_service.download(context, image_ref,
+                        self._wrap_dst(imageconv.StreamWriter(writer)))
+                writer.close()
+            stats['bytes'] = writer.next_block * writer.block_size
+        imageconv.write_descriptor(dst, writer.size)
+
+    def _convert_native(self, context, image_ref, image_meta,
+                        image_service, dst):
+        glance_path = os.path.join(dst, 'glance.img')
+        try:
+            with self._stage('download') as stats:
+                with self._open_dst(glance_path) as f:
+                    image_service.download(context, image_ref, f)
+                stats['bytes'] = os.path.getsize(glance_path)
+            with self._stage('convert') as stats:
+                imageconv.convert_to_ploop(glance_path,
+                                           image_meta['disk_format'], dst)
+                stats['bytes'] = os.path.getsize(os.path.join(dst,
+                                                              'root.hds'))
+        finally:
+            if os.path.exists(glance_path):
+                os.unlink(glance_path)
 
-        ro = re.search('dev=(\S+)', out)
-        if not ro:
-            utils.execute('ploop', 'umount', dd_path, run_as_root=True)
-        ploop_dev = ro.group(1)
+    def _download_ploop(self, context, image_ref,
+                        image_meta, image_service, dst):
+        disk_format = image_meta['disk_format']
+        if (CONF.pcs_native_image_conversion and
+                disk_format in imageconv.FORMATS):
+            if disk_format == 'raw' and image_meta.get('size'):
+                self._stream_native(context, image_ref, image_meta,
+                                    image_service, dst)
+            else:
+                self._convert_native(context, image_ref, image_meta,
+                                     image_service, dst)
+            return
 
         try:
-            LOG.info("Convert to ploop format ...")
-            utils.execute('qemu-img', 'convert', '-O', 'raw',
-                          glance_path, ploop_dev, run_as_root=True)
+            if disk_format == 'raw' and image_meta.get('size'):
+                self._stream_raw(context, image_ref, image_meta,
+                                 image_service, dst)
+            else:
+                self._convert(context, image_ref, image_meta,
+                              image_service, dst)
         finally:
-            utils.execute('ploop', 'umount', dd_path, run_as_root=True)
-            utils.execute('rm', '-f', dd_path + '.lck')
-            os.unlink(glance_path)
+            lock_path = os.path.join(dst, 'DiskDescriptor.xml.lck')
+            utils.execute('rm', '-f', lock_path)
 
 
 class LZRWDownloader(ImageDownloader):
     "Class for images stored in cploop format."
 
-    def fetch_to_lzrw(self, context, image_ref, image_meta, dst):
-        image_service = glance.get_remote_image_service(context, image_ref)[0]
-        with open(dst, 'w') as f:
-            image_service.download(context, image_ref, f)
+    def __init__(self, throttle=None, codec=None):
+        # downloaded data is cached as is
+        super(LZRWDownloader, self).__init__(throttle, 'lzrw')
 
+    def fetch_to_lzrw(self, context, image_ref, image_meta, dst,
+                      unpack_to=None):
+        image_service = glance.get_remote_image_service(context, image_ref)[0]
+        if unpack_to is None:
+            with self._open_dst(dst) as f:
+                image_service.download(context, image_ref, f)
+            self._verify_checksums(image_meta)
+            return
 
-def get_downloader(disk_format):
+        LOG.info("Unpacking image to %s while downloading" % unpack_to)
+        unpacker = pcsutils.PloopUnpacker(unpack_to,
+                                root_helper=utils._get_root_helper())
+        with self._open_dst(dst) as f:
+            stream = unpacker.start()
+            try:
+                image_service.download(context, image_ref,
+                                       pcsutils.TeeWriter([f, stream]))
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    unpacker.kill()
+        unpacker.wait()
+        self._verify_checksums(image_meta)
+
+
+def get_downloader(disk_format, throttle=None, codec='lzrw'):
     if disk_format == 'ploop':
-        return PloopDownloader()
+        return PloopDownloader(throttle, codec)
     elif disk_format == 'cploop':
-        return LZRWDownloader()
+        return LZRWDownloader(throttle)
     else:
-        return QemuDownloader()
+        return QemuDownloader(throttle, codec)
@@ -13,51 +13,189 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import hashlib
 import os
 import re
 import shlex
 import subprocess
+import time
+
+from eventlet import greenthread
 
 from pcsnovadriver.pcs import prlsdkapi_proxy
 
 pc = prlsdkapi_proxy.consts
 
 
-def compress_ploop(src, dst):
-    cmd1 = ['tar', 'cO', '-C', src, '.']
-    cmd2 = ['prlcompress', '-p']
+def strip_uuid(uuid):
+    "SDK returns UUIDs in braces, nova uses them without."
+    return uuid.strip('{}')
+
+
+class LazyDict(collections.Mapping):
+    """Read-only dict, which is built by given function on the
+    first access. Used for tables of SDK constants, so that the
+    SDK isn't imported together with driver modules.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._data = None
+
+    def _get_data(self):
+        if self._data is None:
+            self._data = self._build()
+        return self._data
+
+    def __getitem__(self, key):
+        return self._get_data()[key]
+
+    def __iter__(self):
+        return iter(self._get_data())
+
+    def __len__(self):
+        return len(self._get_data())
+
+
+class Throttle(object):
+    """Limits total rate of writes through ThrottledWriter objects,
+    sharing it. rate is in bytes per second, 0 means no limit.
+    Writes are also passed to parent throttle, if given, so a child
+    counts bytes of its own writers under the limit of the parent.
+    """
+
+    def __init__(self, rate=0, parent=None):
+        self.rate = rate
+        self.parent = parent
+        self.transferred = 0
+        self._start = None
+
+    def consume(self, nbytes):
+        if self._start is None:
+            self._start = time.time()
+        self.transferred += nbytes
+        if self.parent:
+            self.parent.consume(nbytes)
+        if self.rate:
+            delay = (self._start + float(self.transferred) / self.rate -
+                     time.time())
+            if delay > 0:
+                greenthread.sleep(delay)
+
+
+class ThrottledWriter(object):
+    "File object wrapper, which passes writes through a Throttle."
+
+    def __init__(self, f, throttle):
+        self.f = f
+        self.throttle = throttle
+
+    def write(self, data):
+        self.throttle.consume(len(data))
+        self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.f.close()
+
+
+class Codec(object):
+    """Stream compressor of tar archives of ploop images.
 
-    dst_file = open(dst, 'w')
+    Archives, compressed by a codec, have names ending with suffix.
+    """
+
+    def __init__(self, name, suffix, compress_cmd, uncompress_cmd):
+        self.name = name
+        self.suffix = suffix
+        self.compress_cmd = compress_cmd
+        self.uncompress_cmd = uncompress_cmd
+
+
+# lzrw is the format of cploop images and the only codec, understood
+# by other Parallels tools. zstd uses all CPUs for compression and
+# lz4 is the fastest one to decompress.
+CODECS = {
+    'lzrw': Codec('lzrw', '.tar.lzrw',
+                  ['prlcompress', '-p'], ['prlcompress', '-u']),
+    'zstd': Codec('zstd', '.tar.zst',
+                  ['zstd', '-q', '-c', '-3', '-T0'],
+                  ['zstd', '-q', '-c', '-d']),
+    'lz4': Codec('lz4', '.tar.lz4',
+                 ['lz4', '-q', '-c', '-1'], ['lz4', '-q', '-c', '-d']),
+}
+
+
+def get_codec(name):
     try:
-        p1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
-    except Exception:
-        dst_file.close()
+        return CODECS[name]
+    except KeyError:
+        raise Exception("Unknown compression codec '%s'" % name)
 
+
+def _pipe_to(src, dst_file):
+    "Copy data from pipe src to file object dst_file."
+    while True:
+        data = src.read(1 << 20)
+        if not data:
+            break
+        dst_file.write(data)
+
+
+def _start_compress(src, codec, stdout):
+    "Start tar of src directory, piped to the compressor of codec."
+    cmd1 = ['tar', 'cO', '-C', src, '.']
+    cmd2 = get_codec(codec).compress_cmd
+
+    p1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
     try:
-        p2 = subprocess.Popen(cmd2, stdin=p1.stdout, stdout=dst_file)
+        p2 = subprocess.Popen(cmd2, stdin=p1.stdout, stdout=stdout)
     except Exception:
         p1.kill()
         p1.wait()
         raise
-    finally:
-        dst_file.close()
-
     p1.stdout.close()
+    return [(cmd1, p1), (cmd2, p2)]
 
-    ret1 = p1.wait()
-    ret2 = p2.wait()
 
-    msg = ""
-    if ret1:
-        msg = '%r returned %d' % (cmd1, ret1)
-    if ret2:
-        msg += ', %r returned %d' % (cmd2, ret2)
-    if msg:
-        raise Exception(msg)
+def _kill_processes(procs):
+    for cmd, p in procs:
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+
+
+def compress_ploop(src, dst, codec='lzrw'):
+    """Pack ploop in src directory to dst. dst is a path or a file
+    object; data for a file object are passed through python, so
+    it may be a wrapper like ChecksumWriter.
+    """
+    if isinstance(dst, basestring):
+        with open(dst, 'w') as dst_file:
+            procs = _start_compress(src, codec, dst_file)
+        _check_processes(procs)
+        return
+
+    procs = _start_compress(src, codec, subprocess.PIPE)
+    try:
+        _pipe_to(procs[1][1].stdout, dst)
+    except Exception:
+        _kill_processes(procs)
+        raise
+    finally:
+        procs[1][1].stdout.close()
+    _check_processes(procs)
 
 
-def uncompress_ploop(src_path, dst_path, src_file=None, root_helper=""):
-    cmd1 = ['prlcompress', '-u']
+def uncompress_ploop(src_path, dst_path, src_file=None, root_helper="",
+                     codec='lzrw'):
+    cmd1 = get_codec(codec).uncompress_cmd
     cmd2 = shlex.split(root_helper) + ['tar', 'x', '-C', dst_path]
 
     if src_file is None:
@@ -88,6 +226,163 @@ def uncompress_ploop(src_path, dst_path, src_file=None, root_helper=""):
         raise Exception(msg)
 
 
+class ChecksumWriter(object):
+    "File object wrapper, which computes digests of written data."
+
+    def __init__(self, f, algorithms=('md5',)):
+        self.f = f
+        self.digests = dict((x, hashlib.new(x)) for x in algorithms)
+
+    def write(self, data):
+        for digest in self.digests.values():
+            digest.update(data)
+        self.f.write(data)
+
+    def hexdigests(self):
+        return dict((x, d.hexdigest()) for x, d in self.digests.items())
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.f.close()
+
+
+def file_digest(path, algorithm='md5', throttle=None,
+                chunk_size=1 << 20):
+    """Return hex digest of file contents. Reads are limited by
+    throttle, if given.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if throttle:
+                throttle.consume(len(data))
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class TeeWriter(object):
+    "File-like object, which writes data to several files."
+
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+
+class SparseWriter(object):
+    """Writes data to a file or block device, seeking over chunks of
+    zeros instead of writing them. Skipped places of the target must
+    read as zeros, like in a new ploop device.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, data):
+        if data.count('\0') == len(data):
+            self.f.seek(len(data), os.SEEK_CUR)
+            self.skipped += len(data)
+        else:
+            self.f.write(data)
+            self.written += len(data)
+
+
+def _check_processes(procs):
+    "Wait for (cmd, process) pairs and raise, if any of them failed."
+    msgs = []
+    for cmd, p in procs:
+        ret = p.wait()
+        if ret:
+            msgs.append('%r returned %d' % (cmd, ret))
+    if msgs:
+        raise Exception(', '.join(msgs))
+
+
+class PloopUnpacker(object):
+    """Extracts ploop from a tar stream, compressed by codec,
+    if compressed is True, to dst_path. Stream is written to the
+    file object, returned by start().
+    """
+
+    def __init__(self, dst_path, compressed=True, root_helper="",
+                 codec='lzrw'):
+        self.dst_path = dst_path
+        self.compressed = compressed
+        self.root_helper = root_helper
+        self.codec = codec
+        self.procs = []
+
+    def start(self):
+        tar_cmd = shlex.split(self.root_helper) + \
+                    ['tar', 'x', '-C', self.dst_path]
+        if not self.compressed:
+            p = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE)
+            self.procs.append((tar_cmd, p))
+            return p.stdin
+
+        cmd = get_codec(self.codec).uncompress_cmd
+        p1 = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+        self.procs.append((cmd, p1))
+        try:
+            p2 = subprocess.Popen(tar_cmd, stdin=p1.stdout)
+        except Exception:
+            p1.kill()
+            p1.wait()
+            raise
+        self.procs.append((tar_cmd, p2))
+        p1.stdout.close()
+        return p1.stdin
+
+    def kill(self):
+        _kill_processes(self.procs)
+
+    def wait(self):
+        self.procs[0][1].stdin.close()
+        _check_processes(self.procs)
+
+
+def tee_compress_ploop(src, dst, unpack_to, root_helper="", codec='lzrw'):
+    """Pack ploop in src directory to dst, like compress_ploop,
+    and extract the compressed stream to unpack_to directory.
+    """
+    if isinstance(dst, basestring):
+        with open(dst, 'w') as dst_file:
+            return tee_compress_ploop(src, dst_file, unpack_to,
+                                      root_helper, codec)
+
+    unpacker = PloopUnpacker(unpack_to, root_helper=root_helper,
+                             codec=codec)
+    stream = unpacker.start()
+    try:
+        procs = _start_compress(src, codec, subprocess.PIPE)
+    except Exception:
+        unpacker.kill()
+        raise
+    try:
+        _pipe_to(procs[1][1].stdout, TeeWriter([dst, stream]))
+    except Exception:
+        unpacker.kill()
+        _kill_processes(procs)
+        raise
+    finally:
+        procs[1][1].stdout.close()
+    _check_processes(procs)
+    unpacker.wait()
+
+
 def _get_ct_boot_disk(ve):
     "Get first disk in config."
 
@@ -160,12 +455,13 @@ def convert_image(src, dst, disk_format, root_helper=''):
 
 
 class CPloopUploader(object):
-    def __init__(self, hdd_path):
+    def __init__(self, hdd_path, codec='lzrw'):
         self.hdd_path = hdd_path
+        self.codec = codec
 
     def start(self):
         self.cmd1 = ['tar', 'cO', '-C', self.hdd_path, '.']
-        self.cmd2 = ['prlcompress', '-p']
+        self.cmd2 = get_codec(self.codec).compress_cmd
 
         self.p1 = subprocess.Popen(self.cmd1, stdout=subprocess.PIPE)
 
@@ -0,0 +1,96 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+
+class VECache(object):
+    """Cache of SDK VE handles, keyed by name and by UUID.
+
+    Handle for a VE is dropped from the cache as soon as dispatcher
+    reports, that VE's config was changed or VE was registered,
+    unregistered or deleted. Next lookup will fetch a fresh handle.
+    Misses are not cached.
+    """
+
+    def __init__(self, events):
+        self._events = events
+        self._by_name = {}
+        self._by_uuid = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        events.subscribe([pc.PET_DSP_EVT_VM_CONFIG_CHANGED,
+                          pc.PET_DSP_EVT_VM_ADDED,
+                          pc.PET_DSP_EVT_VM_UNREGISTERED,
+                          pc.PET_DSP_EVT_VM_DELETED],
+                         self._on_event)
+
+    def _on_event(self, ve_event):
+        self.invalidate(ve_event.uuid)
+
+    def populate(self, ves):
+        for sdk_ve in ves:
+            self.add(sdk_ve)
+
+    def add(self, sdk_ve):
+        uuid = pcsutils.strip_uuid(sdk_ve.get_uuid())
+        name = sdk_ve.get_name()
+        self.invalidate(uuid, count=False)
+        self._by_uuid[uuid] = sdk_ve
+        self._by_name[name] = sdk_ve
+
+    def invalidate(self, uuid, count=True):
+        sdk_ve = self._by_uuid.pop(uuid, None)
+        if sdk_ve is None:
+            return
+        if count:
+            self.invalidations += 1
+        name = sdk_ve.get_name()
+        if self._by_name.get(name) is sdk_ve:
+            del self._by_name[name]
+
+    def clear(self):
+        self._by_name.clear()
+        self._by_uuid.clear()
+
+    def _lookup(self, table, key):
+        self._events.dispatch_pending()
+        sdk_ve = table.get(key)
+        if sdk_ve is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return sdk_ve
+
+    def get_by_name(self, name):
+        return self._lookup(self._by_name, name)
+
+    def get_by_uuid(self, uuid):
+        return self._lookup(self._by_uuid, pcsutils.strip_uuid(uuid))
+
+    def get_stats(self):
+        return {'size': len(self._by_uuid),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations}
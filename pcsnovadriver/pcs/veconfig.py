@@ -0,0 +1,105 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Open transactions, keyed by id() of SDK VE handle. Handle is
+# referenced by the transaction, so its id can't be reused while
+# transaction is open.
+_transactions = {}
+
+
+class ConfigTransaction(object):
+    """Collects configuration changes of a VE into one edit session.
+
+    Every begin_edit()/commit() pair is a synchronous write of the
+    whole VE config by dispatcher, so code, which changes a VE in
+    several steps, should do it in one transaction:
+
+    with veconfig.ConfigTransaction(sdk_ve):
+        driver._apply_flavor(instance, sdk_ve)
+        vif_driver.setup_dev(driver, instance, sdk_ve, vif)
+
+    Helpers make their changes within veconfig.edit(sdk_ve), which
+    joins the open transaction for the handle, if any. Edit session
+    is started by the first joined helper and committed, when the
+    transaction is closed. If transaction is closed with an error,
+    the changes are dropped. Bookkeeping, which must reflect the
+    committed config, is deferred with veconfig.after_commit().
+    """
+
+    def __init__(self, sdk_ve):
+        self.sdk_ve = sdk_ve
+        self.edits = 0
+        self.callbacks = []
+
+    def __enter__(self):
+        key = id(self.sdk_ve)
+        if key in _transactions:
+            raise Exception("VE %s already has an open transaction" %
+                            self.sdk_ve.get_name())
+        _transactions[key] = self
+        return self
+
+    def join(self):
+        if not self.edits:
+            self.sdk_ve.begin_edit().wait()
+        self.edits += 1
+
+    def __exit__(self, type, value, traceback):
+        del _transactions[id(self.sdk_ve)]
+        if not self.edits:
+            return
+        if type is None:
+            LOG.debug("Committing %d edits of VE %s" %
+                      (self.edits, self.sdk_ve.get_name()))
+            self.sdk_ve.commit().wait()
+            for func, args in self.callbacks:
+                func(*args)
+        else:
+            self.sdk_ve.refresh_config()
+
+
+@contextlib.contextmanager
+def edit(sdk_ve):
+    """Context manager for changing VE config, which joins the open
+    transaction for the VE or makes a separate edit session.
+    """
+    txn = _transactions.get(id(sdk_ve))
+    if txn is not None:
+        txn.join()
+        yield sdk_ve
+        return
+
+    sdk_ve.begin_edit().wait()
+    yield sdk_ve
+    sdk_ve.commit().wait()
+
+
+def after_commit(sdk_ve, func, *args):
+    """Call func(*args), when changes made within edit(sdk_ve) are
+    committed: at the end of the open transaction for the VE, or
+    right away, if there is none. It's not called, if the changes
+    are dropped.
+    """
+    txn = _transactions.get(id(sdk_ve))
+    if txn is not None:
+        txn.callbacks.append((func, args))
+    else:
+        func(*args)
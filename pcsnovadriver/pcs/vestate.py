@@ -0,0 +1,114 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo.config import cfg
+
+from nova import exception
+from nova.openstack.common.gettextutils import _
+from nova.openstack.common import log as logging
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import utils as pcsutils
+
+pc = prlsdkapi_proxy.consts
+
+LOG = logging.getLogger(__name__)
+
+vestate_opts = [
+    cfg.IntOpt('pcs_state_wait_timeout',
+                default=600,
+                help='Number of seconds to wait for a VE to leave '
+                     'an intermediate state.'),
+    cfg.IntOpt('pcs_state_poll_interval',
+                default=5,
+                help='Number of seconds to wait for a state change event '
+                     'before querying VE state from dispatcher.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vestate_opts)
+
+
+class StateWatcher(object):
+    """Tracks VE states from dispatcher's state change events.
+
+    Waiters block on a condition, which is notified on each
+    state change event, instead of polling dispatcher. VE state
+    is still queried every pcs_state_poll_interval seconds in case
+    an event was lost.
+    """
+
+    def __init__(self, events):
+        self._events = events
+        self._states = {}
+        self._cond = threading.Condition()
+
+        events.subscribe([pc.PET_DSP_EVT_VM_STATE_CHANGED],
+                         self._on_state_changed)
+        events.subscribe([pc.PET_DSP_EVT_VM_UNREGISTERED,
+                          pc.PET_DSP_EVT_VM_DELETED],
+                         self._on_removed)
+
+    def _on_state_changed(self, ve_event):
+        with self._cond:
+            self._states[ve_event.uuid] = ve_event.state
+            self._cond.notify_all()
+
+    def _on_removed(self, ve_event):
+        with self._cond:
+            self._states.pop(ve_event.uuid, None)
+
+    def wait(self, sdk_ve, get_state, predicate, state_names):
+        """Wait until predicate(state) becomes true for VE state
+        and return that state.
+
+        :param get_state: function to query VE state from dispatcher
+        :param state_names: map of VE states to names for logging
+        """
+        uuid = pcsutils.strip_uuid(sdk_ve.get_uuid())
+        deadline = time.time() + CONF.pcs_state_wait_timeout
+
+        state = get_state(sdk_ve)
+        with self._cond:
+            self._states[uuid] = state
+        next_poll = time.time() + CONF.pcs_state_poll_interval
+
+        while not predicate(state):
+            now = time.time()
+            if now >= deadline:
+                msg = (_('VE "%(name)s" is still in %(state)s state '
+                         'after %(timeout)d seconds') %
+                       {'name': sdk_ve.get_name(),
+                        'state': state_names[state],
+                        'timeout': CONF.pcs_state_wait_timeout})
+                raise exception.NovaException(msg)
+
+            if now >= next_poll:
+                state = get_state(sdk_ve)
+                next_poll = now + CONF.pcs_state_poll_interval
+                continue
+
+            LOG.info('VE "%s" is in %s state, waiting' %
+                     (sdk_ve.get_name(), state_names[state]))
+            self._events.dispatch_pending()
+            with self._cond:
+                state = self._states.get(uuid, state)
+                if not predicate(state):
+                    self._cond.wait(min(next_poll, deadline) - now)
+                    state = self._states.get(uuid, state)
+        return state
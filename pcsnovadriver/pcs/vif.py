@@ -26,6 +26,7 @@ from nova.openstack.common import log as logging
 from nova import utils
 
 from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import veconfig
 
 pc = prlsdkapi_proxy.consts
 
@@ -81,6 +82,21 @@ class PCSVIFDriver(object):
             raise exception.NovaException(
                 _("Unexpected vif_type=%s") % vif['type'])
 
+    def prepare(self, driver, instance, vif):
+        """This method is called during spawn concurrently with
+        VE creation and should do host-side work, that doesn't
+        need the VE.
+        """
+        LOG.info("vif.prepare: %s:%s" % (instance['name'], vif['devname']))
+        vif_class = self._get_vif_class(instance, vif)
+        vif_class.prepare(driver, instance, vif)
+
+    def cleanup(self, driver, instance, vif):
+        """Undo prepare, when spawn fails."""
+        LOG.info("vif.cleanup: %s:%s" % (instance['name'], vif['devname']))
+        vif_class = self._get_vif_class(instance, vif)
+        vif_class.cleanup(driver, instance, vif)
+
     def setup_dev(self, driver, instance, sdk_ve, vif):
         """This method is called before VE start and should
         do all work, that can't be done on running VE.
@@ -114,6 +130,12 @@ class BaseVif:
     def get_bridge_name(self, vif):
             return vif['network']['bridge']
 
+    def prepare(self, driver, instance, vif):
+        pass
+
+    def cleanup(self, driver, instance, vif):
+        pass
+
     def get_prl_name(self, sdk_ve, netdev):
         if sdk_ve.get_vm_type() == pc.PVT_VM:
             return "vme%08x.%d" % (sdk_ve.get_env_id(), netdev.get_index())
@@ -142,14 +164,13 @@ class BaseVif:
         do it by ourselves.
         """
         srv_config = driver.psrv.get_srv_config().wait()[0]
-        sdk_ve.begin_edit().wait()
-        netdev = sdk_ve.add_default_device_ex(srv_config,
-                                pc.PDE_GENERIC_NETWORK_ADAPTER)
-        mac = netaddr.EUI(vif['address'])
-        mac.dialect = netaddr.mac_bare
-        netdev.set_mac_address(str(mac))
-        netdev.set_virtual_network_id('_fake_unexistent')
-        sdk_ve.commit().wait()
+        with veconfig.edit(sdk_ve):
+            netdev = sdk_ve.add_default_device_ex(srv_config,
+                                    pc.PDE_GENERIC_NETWORK_ADAPTER)
+            mac = netaddr.EUI(vif['address'])
+            mac.dialect = netaddr.mac_bare
+            netdev.set_mac_address(str(mac))
+            netdev.set_virtual_network_id('_fake_unexistent')
         return netdev
 
     def setup_prl_dev(self, driver, sdk_ve, vif):
@@ -172,40 +193,62 @@ class BaseVif:
     def configure_ip(self, sdk_ve, netdev, vif):
         """Configure IP parameters inside VE
         """
-        sdk_ve.begin_edit().wait()
-        if CONF.pcs_use_dhcp:
-            netdev.set_configure_with_dhcp(1)
-        else:
-            if len(vif['network']['subnets']) != 1:
-                raise NotImplementedError(
-                        "Only one subnet per vif is supported.")
-            subnet = vif['network']['subnets'][0]
-
-            # Disable DHCP
-            netdev.set_configure_with_dhcp(1)
-
-            # Setup IP addresses
-            iplist = prlsdkapi_proxy.sdk.StringList()
-            for ip in subnet['ips']:
-                cidr = netaddr.IPNetwork(subnet['cidr'])
-                if ip['type'] != 'fixed':
-                    raise NotImplementedError("Only fixed IPs are supported.")
-                iplist.add_item("%s/%s" % (ip['address'], cidr.prefixlen))
-            netdev.set_net_addresses(iplist)
-
-            # Setup gateway
-            if subnet['gateway']:
-                gw = subnet['gateway']
-                if gw['type'] != 'gateway':
+        with veconfig.edit(sdk_ve):
+            if CONF.pcs_use_dhcp:
+                netdev.set_configure_with_dhcp(1)
+            else:
+                if len(vif['network']['subnets']) != 1:
                     raise NotImplementedError(
-                            "Only 'gateway' type gateways are supported.")
-                netdev.set_default_gateway(gw['address'])
-        netdev.set_auto_apply(1)
-        sdk_ve.commit().wait()
+                            "Only one subnet per vif is supported.")
+                subnet = vif['network']['subnets'][0]
+
+                # Disable DHCP
+                netdev.set_configure_with_dhcp(1)
+
+                # Setup IP addresses
+                iplist = prlsdkapi_proxy.sdk.StringList()
+                for ip in subnet['ips']:
+                    cidr = netaddr.IPNetwork(subnet['cidr'])
+                    if ip['type'] != 'fixed':
+                        raise NotImplementedError(
+                                "Only fixed IPs are supported.")
+                    iplist.add_item("%s/%s" % (ip['address'], cidr.prefixlen))
+                netdev.set_net_addresses(iplist)
+
+                # Setup gateway
+                if subnet['gateway']:
+                    gw = subnet['gateway']
+                    if gw['type'] != 'gateway':
+                        raise NotImplementedError(
+                                "Only 'gateway' type gateways are supported.")
+                    netdev.set_default_gateway(gw['address'])
+            netdev.set_auto_apply(1)
 
 
 class VifOvsHybrid(BaseVif):
 
+    def _ensure_bridge(self, driver, br_name):
+        with driver.locks.resource('bridge', br_name):
+            if not linux_net.device_exists(br_name):
+                utils.execute('brctl', 'addbr', br_name, run_as_root=True)
+                utils.execute('brctl', 'setfd', br_name, 0,
+                              run_as_root=True)
+                utils.execute('brctl', 'stp', br_name, 'off',
+                              run_as_root=True)
+
+    def _remove_bridge(self, driver, br_name):
+        with driver.locks.resource('bridge', br_name):
+            if linux_net.device_exists(br_name):
+                utils.execute('ip', 'link', 'set', br_name, 'down',
+                              run_as_root=True)
+                utils.execute('brctl', 'delbr', br_name, run_as_root=True)
+
+    def prepare(self, driver, instance, vif):
+        self._ensure_bridge(driver, self.get_br_name(vif['id']))
+
+    def cleanup(self, driver, instance, vif):
+        self._remove_bridge(driver, self.get_br_name(vif['id']))
+
     def setup_dev(self, driver, instance, sdk_ve, vif):
         netdev = self.create_prl_dev(driver, sdk_ve, vif)
 
@@ -215,10 +258,7 @@ class VifOvsHybrid(BaseVif):
         br_name = self.get_br_name(vif['id'])
         v1_name, v2_name = self.get_veth_pair_names(vif['id'])
 
-        if not linux_net.device_exists(br_name):
-            utils.execute('brctl', 'addbr', br_name, run_as_root=True)
-            utils.execute('brctl', 'setfd', br_name, 0, run_as_root=True)
-            utils.execute('brctl', 'stp', br_name, 'off', run_as_root=True)
+        self._ensure_bridge(driver, br_name)
 
         netdev = self.setup_prl_dev(driver, sdk_ve, vif)
         prl_name = self.get_prl_name(sdk_ve, netdev)
@@ -255,8 +295,7 @@ class VifOvsHybrid(BaseVif):
         prl_name = self.get_prl_name(sdk_ve, netdev)
 
         linux_net.delete_ovs_vif_port(self.get_bridge_name(vif), v2_name)
-        utils.execute('ip', 'link', 'set', br_name, 'down', run_as_root=True)
-        utils.execute('brctl', 'delbr', br_name, run_as_root=True)
+        self._remove_bridge(driver, br_name)
 
 
 class VifOvsEthernet(BaseVif):
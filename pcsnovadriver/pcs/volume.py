@@ -26,6 +26,7 @@ from nova.openstack.common import processutils
 from nova import utils
 
 from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import veconfig
 
 pc = prlsdkapi_proxy.consts
 
@@ -59,67 +60,92 @@ class PCSBaseVolumeDriver(object):
         #TODO(dguryanov): handle RW mode
         #TODO(dguryanov): handle device name inside VE
         srv_cfg = self.driver.psrv.get_srv_config().wait().get_param()
-        sdk_ve.begin_edit().wait()
-        hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
-        hdd.set_emulated_type(pc.PDT_USE_REAL_HDD)
-        hdd.set_friendly_name(guest_device)
-        hdd.set_sys_name(host_device)
-        sdk_ve.commit().wait()
+        with veconfig.edit(sdk_ve):
+            hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
+            hdd.set_emulated_type(pc.PDT_USE_REAL_HDD)
+            hdd.set_friendly_name(guest_device)
+            hdd.set_sys_name(host_device)
+        veconfig.after_commit(sdk_ve, self.driver.blockdevs.add,
+                              host_device, sdk_ve, hdd)
         return hdd
 
     def _detach_blockdev(self, sdk_ve, host_device,
                          guest_device, ignore_errors):
-        sdk_ve.begin_edit().wait()
-        n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
-        for i in xrange(n):
-            dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
-            if dev.get_emulated_type() != pc.PDT_USE_REAL_HDD:
-                continue
-            if self.driver.get_disk_dev_path(dev) == host_device:
-                LOG.info("Removing device %s" % dev.get_friendly_name())
-                dev.remove()
-                break
-        else:
-            msg = "Can't find device %s" % guest_device
-            if ignore_errors:
-                LOG.error(msg)
+        index = self.driver.blockdevs.find(host_device, sdk_ve)
+
+        def match(dev):
+            if index is not None:
+                return dev.get_index() == index
+            return self.driver.get_disk_dev_path(dev) == host_device
+
+        with veconfig.edit(sdk_ve):
+            n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
+            for i in xrange(n):
+                dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
+                if dev.get_emulated_type() != pc.PDT_USE_REAL_HDD:
+                    continue
+                if match(dev):
+                    LOG.info("Removing device %s" % dev.get_friendly_name())
+                    dev.remove()
+                    break
             else:
-                raise Exception(msg)
-        sdk_ve.commit().wait()
+                msg = "Can't find device %s" % guest_device
+                if ignore_errors:
+                    LOG.error(msg)
+                else:
+                    raise Exception(msg)
+        veconfig.after_commit(sdk_ve, self.driver.blockdevs.remove,
+                              host_device)
 
     def _attach_image(self, sdk_ve, image):
         #TODO(dguryanov): handle QOS specifications
         #TODO(dguryanov): handle RW mode
         #TODO(dguryanov): handle device name inside VE
         srv_cfg = self.driver.psrv.get_srv_config().wait().get_param()
-        sdk_ve.begin_edit().wait()
-        hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
-        hdd.set_emulated_type(pc.PDT_USE_IMAGE_FILE)
-        hdd.set_image_path(image)
-        sdk_ve.commit().wait()
+        with veconfig.edit(sdk_ve):
+            hdd = sdk_ve.add_default_device_ex(srv_cfg, pc.PDE_HARD_DISK)
+            hdd.set_emulated_type(pc.PDT_USE_IMAGE_FILE)
+            hdd.set_image_path(image)
         return hdd
 
     def _detach_image(self, sdk_ve, image, ignore_errors):
-        sdk_ve.begin_edit().wait()
-        n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
-        for i in xrange(n):
-            dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
-            if dev.get_emulated_type() != pc.PDT_USE_IMAGE_FILE:
-                continue
-            if dev.get_image_path() == image:
-                LOG.info("Removing device %s" % dev.get_friendly_name())
-                dev.remove()
-                break
-        else:
-            msg = "Can't find device with image %s" % image
-            if ignore_errors:
-                LOG.error(msg)
+        with veconfig.edit(sdk_ve):
+            n = sdk_ve.get_devs_count_by_type(pc.PDE_HARD_DISK)
+            for i in xrange(n):
+                dev = sdk_ve.get_dev_by_type(pc.PDE_HARD_DISK, i)
+                if dev.get_emulated_type() != pc.PDT_USE_IMAGE_FILE:
+                    continue
+                if dev.get_image_path() == image:
+                    LOG.info("Removing device %s" % dev.get_friendly_name())
+                    dev.remove()
+                    break
             else:
-                raise Exception(msg)
-        sdk_ve.commit().wait()
+                msg = "Can't find device with image %s" % image
+                if ignore_errors:
+                    LOG.error(msg)
+                else:
+                    raise Exception(msg)
+
+    def connect_host(self, connection_info, disk_info):
+        """Make volume available on the host and return path to
+        the block device or image. VE is not needed here, so spawn
+        runs this concurrently with VE creation.
+        """
+        raise NotImplementedError()
+
+    def disconnect_host(self, connection_info, disk_info):
+        """Undo connect_host for a volume, which hasn't been added
+        to a VE, when spawn fails.
+        """
+        pass
+
+    def attach_to_ve(self, connection_info, sdk_ve, path, disk_info):
+        """Add a disk, connected by connect_host, to VE config."""
+        return self._attach_blockdev(sdk_ve, path, disk_info['dev'])
 
     def connect_volume(self, connection_info, sdk_ve, disk_info):
-        raise NotImplementedError()
+        path = self.connect_host(connection_info, disk_info)
+        return self.attach_to_ve(connection_info, sdk_ve, path, disk_info)
 
     def disconnect_volume(self, connection_info, sdk_ve, disk_info):
         raise NotImplementedError()
@@ -127,10 +153,8 @@ class PCSBaseVolumeDriver(object):
 
 class PCSLocalVolumeDriver(PCSBaseVolumeDriver):
 
-    def connect_volume(self, connection_info, sdk_ve, disk_info):
-        data = connection_info['data']
-        return self._attach_blockdev(sdk_ve,
-                data['device_path'], disk_info['dev'])
+    def connect_host(self, connection_info, disk_info):
+        return connection_info['data']['device_path']
 
     def disconnect_volume(self, connection_info, sdk_ve,
                           disk_info, ignore_errors):
@@ -161,39 +185,51 @@ class PCSISCSIVolumeDriver(PCSBaseVolumeDriver):
     def _get_target_portals_from_iscsiadm_output(self, output):
         return [line.split()[0] for line in output.splitlines()]
 
-    @utils.synchronized('connect_volume')
-    def connect_volume(self, connection_info, sdk_ve, disk_info):
-        """Attach the volume to instance_name."""
+    def _target_lock(self, iscsi_properties):
+        return self.driver.locks.resource('iscsi',
+                                          iscsi_properties['target_iqn'])
+
+    def _iscsiadm_lock(self):
+        """Host-wide lock for iscsiadm and multipath calls: sessions,
+        node records and multipath maps are shared by all targets.
+        Waits for device nodes are done without it.
+        """
+        return self.driver.locks.lock('connect_volume')
+
+    def connect_host(self, connection_info, disk_info):
+        """Login to the target and return path to the volume."""
+        with self._target_lock(connection_info['data']):
+            return self._connect_host(connection_info, disk_info)
+
+    def _connect_host(self, connection_info, disk_info):
         iscsi_properties = connection_info['data']
 
         pcs_iscsi_use_multipath = CONF.pcs_iscsi_use_multipath
 
-        if pcs_iscsi_use_multipath:
-            #multipath installed, discovering other targets if available
-            #multipath should be configured on the nova-compute node,
-            #in order to fit storage vendor
-            out = self._run_iscsiadm_bare(['-m',
+        with self._iscsiadm_lock():
+            if pcs_iscsi_use_multipath:
+                #multipath installed, discovering other targets if available
+                #multipath should be configured on the nova-compute node,
+                #in order to fit storage vendor
+                out = self._run_iscsiadm_bare(['-m',
                                           'discovery',
                                           '-t',
                                           'sendtargets',
                                           '-p',
                                           iscsi_properties['target_portal']],
                                           check_exit_code=[0, 255])[0] \
-                or ""
+                    or ""
 
-            for ip in self._get_target_portals_from_iscsiadm_output(out):
-                props = iscsi_properties.copy()
-                props['target_portal'] = ip
-                self._connect_to_iscsi_portal(props)
+                for ip in self._get_target_portals_from_iscsiadm_output(out):
+                    props = iscsi_properties.copy()
+                    props['target_portal'] = ip
+                    self._connect_to_iscsi_portal(props)
 
-            self._rescan_iscsi()
-        else:
-            self._connect_to_iscsi_portal(iscsi_properties)
+                self._rescan_iscsi()
+            else:
+                self._connect_to_iscsi_portal(iscsi_properties)
 
-        host_device = ("/dev/disk/by-path/ip-%s-iscsi-%s-lun-%s" %
-                       (iscsi_properties['target_portal'],
-                        iscsi_properties['target_iqn'],
-                        iscsi_properties.get('target_lun', 0)))
+        host_device = self._get_host_device(iscsi_properties)
 
         # The /dev/disk/by-path/... node is not always present immediately
         # TODO(justinsb): This retry-with-delay is a pattern, move to utils?
@@ -210,7 +246,8 @@ class PCSISCSIVolumeDriver(PCSBaseVolumeDriver):
                       'tries': tries})
 
             # The rescan isn't documented as being necessary(?), but it helps
-            self._run_iscsiadm(iscsi_properties, ("--rescan",))
+            with self._iscsiadm_lock():
+                self._run_iscsiadm(iscsi_properties, ("--rescan",))
 
             tries = tries + 1
             if not os.path.exists(host_device):
@@ -224,30 +261,59 @@ class PCSISCSIVolumeDriver(PCSBaseVolumeDriver):
 
         if pcs_iscsi_use_multipath:
             #we use the multipath device instead of the single path device
-            self._rescan_multipath()
-            multipath_device = self._get_multipath_device_name(host_device)
+            with self._iscsiadm_lock():
+                self._rescan_multipath()
+                multipath_device = self._get_multipath_device_name(
+                                                            host_device)
             if multipath_device is not None:
                 host_device = multipath_device
 
-        return self._attach_blockdev(sdk_ve, host_device, disk_info['dev'])
+        return host_device
+
+    def disconnect_host(self, connection_info, disk_info):
+        """Logout from the target, unless it has other volumes
+        in use.
+        """
+        iscsi_properties = connection_info['data']
+        multipath_device = None
+        with self._target_lock(iscsi_properties):
+            with self._iscsiadm_lock():
+                if CONF.pcs_iscsi_use_multipath:
+                    multipath_device = self._get_multipath_device_name(
+                                    self._get_host_device(iscsi_properties))
+                self._disconnect_target(iscsi_properties, multipath_device)
 
-    @utils.synchronized('connect_volume')
     def disconnect_volume(self, connection_info, sdk_ve,
                           disk_info, ignore_errors):
         """Detach the volume from instance_name."""
+        with self._target_lock(connection_info['data']):
+            self._disconnect_volume(connection_info, sdk_ve,
+                                    disk_info, ignore_errors)
+
+    def _get_host_device(self, iscsi_properties):
+        return ("/dev/disk/by-path/ip-%s-iscsi-%s-lun-%s" %
+                (iscsi_properties['target_portal'],
+                 iscsi_properties['target_iqn'],
+                 iscsi_properties.get('target_lun', 0)))
+
+    def _disconnect_volume(self, connection_info, sdk_ve,
+                           disk_info, ignore_errors):
         iscsi_properties = connection_info['data']
         multipath_device = None
-        host_device = ("/dev/disk/by-path/ip-%s-iscsi-%s-lun-%s" %
-                       (iscsi_properties['target_portal'],
-                        iscsi_properties['target_iqn'],
-                        iscsi_properties.get('target_lun', 0)))
+        host_device = self._get_host_device(iscsi_properties)
 
         if CONF.pcs_iscsi_use_multipath:
-            multipath_device = self._get_multipath_device_name(host_device)
+            with self._iscsiadm_lock():
+                multipath_device = self._get_multipath_device_name(
+                                                            host_device)
 
         self._detach_blockdev(sdk_ve, host_device,
                               disk_info['dev'], ignore_errors)
 
+        with self._iscsiadm_lock():
+            self._disconnect_target(iscsi_properties, multipath_device)
+
+    def _disconnect_target(self, iscsi_properties, multipath_device):
         if CONF.pcs_iscsi_use_multipath and multipath_device:
             return self._disconnect_volume_multipath_iscsi(iscsi_properties)
 
@@ -481,12 +547,15 @@ class PCSPStorageVolumeDriver(PCSBaseVolumeDriver):
         if mounts[mp] != dev:
             raise Exception("%s already mounted to %s" % (mounts[mp], mp))
 
-    def connect_volume(self, connection_info, sdk_ve, disk_info):
+    def connect_host(self, connection_info, disk_info):
         data = connection_info['data']
-        self._ensure_mounted(data)
+        with self.driver.locks.resource('pstorage', data['cluster_name']):
+            self._ensure_mounted(data)
         mp = self._get_mount_point(data)
-        return self._attach_image(sdk_ve,
-                os.path.join(mp, data['volume_name']))
+        return os.path.join(mp, data['volume_name'])
+
+    def attach_to_ve(self, connection_info, sdk_ve, path, disk_info):
+        return self._attach_image(sdk_ve, path)
 
     def disconnect_volume(self, connection_info, sdk_ve,
                           disk_info, ignore_errors):
@@ -66,6 +66,13 @@ class Consts:
 
     PDT_USE_REAL_HDD = 0x0002
 
+    PET_DSP_EVT_VM_STATE_CHANGED = 0x0001
+    PET_DSP_EVT_VM_CONFIG_CHANGED = 0x0002
+    PET_DSP_EVT_VM_ADDED = 0x0003
+    PET_DSP_EVT_VM_UNREGISTERED = 0x0004
+    PET_DSP_EVT_VM_DELETED = 0x0005
+    PET_DSP_EVT_VM_PERFSTATS = 0x0006
+
 consts = Consts()
 
 
@@ -89,8 +96,27 @@ def conv_error(err):
     return err * 3 + 0x1000000
 
 
+class Dispatcher(object):
+    "State of the fake dispatcher, shared by all sessions."
+
+    def __init__(self):
+        self.vms = []
+        self.sessions = []
+        self.host_info = {}
+
+    def test_restart(self):
+        "Drop all sessions, as dispatcher restart does."
+        for srv in self.sessions:
+            srv.connected = False
+        self.sessions = []
+
+
+dispatcher = Dispatcher()
+
+
 def init_server_sdk():
-    pass
+    global dispatcher
+    dispatcher = Dispatcher()
 
 
 class PrlSDKError(Exception):
@@ -126,6 +152,46 @@ class Job(object):
         return Result(self.objects)
 
 
+class EventParam(object):
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def get_name(self):
+        return self.name
+
+    def to_int32(self):
+        return self.value
+
+    def to_uint64(self):
+        return self.value
+
+
+class Event(object):
+
+    def __init__(self, event_type, issuer_id, params={}):
+        self.event_type = event_type
+        self.issuer_id = issuer_id
+        self.params = params
+
+    def get_event_type(self):
+        return self.event_type
+
+    def get_issuer_id(self):
+        return self.issuer_id
+
+    def get_params_count(self):
+        return len(self.params)
+
+    def get_param(self, i):
+        name = sorted(self.params)[i]
+        return EventParam(name, self.params[name])
+
+    def get_param_by_name(self, name):
+        return EventParam(name, self.params[name])
+
+
 class VmInfo(object):
 
     def __init__(self, props):
@@ -143,6 +209,9 @@ class ServerConfig(object):
     def get_cpu_count(self):
         return self.props['cpu_count']
 
+    def get_cpu_model(self):
+        return self.props['cpu_model']
+
 
 class Statistics(object):
 
@@ -275,11 +344,20 @@ class Vm(object):
     def get_uuid(self):
         return self.props['uuid']
 
+    def _set_state(self, state):
+        self.prev_state = self.state
+        self.state = state
+        self.srv.test_emit_event(consts.PET_DSP_EVT_VM_STATE_CHANGED, self,
+                                 {'vminfo_vm_state': state})
+
+    def test_set_state(self, state):
+        "Switch state without any checks, as dispatcher would do."
+        self._set_state(state)
+
     def start(self):
         if self.state in [consts.VMS_PAUSED,
                             consts.VMS_STOPPED]:
-            self.prev_state = self.state
-            self.state = consts.VMS_RUNNING
+            self._set_state(consts.VMS_RUNNING)
             return Job()
         elif self.state == consts.VMS_SUSPENDED:
             return self.resume()
@@ -292,8 +370,7 @@ class Vm(object):
 
     def stop(self):
         if self.state == consts.VMS_RUNNING:
-            self.prev_state = self.state
-            self.state = consts.VMS_STOPPED
+            self._set_state(consts.VMS_STOPPED)
             return Job()
         else:
             err = PrlSDKError(errors.PRL_ERR_DISP_VM_IS_NOT_STARTED)
@@ -304,8 +381,7 @@ class Vm(object):
 
     def pause(self):
         if self.state == consts.VMS_RUNNING:
-            self.prev_state = self.state
-            self.state = consts.VMS_PAUSED
+            self._set_state(consts.VMS_PAUSED)
             return Job()
         else:
             err = PrlSDKError(errors.PRL_ERR_DISP_VM_IS_NOT_STARTED)
@@ -313,8 +389,7 @@ class Vm(object):
 
     def suspend(self):
         if self.state == consts.VMS_RUNNING:
-            self.prev_state = self.state
-            self.state = consts.VMS_SUSPENDED
+            self._set_state(consts.VMS_SUSPENDED)
             return Job()
         else:
             err = PrlSDKError(errors.PRL_ERR_DISP_VM_IS_NOT_STARTED)
@@ -325,8 +400,7 @@ class Vm(object):
             tmp = self.prev_state
             if not tmp:
                 tmp = consts.VMS_RUNNING
-            self.prev_state = self.state
-            self.state = tmp
+            self._set_state(tmp)
             return Job()
         else:
             err = PrlSDKError(errors.PRL_ERR_DISP_VM_IS_NOT_STOPPED)
@@ -343,6 +417,14 @@ class Vm(object):
     def get_state(self):
         return Job([VmInfo({'state': self.state})])
 
+    def get_perf_stats(self, filter):
+        if self.state != consts.VMS_RUNNING:
+            err = PrlSDKError(errors.PRL_ERR_DISP_VM_IS_NOT_STARTED)
+            return Job(error=err)
+        stats = Event(consts.PET_DSP_EVT_VM_PERFSTATS, self.get_uuid(),
+                      self.props.get('perf_stats', {}))
+        return Job([stats])
+
     def get_ram_size(self):
         return self.props['ram_size']
 
@@ -358,7 +440,10 @@ class Vm(object):
         self.writers[tid]['props']['cpu_count'] = cpu_count
 
     def get_vm_type(self):
-        return self.props['vm_type']
+        return self.props.get('vm_type', consts.PVT_VM)
+
+    def get_env_id(self):
+        return self.props.get('env_id', 0)
 
     def set_vm_type(self, vm_type):
         tid = threading.currentThread().ident
@@ -387,8 +472,13 @@ class Vm(object):
                 return Job(error=PrlSDKError(e))
             self.config_version = writer['config_version'] + 1
             self.props = writer['props']
+        self.srv.test_emit_event(consts.PET_DSP_EVT_VM_CONFIG_CHANGED, self)
         return Job()
 
+    def refresh_config(self):
+        tid = threading.currentThread().ident
+        self.writers.pop(tid, None)
+
     def get_devs_count_by_type(self, dev_type):
         return len(self.props['devs'][dev_type])
 
@@ -409,7 +499,9 @@ class Vm(object):
 
     def reg(self, path, non_int_mode):
         self.srv.vms.append(self)
-        return self.commit()
+        job = self.commit()
+        self.srv.test_emit_event(consts.PET_DSP_EVT_VM_ADDED, self)
+        return job
 
     def add_default_device_ex(self, srv_cfg, dev_type):
         tid = threading.currentThread().ident
@@ -438,17 +530,34 @@ class Vm(object):
 
     def delete(self):
         self.srv.vms.remove(self)
+        self.srv.test_emit_event(consts.PET_DSP_EVT_VM_DELETED, self)
         return Job()
 
 
 class Server(object):
 
     def __init__(self):
-        self.vms = []
+        self.dispatcher = dispatcher
+        self.event_handlers = []
+        self.connected = False
+
+    @property
+    def vms(self):
+        return self.dispatcher.vms
+
+    def reg_event_handler(self, handler, user_data):
+        self.event_handlers.append((handler, user_data))
+
+    def test_emit_event(self, event_type, vm, params={}):
+        event = Event(event_type, vm.get_uuid(), params)
+        for srv in self.dispatcher.sessions:
+            for handler, user_data in srv.event_handlers:
+                handler(event, user_data)
 
     def test_add_vm(self, props):
         vm = Vm(self, props)
         self.vms.append(vm)
+        self.test_emit_event(consts.PET_DSP_EVT_VM_ADDED, vm)
         return vm
 
     def test_add_vms(self, prop_list):
@@ -460,14 +569,20 @@ class Server(object):
         info['stats']['total_ram'] = info['stats']['total_ram'] << 20
         info['stats']['usage_ram'] = info['stats']['usage_ram'] << 20
 
-        self.server_info = ServerInfo(info['info'])
-        self.server_config = ServerConfig(info['cfg'])
-        self.statistics = Statistics(info['stats'])
-        self.user_profile = UserProfile(info['user_profile'])
+        host_info = self.dispatcher.host_info
+        host_info['server_info'] = ServerInfo(info['info'])
+        host_info['server_config'] = ServerConfig(info['cfg'])
+        host_info['statistics'] = Statistics(info['stats'])
+        host_info['user_profile'] = UserProfile(info['user_profile'])
 
     def login(self, host, login, password):
+        self.connected = True
+        self.dispatcher.sessions.append(self)
         return Job()
 
+    def is_connected(self):
+        return self.connected
+
     def get_vm_list_ex(self, nFlags):
         return Job(self.vms)
 
@@ -480,16 +595,16 @@ class Server(object):
         return Job(error=PrlSDKError(errors.PRL_ERR_VM_UUID_NOT_FOUND))
 
     def get_srv_config(self):
-        return Job([self.server_config])
+        return Job([self.dispatcher.host_info['server_config']])
 
     def get_server_info(self):
-        return self.server_info
+        return self.dispatcher.host_info['server_info']
 
     def get_statistics(self):
-        return Job([self.statistics])
+        return Job([self.dispatcher.host_info['statistics']])
 
     def get_user_profile(self):
-        return Job([self.user_profile])
+        return Job([self.dispatcher.host_info['user_profile']])
 
     def create_vm(self):
         props = {
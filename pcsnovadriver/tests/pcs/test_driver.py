@@ -13,6 +13,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import threading
+import time
+
 import mock
 
 from oslo.config import cfg
@@ -21,12 +25,15 @@ from nova.compute import flavors
 from nova.compute import power_state
 from nova import context
 from nova import db
+from nova import exception
 from nova.objects import instance as instance_obj
+from nova.openstack.common import jsonutils
 from nova.openstack.common import uuidutils
 from nova import test
 from nova.virt import fake
 
 from pcsnovadriver.pcs import prlsdkapi_proxy
+from pcsnovadriver.pcs import veconfig
 from pcsnovadriver.pcs import volume
 from pcsnovadriver.tests.pcs import fakeprlsdkapi
 
@@ -139,6 +146,28 @@ vm_with_disk = {
     }
 }
 
+PERF_STATS = {
+    'guest.cpu.time': 123456,
+    'guest.ram.usage': 312,
+    'devices.hdd0.read_requests': 10,
+    'devices.hdd0.read_total': 4096,
+    'devices.hdd0.write_requests': 20,
+    'devices.hdd0.write_total': 8192,
+    'net.nic0.bytes_in': 1000,
+    'net.nic0.pkts_in': 10,
+    'net.nic0.bytes_out': 2000,
+    'net.nic0.pkts_out': 20,
+}
+
+vm_perf_stats = {
+    'name': 'instance004',
+    'uuid': '{6d0b5f34-7c3a-4c36-9d83-2f6b0f1e4a51}',
+    'ram_size': 2048,
+    'cpu_count': 2,
+    'state': pc.VMS_RUNNING,
+    'perf_stats': PERF_STATS,
+}
+
 OPENSTACK_STATES = {
     power_state.RUNNING: pc.VMS_RUNNING,
     power_state.PAUSED: pc.VMS_PAUSED,
@@ -154,6 +183,7 @@ HOST_INFO = {
     },
     'cfg': {
         'cpu_count': 8,
+        'cpu_model': 'Intel(R) Xeon(R) CPU E5-2620 0 @ 2.00GHz',
     },
     'info': {
         'product_version': '6.5.23309.945088',
@@ -165,10 +195,8 @@ HOST_INFO = {
 
 
 class FakeVolumeDriver(volume.PCSBaseVolumeDriver):
-    def connect_volume(self, connection_info, sdk_ve, disk_info):
-        data = connection_info['data']
-        return self._attach_blockdev(sdk_ve,
-                    data['device_path'], disk_info['dev'])
+    def connect_host(self, connection_info, disk_info):
+        return connection_info['data']['device_path']
 
     def disconnect_volume(self, connection_info, sdk_ve,
                     disk_info, ignore_errors):
@@ -181,6 +209,8 @@ class PCSDriverTestCase(test.TestCase):
 
     def setUp(self):
         super(PCSDriverTestCase, self).setUp()
+        self.flags(pcs_perf_stats_interval=0, pcs_session_check_interval=0,
+                   pcs_image_scrub_interval=0)
         self.conn = driver.PCSDriver(fake.FakeVirtAPI(), True)
         self.conn.init_host(host='localhost')
         self.conn.psrv.test_add_vms(vms)
@@ -239,6 +269,65 @@ class PCSDriverTestCase(test.TestCase):
     def test_instance_exists_notexists(self):
         self.assertFalse(self.conn.instance_exists('x' + vms[0]['name']))
 
+    def test_inventory_shared(self):
+        srv = self.conn.psrv
+        with mock.patch.object(srv, 'get_vm_list_ex',
+                               wraps=srv.get_vm_list_ex) as list_mock:
+            self.conn.list_instances()
+            self.conn.list_instance_uuids()
+            self.assertTrue(self.conn.instance_exists(vms[0]['name']))
+            self.assertEqual(list_mock.call_count, 1)
+
+    def test_inventory_refreshed_on_event(self):
+        self.conn.list_instances()
+        self.conn.psrv.test_add_vm(vm_with_disk)
+
+        self.assertTrue(self.conn.instance_exists(vm_with_disk['name']))
+
+    def test_inventory_state_on_event(self):
+        sdk_ve = self.conn._get_ve_by_name(vms[0]['name'])
+        sdk_ve.start().wait()
+
+        info = self.conn.inventory.get_by_name(vms[0]['name'])
+        self.assertEqual(info.state, pc.VMS_RUNNING)
+
+    def test_inventory_periodic_refresh_fixes_state(self):
+        info = self.conn.inventory.get_by_name(vms[0]['name'])
+        state = info.state
+        # state change event was lost
+        info.state = pc.VMS_PAUSED
+
+        self.conn.inventory.refresh()
+        info = self.conn.inventory.get_by_name(vms[0]['name'])
+        self.assertEqual(info.state, state)
+
+    def test_get_ve_by_name_cached(self):
+        name = vms[0]['name']
+        sdk_ve = self.conn._get_ve_by_name(name)
+        misses = self.conn.ve_cache.misses
+
+        self.assertIs(self.conn._get_ve_by_name(name), sdk_ve)
+        self.assertEqual(self.conn.ve_cache.misses, misses)
+        self.assertEqual(self.conn.ve_cache.hits, 1)
+
+    def test_get_ve_by_name_invalidated(self):
+        name = vms[0]['name']
+        sdk_ve = self.conn._get_ve_by_name(name)
+        sdk_ve.begin_edit().wait()
+        sdk_ve.commit().wait()
+        misses = self.conn.ve_cache.misses
+
+        self.conn._get_ve_by_name(name)
+        self.assertEqual(self.conn.ve_cache.misses, misses + 1)
+
+    def test_get_ve_by_name_deleted(self):
+        name = vms[0]['name']
+        sdk_ve = self.conn._get_ve_by_name(name)
+        sdk_ve.delete().wait()
+
+        self.assertRaises(exception.InstanceNotFound,
+                          self.conn._get_ve_by_name, name)
+
     def test_get_host_ip_addr(self):
         self.assertEqual(self.conn.get_host_ip_addr(), CONF.my_ip)
 
@@ -249,7 +338,41 @@ class PCSDriverTestCase(test.TestCase):
         self.assertEqual(info['max_mem'], vm['ram_size'])
         self.assertEqual(info['mem'], vm['ram_size'])
         self.assertEqual(info['num_cpu'], vm['cpu_count'])
-        self.assertEqual(info['cpu_time'], 1000)
+        self.assertEqual(info['cpu_time'], 0)
+
+    def test_get_info_perf_stats(self):
+        vm = vm_perf_stats
+        self.conn.psrv.test_add_vm(vm)
+        self.conn.perf_sampler.sample()
+
+        info = self.conn.get_info({'id': vm['uuid'], 'name': vm['name']})
+        self.assertEqual(info['state'], power_state.RUNNING)
+        self.assertEqual(info['max_mem'], vm['ram_size'])
+        self.assertEqual(info['mem'], 312)
+        self.assertEqual(info['cpu_time'], 123456000)
+
+    def test_get_diagnostics(self):
+        vm = vm_perf_stats
+        self.conn.psrv.test_add_vm(vm)
+        self.conn.perf_sampler.sample()
+
+        diags = self.conn.get_diagnostics({'name': vm['name']})
+        self.assertEqual(diags['memory'], vm['ram_size'])
+        self.assertEqual(diags['memory-rss'], 312)
+        self.assertEqual(diags['cpu_time'], 123456000)
+        self.assertEqual(diags['hdd0_read_req'], 10)
+        self.assertEqual(diags['hdd0_read'], 4096)
+        self.assertEqual(diags['hdd0_write_req'], 20)
+        self.assertEqual(diags['hdd0_write'], 8192)
+        self.assertEqual(diags['nic0_rx'], 1000)
+        self.assertEqual(diags['nic0_rx_packets'], 10)
+        self.assertEqual(diags['nic0_tx'], 2000)
+        self.assertEqual(diags['nic0_tx_packets'], 20)
+
+    def test_get_diagnostics_stopped(self):
+        vm = vms[0]
+        diags = self.conn.get_diagnostics({'name': vm['name']})
+        self.assertEqual(diags, {'memory': vm['ram_size']})
 
     def test_plug_vifs_running(self):
         instance, sdk_ve = self._prep_instance_and_vm(
@@ -340,6 +463,29 @@ class PCSDriverTestCase(test.TestCase):
         self.conn.vif_driver.unplug.assert_called_once_with(*args)
         self.assertEqual(sdk_ve.state, pc.VMS_RUNNING)
 
+    def test_reconnect(self):
+        self.conn.list_instances()
+        fakeprlsdkapi.dispatcher.test_restart()
+        self.conn.sessions.check()
+
+        self.conn.psrv.test_add_vm(vm_perf_stats)
+        self.assertIn('instance004', self.conn.list_instances())
+        self.assertTrue(self.conn.sessions.primary.is_connected())
+
+    def test_dead_session_found_by_job_wait(self):
+        pool = self.conn.sessions
+        job = self.conn.psrv.get_vm_config('missing', pc.PGVC_SEARCH_BY_NAME)
+        # the session is held by the running job
+        self.assertEqual(pool._slots.balance, CONF.pcs_session_pool_size - 1)
+
+        fakeprlsdkapi.dispatcher.test_restart()
+        with mock.patch.object(pool, '_recover',
+                               wraps=pool._recover) as recover:
+            self.assertRaises(fakeprlsdkapi.PrlSDKError, job.wait)
+        self.assertTrue(recover.called)
+        self.assertEqual(pool._slots.balance, CONF.pcs_session_pool_size)
+        self.assertTrue(pool.primary.is_connected())
+
     def test_spawn_vm_from_image(self):
         func_name = 'pcsnovadriver.pcs.template.get_template'
         srv = self.conn.psrv
@@ -367,6 +513,73 @@ class PCSDriverTestCase(test.TestCase):
         srv.get_vm_config(instance['name'], pc.PGVC_SEARCH_BY_NAME).wait()
         self.conn.vif_driver.plug.assert_called_once()
 
+    def test_spawn_commits_config_once(self):
+        instance = self._prep_instance_boot_volume()
+        commit = fakeprlsdkapi.Vm.commit
+
+        with mock.patch.object(fakeprlsdkapi.Vm, 'commit', autospec=True,
+                               side_effect=commit) as commit_mock:
+            self.conn.spawn(self.context, instance, None, [],
+                        'fon234mc9pd1', network_info_1vif, block_device_info1)
+
+        # one commit to register blank VM, one for the whole VE setup
+        self.assertEqual(commit_mock.call_count, 2)
+
+    def test_spawn_create_ve_fails(self):
+        instance = self._prep_instance_boot_volume()
+        self.conn._create_ve = mock.Mock(side_effect=Exception("no space"))
+
+        with mock.patch.object(FakeVolumeDriver,
+                               'disconnect_host') as disconnect_host:
+            self.assertRaises(Exception, self.conn.spawn, self.context,
+                              instance, None, [], 'fon234mc9pd1',
+                              network_info_1vif, block_device_info1)
+
+        vol = block_device_info1['block_device_mapping'][0]
+        disconnect_host.assert_called_once_with(vol['connection_info'],
+                                                {'dev': 'vda',
+                                                 'mount_device': 'vda'})
+        self.conn.vif_driver.cleanup.assert_called_once_with(
+                                    self.conn, instance, network_info_1vif[0])
+
+    def test_block_device_index(self):
+        instance = self._prep_instance_boot_volume()
+        self.conn.spawn(self.context, instance, None, [],
+                    'fon234mc9pd1', network_info_1vif, block_device_info1)
+        self.assertEqual(self.conn.get_used_block_devices(), ['/qwe'])
+
+        self.conn.get_disk_dev_path = mock.MagicMock()
+        self.conn.destroy(self.context, instance,
+                          network_info_1vif, block_device_info1)
+        self.assertFalse(self.conn.get_disk_dev_path.called)
+        self.assertEqual(self.conn.get_used_block_devices(), [])
+
+    def test_block_device_index_rolled_back(self):
+        instance, sdk_ve = self._prep_instance_and_vm()
+        volume_driver = FakeVolumeDriver(self.conn)
+
+        def attach(path):
+            with veconfig.ConfigTransaction(sdk_ve):
+                volume_driver.attach_to_ve(None, sdk_ve, path,
+                                           {'dev': 'vdb'})
+                self.assertNotIn(path, self.conn.get_used_block_devices())
+                raise Exception("vif setup failed")
+
+        self.assertRaises(Exception, attach, '/dev/sdx')
+        self.assertNotIn('/dev/sdx', self.conn.get_used_block_devices())
+
+        def attach_commit_fails(path):
+            error = fakeprlsdkapi.FakePrlSDKError("commit failed")
+            with mock.patch.object(fakeprlsdkapi.Vm, 'commit',
+                            return_value=fakeprlsdkapi.Job(error=error)):
+                with veconfig.ConfigTransaction(sdk_ve):
+                    volume_driver.attach_to_ve(None, sdk_ve, path,
+                                               {'dev': 'vdb'})
+
+        self.assertRaises(fakeprlsdkapi.FakePrlSDKError,
+                          attach_commit_fails, '/dev/sdy')
+        self.assertNotIn('/dev/sdy', self.conn.get_used_block_devices())
+
     def _prep_instance_and_vm(self, **kwargs):
         instance = self._prep_instance_boot_volume(**kwargs)
         vm = vm_with_disk.copy()
@@ -456,6 +669,45 @@ class PCSDriverTestCase(test.TestCase):
 
         self.assertEqual(sdk_ve.state, pc.VMS_STOPPED)
 
+    def test_power_off_stopping_event(self):
+        self.flags(pcs_state_poll_interval=10)
+        instance, sdk_ve = self._prep_instance_and_vm(
+                                power_state=power_state.RUNNING)
+        sdk_ve.test_set_state(pc.VMS_STOPPING)
+        timer = threading.Timer(0.1, sdk_ve.test_set_state,
+                                [pc.VMS_STOPPED])
+
+        start = time.time()
+        timer.start()
+        self.conn.power_off(instance)
+
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(sdk_ve.state, pc.VMS_STOPPED)
+
+    def test_power_off_stopping_poll(self):
+        self.flags(pcs_state_poll_interval=1)
+        instance, sdk_ve = self._prep_instance_and_vm(
+                                power_state=power_state.RUNNING)
+        sdk_ve.test_set_state(pc.VMS_STOPPING)
+
+        def stop_silently():
+            sdk_ve.state = pc.VMS_STOPPED
+
+        timer = threading.Timer(0.1, stop_silently)
+        timer.start()
+        self.conn.power_off(instance)
+
+        self.assertEqual(sdk_ve.state, pc.VMS_STOPPED)
+
+    def test_power_off_stopping_timeout(self):
+        self.flags(pcs_state_poll_interval=1, pcs_state_wait_timeout=1)
+        instance, sdk_ve = self._prep_instance_and_vm(
+                                power_state=power_state.RUNNING)
+        sdk_ve.test_set_state(pc.VMS_STOPPING)
+
+        self.assertRaises(exception.NovaException,
+                          self.conn.power_off, instance)
+
     def test_power_on(self):
         instance, sdk_ve = self._prep_instance_and_vm(
                                 power_state=power_state.SHUTDOWN)
@@ -470,8 +722,10 @@ class PCSDriverTestCase(test.TestCase):
 
         def check_stats():
             self.assertEqual(stats['vcpus'], HOST_INFO['cfg']['cpu_count'])
-            self.assertEqual(stats['vcpus_used'], 0)
-            self.assertEqual(stats['cpu_info'], 0)
+            # only instance002 is running
+            self.assertEqual(stats['vcpus_used'], 4)
+            cpu_info = jsonutils.loads(stats['cpu_info'])
+            self.assertEqual(cpu_info['model'], HOST_INFO['cfg']['cpu_model'])
             self.assertEqual(stats['memory_mb'],
                              HOST_INFO['stats']['total_ram'])
             self.assertEqual(stats['memory_mb_used'],
@@ -499,3 +753,24 @@ class PCSDriverTestCase(test.TestCase):
 
             stats = self.conn.get_available_resource(None)
             check_stats()
+
+    @mock.patch('os.statvfs', return_value=os.statvfs('/'))
+    def test_host_stats_cached(self, statvfs):
+        self.conn.get_host_stats(True)
+        srv = fakeprlsdkapi.Server
+        with mock.patch.object(srv, 'get_srv_config') as get_srv_config:
+            with mock.patch.object(srv, 'get_statistics') as get_statistics:
+                self.conn.get_available_resource(None)
+        self.assertFalse(get_srv_config.called)
+        self.assertFalse(get_statistics.called)
+        self.assertEqual(statvfs.call_count, 1)
+
+    @mock.patch('os.statvfs', return_value=os.statvfs('/'))
+    def test_host_stats_committed_memory(self, statvfs):
+        vm = vm_perf_stats.copy()
+        vm['ram_size'] = 16384
+        self.conn.psrv.test_add_vm(vm)
+
+        stats = self.conn.get_available_resource(None)
+        self.assertEqual(stats['memory_mb_used'], 2048 + 16384)
+        self.assertEqual(stats['vcpus_used'], 4 + 2)
@@ -0,0 +1,179 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+from oslo.config import cfg
+
+from nova import test
+
+from pcsnovadriver.pcs import imagecache
+from pcsnovadriver.pcs import template
+
+CONF = cfg.CONF
+
+MB = 1 << 20
+
+
+class FakeImageCache(object):
+
+    def __init__(self, images):
+        # image id -> (size, last used)
+        self.images = images
+        # images, which delete_image() refuses to remove
+        self.busy = set()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def list_images(self):
+        return self.images.keys()
+
+    def get_size(self, image_id):
+        return self.images[image_id][0]
+
+    def get_last_used(self, image_id):
+        return self.images[image_id][1]
+
+    def in_use(self, image_id):
+        return False
+
+    def mark_used(self, image_id):
+        self.images[image_id] = (self.images[image_id][0], time.time())
+
+    def flush_usage(self):
+        pass
+
+    def delete_image(self, image_id):
+        if image_id in self.busy:
+            return False
+        del self.images[image_id]
+        return True
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['images'] = len(self.images)
+        stats['size'] = sum([x[0] for x in self.images.values()])
+        return stats
+
+
+class ImageCacheManagerTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ImageCacheManagerTestCase, self).setUp()
+        now = time.time()
+        self.cache = FakeImageCache({
+            'used': (100 * MB, now - 7200),
+            'recent': (100 * MB, now - 60),
+            'old': (100 * MB, now - 7200),
+            'older': (100 * MB, now - 9000),
+        })
+        self.driver = mock.Mock(image_cache=self.cache)
+        self.manager = imagecache.ImageCacheManager(self.driver)
+        self.instances = [{'image_ref': 'used'}]
+
+    @mock.patch.object(imagecache.ImageCacheManager, '_get_free_space',
+                       return_value=1 << 40)
+    def test_evict_unused(self, free_space):
+        self.manager.update(None, self.instances)
+        self.assertEqual(sorted(self.cache.images), ['recent', 'used'])
+        self.assertEqual(self.cache.stats['evictions'], 2)
+
+    @mock.patch.object(imagecache.ImageCacheManager, '_get_free_space',
+                       return_value=1 << 40)
+    def test_evict_refused(self, free_space):
+        self.flags(pcs_image_cache_max_size=250)
+        self.cache.busy.add('older')
+        self.manager.update(None, self.instances)
+        self.assertEqual(sorted(self.cache.images),
+                         ['older', 'recent', 'used'])
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    @mock.patch.object(imagecache.ImageCacheManager, '_get_free_space',
+                       return_value=1 << 40)
+    def test_evict_lru_over_budget(self, free_space):
+        self.flags(pcs_image_cache_max_size=350)
+        self.manager.update(None, self.instances)
+        self.assertEqual(sorted(self.cache.images), ['old', 'recent', 'used'])
+
+    @mock.patch.object(imagecache.ImageCacheManager, '_get_free_space',
+                       return_value=50 * MB)
+    def test_evict_low_space(self, free_space):
+        self.flags(pcs_image_cache_max_size=1000,
+                   pcs_image_cache_min_free=200)
+        self.manager.update(None, self.instances)
+        self.assertEqual(sorted(self.cache.images), ['recent', 'used'])
+
+
+class SharedImageCacheManagerTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(SharedImageCacheManagerTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.flags(pcs_image_cache_shared_dir=os.path.join(self.path,
+                                                           'shared'))
+        os.mkdir(CONF.pcs_image_cache_shared_dir)
+
+    def _make_manager(self, node):
+        self.flags(pcs_template_dir=os.path.join(self.path, node))
+        os.mkdir(CONF.pcs_template_dir)
+        cache = template.LZRWImageCache()
+        return imagecache.ImageCacheManager(mock.Mock(image_cache=cache))
+
+    def test_image_used_by_other_node(self):
+        manager1 = self._make_manager('node1')
+        manager2 = self._make_manager('node2')
+        cache = manager1.driver.image_cache
+        for image_id in 'image-1', 'image-2':
+            with open(cache._get_cached_file(image_id), 'w') as f:
+                f.write('data')
+            cache.index.update(image_id, size=4,
+                               last_used=time.time() - 7200)
+
+        manager1.update(None, [{'image_ref': 'image-1'}])
+        self.assertEqual(cache.list_images(), ['image-1'])
+        manager2.update(None, [])
+        self.assertEqual(manager2.driver.image_cache.list_images(),
+                         ['image-1'])
+
+
+class ImageScrubberTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ImageScrubberTestCase, self).setUp()
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        self.flags(pcs_template_dir=template_dir)
+        self.cache = template.LZRWImageCache()
+        self.scrubber = imagecache.ImageScrubber(
+                                mock.Mock(image_cache=self.cache))
+
+    def _add_image(self, image_id, data, file_md5):
+        with open(self.cache._get_cached_file(image_id), 'w') as f:
+            f.write(data)
+        self.cache.index.update(image_id, file_md5=file_md5)
+
+    def test_scrub(self):
+        self._add_image('good', 'data', '8d777f385d3dfec8815d20f7496026dc')
+        self._add_image('bad', 'datx', '8d777f385d3dfec8815d20f7496026dc')
+
+        self.assertEqual(self.scrubber.scrub(), ['bad'])
+        self.assertEqual(self.cache.list_images(), ['good'])
+        self.assertEqual(self.cache.index.list(), ['good'])
+        self.assertIn('verified_at', self.cache.index.get('good'))
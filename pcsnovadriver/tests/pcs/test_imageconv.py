@@ -0,0 +1,128 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from eventlet import greenthread
+
+from nova import test
+
+from pcsnovadriver.pcs import imageconv
+from pcsnovadriver.pcs import ploop
+
+MB = 1 << 20
+
+
+class ImageConvTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(ImageConvTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        # 5 MB disk with data in the first, third and last megabytes
+        self.data = ('a' * MB + '\0' * MB + 'b' * 100 + '\0' * (2 * MB - 100)
+                     + 'c' * MB)
+        self.raw = self._write('disk.raw', self.data)
+
+    def _write(self, name, data):
+        path = os.path.join(self.path, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def test_raw_ploop_raw(self):
+        imageconv.convert_to_ploop(self.raw, 'raw', self.path)
+        # header and BAT block, and 3 data blocks
+        self.assertEqual(os.path.getsize(os.path.join(self.path,
+                                                      'root.hds')), 4 * MB)
+
+        out = os.path.join(self.path, 'out.raw')
+        imageconv.convert_from_ploop(self.path, out, 'raw')
+        self.assertEqual(self._read('out.raw'), self.data)
+
+    def test_qcow2_roundtrip(self):
+        qcow2 = os.path.join(self.path, 'disk.qcow2')
+        with open(self.raw, 'rb') as src:
+            with open(qcow2, 'wb') as dst:
+                imageconv.copy_image(imageconv.RawReader(src),
+                        imageconv.Qcow2Writer(dst, len(self.data)))
+
+        imageconv.convert_to_ploop(qcow2, 'qcow2', self.path)
+        out = os.path.join(self.path, 'out.raw')
+        imageconv.convert_from_ploop(self.path, out, 'raw')
+        self.assertEqual(self._read('out.raw'), self.data)
+
+    def test_ploop_delta_chain(self):
+        with open(self.raw, 'rb') as src:
+            with open(os.path.join(self.path, 'base.hds'), 'wb') as f:
+                imageconv.copy_image(imageconv.RawReader(src),
+                                     imageconv.PloopWriter(f, len(self.data)))
+        with open(os.path.join(self.path, 'delta.hds'), 'wb') as f:
+            writer = imageconv.PloopWriter(f, len(self.data))
+            writer.write(MB, 'd' * 10)
+            writer.close()
+
+        files = [open(os.path.join(self.path, x), 'rb')
+                 for x in 'delta.hds', 'base.hds']
+        for f in files:
+            self.addCleanup(f.close)
+        reader = imageconv.PloopReader(files)
+        data = dict(reader.iter_data())
+        self.assertEqual(sorted(data), [0, MB, 2 * MB, 4 * MB])
+        self.assertEqual(data[MB], 'd' * 10 + '\0' * (MB - 10))
+
+    def test_conversion_yields(self):
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(None)
+                greenthread.sleep(0)
+
+        ticker = greenthread.spawn(tick)
+        self.addCleanup(ticker.kill)
+        greenthread.sleep(0)
+        imageconv.convert_to_ploop(self.raw, 'raw', self.path)
+        # one tick per converted block
+        self.assertTrue(len(ticks) >= 3)
+
+    def test_flatten_ploop(self):
+        base = os.path.join(self.path, 'base')
+        os.mkdir(base)
+        imageconv.convert_to_ploop(self.raw, 'raw', base)
+        with open(os.path.join(self.path, 'delta.hds'), 'wb') as f:
+            writer = imageconv.PloopWriter(f, len(self.data))
+            writer.write(MB, 'd' * 10)
+            writer.close()
+        with open(os.path.join(self.path, 'DiskDescriptor.xml'), 'w') as f:
+            f.write(ploop.link_descriptor(
+                    ploop.read_descriptor(base), base,
+                    ploop.make_descriptor(len(self.data), MB, 'delta.hds')))
+
+        flat = os.path.join(self.path, 'flat')
+        os.mkdir(flat)
+        imageconv.flatten_ploop(self.path, flat)
+        self.assertEqual(len(ploop.get_descriptor(flat).images), 1)
+
+        imageconv.convert_from_ploop(flat, os.path.join(self.path, 'out'),
+                                     'raw')
+        self.assertEqual(self._read('out'), self.data[:MB] + 'd' * 10 +
+                         self.data[MB + 10:])
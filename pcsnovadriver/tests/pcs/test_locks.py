@@ -0,0 +1,53 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+
+from nova import test
+
+from pcsnovadriver.pcs import locks
+
+
+class FakeDriver(object):
+
+    def __init__(self):
+        self.locks = locks.LockManager()
+        self.calls = []
+
+    @locks.instance_operation
+    def power_on(self, context, instance, network_info=None):
+        self.calls.append(('start', instance['uuid']))
+        eventlet.sleep(0.01)
+        self.calls.append(('end', instance['uuid']))
+
+
+class LockManagerTestCase(test.NoDBTestCase):
+
+    def _run(self, *instances):
+        drv = FakeDriver()
+        threads = [eventlet.spawn(drv.power_on, None, instance=x)
+                   for x in instances]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(drv.locks._locks, {})
+        return [x[0] for x in drv.calls]
+
+    def test_same_instance(self):
+        calls = self._run({'uuid': 'a'}, {'uuid': 'a'})
+        self.assertEqual(calls, ['start', 'end', 'start', 'end'])
+
+    def test_different_instances(self):
+        calls = self._run({'uuid': 'a'}, {'uuid': 'b'})
+        self.assertEqual(calls, ['start', 'start', 'end', 'end'])
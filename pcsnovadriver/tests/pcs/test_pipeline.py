@@ -0,0 +1,79 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import eventlet
+
+from nova import test
+
+from pcsnovadriver.pcs import pipeline
+
+
+class PipelineTestCase(test.NoDBTestCase):
+
+    def test_run_concurrently(self):
+        def stage(value):
+            eventlet.sleep(0.2)
+            return value
+
+        p = pipeline.Pipeline('test')
+        p.add_stage('a', lambda: stage(1))
+        p.add_stage('b', lambda: stage(2))
+        p.add_stage('c', lambda a, b: a + b, requires=['a', 'b'])
+
+        start = time.time()
+        results = p.run()
+
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(results, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(set(p.timings), set(['a', 'b', 'c']))
+
+    def test_failed_stage(self):
+        calls = []
+
+        def fail():
+            raise ValueError()
+
+        p = pipeline.Pipeline('test')
+        p.add_stage('a', fail)
+        p.add_stage('b', lambda: calls.append('b'))
+        p.add_stage('c', lambda a: calls.append('c'), requires=['a'])
+
+        self.assertRaises(ValueError, p.run)
+        self.assertEqual(calls, ['b'])
+
+    def test_undo(self):
+        undone = []
+
+        def fail(a):
+            raise ValueError()
+
+        def undo_b(b):
+            raise Exception("undo failed")
+
+        p = pipeline.Pipeline('test')
+        p.add_stage('a', lambda: 1, undo=undone.append)
+        p.add_stage('b', lambda: 2, undo=undo_b)
+        p.add_stage('c', fail, requires=['a'], undo=undone.append)
+        p.add_stage('d', lambda: 4)
+
+        self.assertRaises(ValueError, p.run)
+        self.assertEqual(undone, [1])
+
+        p = pipeline.Pipeline('test')
+        p.add_stage('a', lambda: 1, undo=undone.append)
+        self.assertEqual(p.run(), {'a': 1})
+        self.assertEqual(undone, [1])
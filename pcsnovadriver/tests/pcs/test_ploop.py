@@ -0,0 +1,144 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import shutil
+import tempfile
+
+import mock
+
+from nova import test
+
+from pcsnovadriver.pcs import ploop
+
+DISK_DESCRIPTOR = """<?xml version='1.0' encoding='UTF-8'?>
+<Parallels_disk_image Version="1.0">
+  <Disk_Parameters>
+    <Disk_size>20971520</Disk_size>
+    <Cylinders>20805</Cylinders>
+    <Heads>16</Heads>
+    <Sectors>63</Sectors>
+    <Padding>0</Padding>
+  </Disk_Parameters>
+  <StorageData>
+    <Storage>
+      <Start>0</Start>
+      <End>20971520</End>
+      <Blocksize>2048</Blocksize>
+      <Image>
+        <GUID>{5fbaabe3-6958-40ff-92a7-860e329aab41}</GUID>
+        <Type>Compressed</Type>
+        <File>root.hdd</File>
+      </Image>
+      <Image>
+        <GUID>{c5d53ed4-2ab4-4b49-8a2c-52e1b6b27c2a}</GUID>
+        <Type>Compressed</Type>
+        <File>root.hdd.{c5d53ed4-2ab4-4b49-8a2c-52e1b6b27c2a}</File>
+      </Image>
+    </Storage>
+  </StorageData>
+  <Snapshots>
+    <TopGUID>{c5d53ed4-2ab4-4b49-8a2c-52e1b6b27c2a}</TopGUID>
+    <Shot>
+      <GUID>{5fbaabe3-6958-40ff-92a7-860e329aab41}</GUID>
+      <ParentGUID>{00000000-0000-0000-0000-000000000000}</ParentGUID>
+    </Shot>
+    <Shot>
+      <GUID>{c5d53ed4-2ab4-4b49-8a2c-52e1b6b27c2a}</GUID>
+      <ParentGUID>{5fbaabe3-6958-40ff-92a7-860e329aab41}</ParentGUID>
+    </Shot>
+  </Snapshots>
+</Parallels_disk_image>
+"""
+
+TOP_DELTA = 'root.hdd.{c5d53ed4-2ab4-4b49-8a2c-52e1b6b27c2a}'
+
+DELTA_DESCRIPTOR = """<?xml version='1.0' encoding='UTF-8'?>
+<Parallels_disk_image Version="1.0">
+  <Disk_Parameters>
+    <Disk_size>20971520</Disk_size>
+  </Disk_Parameters>
+  <StorageData>
+    <Storage>
+      <Blocksize>2048</Blocksize>
+      <Image>
+        <GUID>%(guid)s</GUID>
+        <Type>Compressed</Type>
+        <File>root.hds</File>
+      </Image>
+    </Storage>
+  </StorageData>
+  <Snapshots>
+    <Shot>
+      <GUID>%(guid)s</GUID>
+      <ParentGUID>{00000000-0000-0000-0000-000000000000}</ParentGUID>
+    </Shot>
+  </Snapshots>
+</Parallels_disk_image>
+"""
+
+DELTA_GUID = '{9a3a1e6e-5c0f-4d1b-b3a5-0e1f2d3c4b5a}'
+
+
+class DiskDescriptorTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(DiskDescriptorTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.dd_path = os.path.join(self.path, 'DiskDescriptor.xml')
+        with open(self.dd_path, 'w') as f:
+            f.write(DISK_DESCRIPTOR)
+
+    def test_parse(self):
+        dd = ploop.parse(DISK_DESCRIPTOR)
+        self.assertEqual(dd.size, 10 << 30)
+        self.assertEqual(dd.block_size, 1 << 20)
+        self.assertEqual(dd.top_image, TOP_DELTA)
+        self.assertEqual(dd.image_files, [TOP_DELTA, 'root.hdd'])
+
+    def test_get_descriptor_cached(self):
+        dd = ploop.get_descriptor(self.path)
+        self.assertEqual(dd.top_image, os.path.join(self.path, TOP_DELTA))
+        self.assertIs(ploop.get_descriptor(self.path), dd)
+
+        with open(self.dd_path, 'w') as f:
+            f.write(DISK_DESCRIPTOR.replace(TOP_DELTA, 'top.hdd'))
+        os.utime(self.dd_path, (0, 0))
+        dd = ploop.get_descriptor(self.path)
+        self.assertEqual(dd.top_image, os.path.join(self.path, 'top.hdd'))
+
+    @mock.patch('nova.utils.read_file_as_root', return_value=DISK_DESCRIPTOR)
+    def test_get_descriptor_no_access(self, read_file_as_root):
+        error = OSError(errno.EACCES, 'Permission denied')
+        with mock.patch('os.stat', side_effect=error):
+            dd = ploop.get_descriptor(self.path)
+            self.assertEqual(dd.top_image,
+                             os.path.join(self.path, TOP_DELTA))
+            ploop.get_descriptor(self.path)
+        read_file_as_root.assert_called_with(self.dd_path)
+        self.assertEqual(read_file_as_root.call_count, 2)
+        self.assertNotIn(self.path, ploop._cache)
+
+    def test_link_descriptor(self):
+        delta_dd = DELTA_DESCRIPTOR % {'guid': DELTA_GUID}
+        data = ploop.link_descriptor(DISK_DESCRIPTOR, '/base', delta_dd)
+        dd = ploop.parse(data, self.path)
+        self.assertEqual(dd.top_guid, DELTA_GUID)
+        self.assertEqual(dd.image_files,
+                         [os.path.join(self.path, 'root.hds'),
+                          '/base/' + TOP_DELTA, '/base/root.hdd'])
+        self.assertEqual(dd.size, 10 << 30)
@@ -0,0 +1,62 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from eventlet import greenthread
+import mock
+
+from nova import test
+
+from pcsnovadriver.pcs import prewarm
+
+
+class FakeImageCache(object):
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.cached = []
+
+    def prefetch(self, context, image_ref, image_meta, throttle=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        greenthread.sleep(0)
+        self.running -= 1
+        if image_ref == 'bad':
+            raise Exception("download failed")
+        throttle.consume(1024)
+        self.cached.append(image_ref)
+
+
+class PrewarmTestCase(test.NoDBTestCase):
+
+    @mock.patch('nova.image.glance.get_remote_image_service')
+    def test_prewarm_images(self, get_service):
+        image_service = mock.Mock()
+        image_service.show.side_effect = lambda context, image_id: \
+                {'id': image_id, 'disk_format': 'cploop'}
+        get_service.side_effect = lambda context, image_id: \
+                (image_service, image_id)
+        cache = FakeImageCache()
+        callback = mock.Mock()
+
+        progress = prewarm.prewarm_images(cache, None, ['a', 'bad', 'c'],
+                                          concurrency=2, callback=callback)
+
+        self.assertEqual(cache.max_running, 2)
+        self.assertEqual(sorted(cache.cached), ['a', 'c'])
+        self.assertEqual(progress.failed.keys(), ['bad'])
+        self.assertEqual(progress.finished, 3)
+        self.assertEqual(progress.downloaded, 2048)
+        self.assertEqual(callback.call_count, 3)
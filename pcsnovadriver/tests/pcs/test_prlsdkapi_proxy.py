@@ -0,0 +1,63 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova import test
+
+from pcsnovadriver.pcs import prlsdkapi_proxy
+
+
+class FakeJob(object):
+
+    def wait(self):
+        return 'result'
+
+
+class FakeModule(object):
+
+    def __init__(self):
+        self.Job = type('Job', (FakeJob,), {})
+
+
+class ExecutionTestCase(test.NoDBTestCase):
+
+    def test_wait_in_native_thread(self):
+        module = FakeModule()
+        prlsdkapi_proxy.init_execution(module)
+        prlsdkapi_proxy.init_execution(module)
+
+        with mock.patch('eventlet.tpool.execute',
+                        side_effect=lambda f, *a: f(*a)) as execute:
+            self.assertEqual(module.Job().wait(), 'result')
+        self.assertEqual(execute.call_count, 1)
+
+    def test_disabled(self):
+        self.flags(pcs_sdk_thread_pool_size=0)
+        module = FakeModule()
+        prlsdkapi_proxy.init_execution(module)
+        self.assertFalse(hasattr(module.Job.wait, 'in_tpool'))
+
+
+class ConstsTestCase(test.NoDBTestCase):
+
+    def test_memoized(self):
+        consts = prlsdkapi_proxy.Consts()
+        with mock.patch.object(prlsdkapi_proxy, 'prlsdkapi') as module:
+            module.consts.VMS_RUNNING = 10
+            self.assertEqual(consts.VMS_RUNNING, 10)
+            module.consts.VMS_RUNNING = 11
+            self.assertEqual(consts.VMS_RUNNING, 10)
+        self.assertIn('VMS_RUNNING', vars(consts))
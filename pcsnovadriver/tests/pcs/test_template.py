@@ -0,0 +1,483 @@
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import hashlib
+import os
+import shutil
+import tempfile
+
+from eventlet import greenpool
+from eventlet import greenthread
+import mock
+from oslo.config import cfg
+
+from nova import exception
+from nova import test
+
+from pcsnovadriver.pcs import ploop
+from pcsnovadriver.pcs import template
+from pcsnovadriver.pcs import utils as pcsutils
+
+CONF = cfg.CONF
+
+IMAGE_META = {'id': 'image-1', 'name': 'image', 'disk_format': 'cploop'}
+
+
+class LZRWImageCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LZRWImageCacheTestCase, self).setUp()
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        self.flags(pcs_template_dir=template_dir)
+        self.cache = template.LZRWImageCache()
+
+    def _open_many(self, n):
+        def open_cached_file():
+            try:
+                f = self.cache._open_cached_file(None, 'image-1',
+                                                 IMAGE_META, None)
+            except Exception as e:
+                return e
+            f.close()
+
+        pool = greenpool.GreenPool()
+        return list(pool.imap(lambda i: open_cached_file(), range(n)))
+
+    def test_concurrent_requests_share_download(self):
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            self.assertIn('image-1', self.cache.get_fills())
+            greenthread.sleep(0.01)
+            with open(dst, 'w') as f:
+                f.write('data')
+            return {'size': 4}
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch) as cache_image:
+            results = self._open_many(10)
+
+        self.assertEqual(results, [None] * 10)
+        self.assertEqual(cache_image.call_count, 1)
+        self.assertEqual(self.cache.get_fills(), {})
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_concurrent_requests_share_error(self):
+        error = Exception("glance is down")
+
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            greenthread.sleep(0.01)
+            raise error
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch) as cache_image:
+            results = self._open_many(10)
+
+        self.assertEqual(results, [error] * 10)
+        self.assertEqual(cache_image.call_count, 1)
+
+    def test_fill_progress(self):
+        downloaded = {}
+
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            size = image_meta['size']
+            with pcsutils.ThrottledWriter(open(dst, 'w'), throttle) as f:
+                f.write('x' * (size // 2))
+                greenthread.sleep(0.01)
+                f.write('x' * (size // 2))
+            fill = self.cache.get_fills()[image_meta['id']]
+            downloaded[image_meta['id']] = fill.downloaded
+            return {'size': size}
+
+        throttle = pcsutils.Throttle()
+        pool = greenpool.GreenPool()
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch):
+            for image_id, size in ('image-1', 100), ('image-2', 200):
+                image_meta = dict(IMAGE_META, id=image_id, size=size)
+                pool.spawn(self.cache.prefetch, None, image_id,
+                           image_meta, throttle)
+            pool.waitall()
+
+        self.assertEqual(downloaded, {'image-1': 100, 'image-2': 200})
+        self.assertEqual(throttle.transferred, 300)
+
+    @mock.patch('pcsnovadriver.pcs.utils.uncompress_ploop')
+    @mock.patch('nova.utils.execute')
+    def test_first_put_image_unpacks_while_caching(self, execute,
+                                                   uncompress):
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            greenthread.sleep(0.01)
+            with open(dst, 'w') as f:
+                f.write('data')
+            return {'size': 4}
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch) as cache_image:
+            pool = greenpool.GreenPool()
+            for dst in '/vz/first', '/vz/second':
+                pool.spawn(self.cache.put_image, None, 'image-1',
+                           IMAGE_META, dst)
+            pool.waitall()
+
+        self.assertEqual(cache_image.call_args[0][5], '/vz/first')
+        self.assertEqual(uncompress.call_count, 1)
+        self.assertEqual(uncompress.call_args[0][1], '/vz/second')
+
+    @mock.patch('nova.image.glance.get_remote_image_service')
+    def test_download_checksum(self, get_service):
+        image_service = mock.Mock()
+        image_service.download.side_effect = \
+                lambda context, image_ref, f: f.write('data')
+        get_service.return_value = (image_service, 'image-1')
+        image_meta = dict(IMAGE_META,
+                          checksum=hashlib.md5('data').hexdigest())
+
+        self.cache.prefetch(None, 'image-1', image_meta)
+        entry = self.cache.index.get('image-1')
+        self.assertEqual(entry['file_md5'], image_meta['checksum'])
+
+        image_meta = dict(IMAGE_META, id='image-2', checksum='bad')
+        self.assertRaises(exception.ImageUnacceptable, self.cache.prefetch,
+                          None, 'image-2', image_meta)
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+        self.assertEqual(os.listdir(self.cache.tmp_dir), [])
+
+    def test_failed_fill_not_indexed(self):
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            with open(dst, 'w') as f:
+                f.write('data')
+            return {'size': 4}
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch):
+            with mock.patch('os.rename', side_effect=OSError("EIO")):
+                self.assertRaises(OSError, self.cache.prefetch,
+                                  None, 'image-1', IMAGE_META)
+
+        self.assertEqual(self.cache.list_images(), [])
+        self.assertEqual(self.cache.index.list(), [])
+        self.assertEqual(os.listdir(self.cache.tmp_dir), [])
+
+    @mock.patch('nova.utils.execute')
+    def test_put_image_checksum_mismatch(self, execute):
+        def fetch(context, image_ref, image_meta, dst, throttle,
+                  unpack_to):
+            with open(dst, 'w') as f:
+                f.write('data')
+            raise exception.ImageUnacceptable(image_id=image_meta['id'],
+                                              reason='checksum mismatch')
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch):
+            self.assertRaises(exception.ImageUnacceptable,
+                              self.cache.put_image, None, 'image-1',
+                              IMAGE_META, '/vz/first')
+
+        self.assertEqual(os.listdir(self.cache.tmp_dir), [])
+        execute.assert_called_with('rm', '-rf', '/vz/first',
+                                   run_as_root=True)
+
+    @mock.patch('pcsnovadriver.pcs.utils.uncompress_ploop')
+    @mock.patch('nova.utils.execute')
+    def test_index(self, execute, uncompress):
+        def fetch(context, image_ref, image_meta, dst, throttle=None,
+                  unpack_to=None):
+            with open(dst, 'w') as f:
+                f.write('data')
+            return {'size': 4, 'hits': 0}
+
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch):
+            self.cache.put_image(None, 'image-1', IMAGE_META, '/vz/first')
+            self.cache.put_image(None, 'image-1', IMAGE_META, '/vz/second')
+
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+        self.assertEqual(self.cache.index.get('image-1')['hits'], 1)
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['images'], stats['size']), (1, 4))
+
+    def test_index_usage_flushed(self):
+        with open(self.cache._get_cached_file('image-1'), 'w') as f:
+            f.write('data')
+        self.cache.index.update('image-1', size=4, last_used=1, hits=0)
+        self.cache.mark_used('image-1')
+
+        other = template.LZRWImageCache()
+        self.assertEqual(other.get_last_used('image-1'), 1)
+        self.assertTrue(self.cache.get_last_used('image-1') > 1)
+
+        self.cache.flush_usage()
+        self.assertTrue(other.get_last_used('image-1') > 1)
+        self.assertEqual(other.index.get('image-1')['hits'], 0)
+
+    def test_sync_index(self):
+        with open(self.cache._get_cached_file('unindexed'), 'w') as f:
+            f.write('data')
+        self.cache.index.update('missing', size=4)
+
+        cache = template.LZRWImageCache()
+        self.assertEqual(cache.list_images(), ['unindexed'])
+        self.assertTrue(cache.get_last_used('unindexed') > 0)
+
+    @mock.patch('pcsnovadriver.pcs.utils.compress_ploop')
+    def test_codec(self, compress):
+        compress.side_effect = lambda src, dst, codec: dst.write('data')
+        self.flags(pcs_image_cache_codec='zstd')
+        with open(self.cache._get_cached_file('old'), 'w') as f:
+            f.write('data')
+        cache = template.LZRWImageCache()
+        self.assertEqual(cache._get_codec('old'), 'lzrw')
+
+        downloader = template.get_downloader('ploop', codec=cache.codec)
+        downloader._download_ploop = mock.Mock()
+        downloader._verify_checksums = mock.Mock()
+        downloader._checksum_writer = mock.Mock()
+        downloader._checksum_writer.hexdigests.return_value = {'md5': 'x'}
+        with mock.patch('nova.image.glance.get_remote_image_service',
+                        return_value=(mock.Mock(), 'image-1')):
+            with mock.patch.object(template, 'get_downloader',
+                                   return_value=downloader):
+                cache.prefetch(None, 'image-1',
+                               dict(IMAGE_META, disk_format='ploop'))
+
+        self.assertEqual(compress.call_args[0][2], 'zstd')
+        self.assertEqual(cache._get_codec('image-1'), 'zstd')
+        self.assertTrue(cache._get_cached_file('image-1').endswith('.zst'))
+        self.assertEqual(cache.index.get('image-1')['file_md5'],
+                         hashlib.md5('data').hexdigest())
+
+
+class LinkedCloneImageCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(LinkedCloneImageCacheTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.flags(pcs_template_dir=os.path.join(self.path, 'cache'))
+        os.mkdir(CONF.pcs_template_dir)
+        self.cache = template.LinkedCloneImageCache()
+
+        patcher = mock.patch('nova.utils.execute')
+        self.execute = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.cache, '_create_delta')
+        self.create_delta = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _unpack_to_tmp(self, context, image_ref, image_meta, throttle=None):
+        image_id = image_meta['id']
+        open(self.cache._get_cached_file(image_id), 'w').close()
+        self.cache.index.update(image_id, size=0)
+        tmp = tempfile.mkdtemp(dir=self.cache.tmp_dir)
+        with open(os.path.join(tmp, 'DiskDescriptor.xml'), 'w') as f:
+            f.write(ploop.make_descriptor(1 << 20, 1 << 20, 'root.hds'))
+        return tmp
+
+    def _put_image(self, name):
+        dst = os.path.join(self.path, name)
+        os.mkdir(dst)
+        self.cache.put_image(None, 'image-1', IMAGE_META, dst)
+        return dst
+
+    def test_put_and_delete_image(self):
+        base = self.cache._get_base('image-1')
+        with mock.patch.object(self.cache, '_unpack_to_tmp',
+                               side_effect=self._unpack_to_tmp) as unpack:
+            disks = [self._put_image('disk1'), self._put_image('disk2')]
+
+        self.assertEqual(unpack.call_count, 1)
+        self.assertTrue(os.path.exists(base))
+        self.assertFalse(os.path.exists(
+                                self.cache._get_cached_file('image-1')))
+        self.assertEqual([x[0] for x in self.create_delta.call_args_list],
+                         [(base, disks[0]), (base, disks[1])])
+        self.assertEqual(self.cache.index.get('image-1')['hits'], 1)
+
+        # base with linked disks is not removed
+        self.assertTrue(self.cache.in_use('image-1'))
+        self.assertFalse(self.cache.delete_image('image-1'))
+        self.assertTrue(os.path.exists(base))
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+
+        for dst in disks:
+            shutil.rmtree(dst)
+        self.assertFalse(self.cache.in_use('image-1'))
+        self.assertTrue(self.cache.delete_image('image-1'))
+        self.execute.assert_called_with('rm', '-rf',
+                                        self.cache._get_base_dir('image-1'),
+                                        run_as_root=True)
+        self.assertEqual(self.cache.list_images(), [])
+
+
+class UncompressedImageCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(UncompressedImageCacheTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.flags(pcs_template_dir=os.path.join(self.path, 'cache'))
+        os.mkdir(CONF.pcs_template_dir)
+        self.cache = template.UncompressedImageCache()
+
+        patcher = mock.patch('nova.utils.execute')
+        self.execute = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.cache, '_unpack_to_tmp',
+                                    side_effect=self._unpack_to_tmp)
+        self.unpack_to_tmp = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _unpack_to_tmp(self, context, image_ref, image_meta, throttle=None):
+        image_id = image_meta['id']
+        open(self.cache._get_cached_file(image_id), 'w').close()
+        self.cache.index.update(image_id, size=0)
+        tmp = tempfile.mkdtemp(dir=self.cache.tmp_dir)
+        with open(os.path.join(tmp, 'root.hds'), 'w') as f:
+            f.write('data')
+        return tmp
+
+    def test_put_image(self):
+        unpacked = self.cache._get_unpacked('image-1')
+        for name in 'disk1', 'disk2':
+            dst = os.path.join(self.path, name)
+            self.cache.put_image(None, 'image-1', IMAGE_META, dst)
+            self.execute.assert_called_with('cp', '-a', '--reflink=auto',
+                                            '--sparse=always',
+                                            os.path.join(unpacked, '.'),
+                                            dst, run_as_root=True)
+
+        self.assertEqual(self.unpack_to_tmp.call_count, 1)
+        self.assertEqual(os.listdir(unpacked), ['root.hds'])
+        self.assertFalse(os.path.exists(
+                                self.cache._get_cached_file('image-1')))
+        entry = self.cache.index.get('image-1')
+        self.assertEqual(entry['size'], self.cache._measure_size('image-1'))
+        self.assertEqual(entry['hits'], 1)
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+
+    def test_in_use(self):
+        def execute(*cmd, **kwargs):
+            if cmd[0] == 'cp':
+                self.assertTrue(self.cache.in_use('image-1'))
+                self.assertFalse(self.cache.delete_image('image-1'))
+
+        self.execute.side_effect = execute
+        self.cache.put_image(None, 'image-1', IMAGE_META,
+                             os.path.join(self.path, 'disk1'))
+
+        self.assertFalse(self.cache.in_use('image-1'))
+        self.assertTrue(os.path.exists(self.cache._get_unpacked('image-1')))
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+
+    def test_delete_image(self):
+        self.cache.prefetch(None, 'image-1', IMAGE_META)
+        self.assertEqual(self.cache.list_images(), ['image-1'])
+
+        self.assertTrue(self.cache.delete_image('image-1'))
+        self.assertFalse(os.path.exists(self.cache._get_unpacked('image-1')))
+        self.assertEqual(self.cache.list_images(), [])
+        self.assertEqual(self.cache.index.list(), [])
+        rm_cmd = self.execute.call_args[0]
+        self.assertEqual(rm_cmd[:2], ('rm', '-rf'))
+        self.assertEqual(os.path.dirname(rm_cmd[2]), self.cache.tmp_dir)
+
+        # next use unpacks the image again
+        self.cache.prefetch(None, 'image-1', IMAGE_META)
+        self.assertEqual(self.unpack_to_tmp.call_count, 2)
+
+
+class SharedImageCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(SharedImageCacheTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        # local directory stands in for the cluster filesystem
+        self.flags(pcs_template_dir=os.path.join(self.path, 'node1'),
+                   pcs_image_cache_shared_dir=os.path.join(self.path,
+                                                           'shared'))
+        os.mkdir(CONF.pcs_template_dir)
+        os.mkdir(CONF.pcs_image_cache_shared_dir)
+
+    def test_fill_is_shared(self):
+        def fetch(context, image_ref, image_meta, dst, throttle=None,
+                  unpack_to=None):
+            with open(dst, 'w') as f:
+                f.write('data')
+            return {'size': 4}
+
+        self.cache = template.LZRWImageCache()
+        with mock.patch.object(self.cache, '_cache_image',
+                               side_effect=fetch):
+            self.cache.prefetch(None, 'image-1', IMAGE_META)
+
+        self.flags(pcs_template_dir=os.path.join(self.path, 'node2'))
+        os.mkdir(CONF.pcs_template_dir)
+        cache = template.LZRWImageCache()
+        with mock.patch.object(cache, '_cache_image') as cache_image:
+            cache.prefetch(None, 'image-1', IMAGE_META)
+        self.assertFalse(cache_image.called)
+        self.assertEqual(cache.list_images(), ['image-1'])
+        self.assertEqual(cache.stats['hits'], 1)
+
+    def test_refs_of_other_nodes(self):
+        cache = template.LinkedCloneImageCache()
+        os.makedirs(cache._get_refs_dir('image-1'))
+        self.flags(host='node1')
+        cache._add_ref('image-1', '/vz/private/missing')
+        self.flags(host='node2')
+        self.assertTrue(cache.in_use('image-1'))
+        self.flags(host='node1')
+        self.assertFalse(cache.in_use('image-1'))
+
+
+class QemuDownloaderTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(QemuDownloaderTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.dev = os.path.join(self.path, 'ploop0')
+
+    @mock.patch('nova.utils.execute')
+    def test_stream_raw(self, execute):
+        def download(context, image_ref, f):
+            for chunk in 'a' * 512, '\0' * 1024, 'b' * 512:
+                f.write(chunk)
+
+        image_service = mock.Mock()
+        image_service.download.side_effect = download
+        image_meta = {'id': 'image-1', 'disk_format': 'raw', 'size': 2048}
+        downloader = template.QemuDownloader()
+
+        @contextlib.contextmanager
+        def mount(dst):
+            yield self.dev
+
+        with mock.patch.object(downloader, '_mount', side_effect=mount):
+            downloader._download_ploop(None, 'image-1', image_meta,
+                                       image_service, self.path)
+
+        self.assertEqual(execute.call_args_list[0][0][:6],
+                         ('ploop', 'init', '-t', 'none', '-s', '2K'))
+        with open(self.dev) as f:
+            self.assertEqual(f.read(), 'a' * 512 + '\0' * 1024 + 'b' * 512)
+        self.assertEqual(downloader.metrics['download'][0], 1024)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare compression codecs of the image cache.
+
+Packs each unpacked ploop image (a directory with DiskDescriptor.xml)
+with every codec, which is installed, and reports compression ratio
+and throughput of compression and decompression in MB/s of the tar
+stream, with CPU seconds, spent by child processes. Values for
+pcs_image_cache_codec are the codec names.
+
+    python tools/bench_codecs.py [-n RUNS] [-d DIR] [-c CODEC]... PLOOP_DIR...
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+from pcsnovadriver.pcs import utils as pcsutils
+
+from bench_image_cache import _measure
+
+
+def _installed(codec):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, codec.compress_cmd[0]), os.X_OK):
+            return True
+    return False
+
+
+def _tar_size(path):
+    p = subprocess.Popen(['tar', 'cO', '-C', path, '.'],
+                         stdout=subprocess.PIPE)
+    size = 0
+    while True:
+        data = p.stdout.read(1 << 20)
+        if not data:
+            break
+        size += len(data)
+    if p.wait():
+        raise Exception("tar of %s failed" % path)
+    return size
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def bench(image, codecs, workdir, runs):
+    size = _tar_size(image)
+    print "%s: %d MB" % (image, size >> 20)
+    for codec in codecs:
+        packed = os.path.join(workdir, 'image' + codec.suffix)
+        pack, unpack = [], []
+        try:
+            for i in xrange(runs):
+                pack.append(_measure(lambda: pcsutils.compress_ploop(
+                                    image, packed, codec.name)))
+                dst = tempfile.mkdtemp(dir=workdir)
+                try:
+                    unpack.append(_measure(lambda: pcsutils.uncompress_ploop(
+                                    packed, dst, codec=codec.name)))
+                finally:
+                    shutil.rmtree(dst)
+            ratio = float(size) / os.path.getsize(packed)
+        finally:
+            if os.path.exists(packed):
+                os.unlink(packed)
+
+        mb = float(size) / (1 << 20)
+        pack_wall = _median([x[0] for x in pack])
+        unpack_wall = _median([x[0] for x in unpack])
+        print ("  %-5s ratio %.2f; compress %.1f MB/s, cpu %.2fs; "
+               "uncompress %.1f MB/s, cpu %.2fs" %
+               (codec.name, ratio, mb / pack_wall,
+                _median([x[1] for x in pack]), mb / unpack_wall,
+                _median([x[1] for x in unpack])))
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage="%prog [-n RUNS] [-d DIR] [-c CODEC]... PLOOP_DIR...")
+    parser.add_option('-n', '--runs', type='int', default=3,
+                      help='number of runs per codec')
+    parser.add_option('-d', '--dir', default='.',
+                      help='directory for compressed and unpacked images')
+    parser.add_option('-c', '--codec', action='append',
+                      choices=sorted(pcsutils.CODECS),
+                      help='codec to measure, all installed by default')
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("at least one ploop directory is required")
+
+    codecs = [pcsutils.CODECS[x] for x in opts.codec or
+              sorted(pcsutils.CODECS)]
+    codecs = filter(_installed, codecs)
+    for image in args:
+        bench(image, codecs, opts.dir, opts.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare ways of deploying a cached image to an instance disk.
+
+Takes an image from the compressed cache (.tar.lzrw) and measures
+wall clock time and CPU seconds, spent by child processes, of
+unpacking it, as the "compressed" cache mode does, and of copying an
+unpacked image, as the "uncompressed" mode does. Run it in a
+directory on the same filesystem as pcs_template_dir, to get
+reflinks where the filesystem supports them.
+
+    python tools/bench_image_cache.py [-n RUNS] [-d DIR] IMAGE.tar.lzrw
+"""
+
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from pcsnovadriver.pcs import utils as pcsutils
+
+
+def _measure(func):
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return elapsed, usage.ru_utime + usage.ru_stime - cpu
+
+
+def _report(name, results):
+    results.sort()
+    wall = [x[0] for x in results]
+    cpu = [x[1] for x in results]
+    print "%-12s wall: min %.2fs, median %.2fs; cpu: median %.2fs" % \
+        (name, wall[0], wall[len(wall) // 2], sorted(cpu)[len(cpu) // 2])
+
+
+def bench(image, workdir, runs):
+    unpacked = tempfile.mkdtemp(dir=workdir)
+    try:
+        pcsutils.uncompress_ploop(image, unpacked)
+
+        methods = [
+            ('uncompress', lambda dst: pcsutils.uncompress_ploop(image, dst)),
+            ('reflink', lambda dst: subprocess.check_call(
+                    ['cp', '-a', '--reflink=auto', '--sparse=always',
+                     os.path.join(unpacked, '.'), dst])),
+            ('sparse-copy', lambda dst: subprocess.check_call(
+                    ['cp', '-a', '--sparse=always',
+                     os.path.join(unpacked, '.'), dst])),
+        ]
+        for name, method in methods:
+            results = []
+            for i in xrange(runs):
+                dst = tempfile.mkdtemp(dir=workdir)
+                try:
+                    results.append(_measure(lambda: method(dst)))
+                finally:
+                    shutil.rmtree(dst)
+            _report(name, results)
+    finally:
+        shutil.rmtree(unpacked)
+
+
+def main():
+    parser = optparse.OptionParser(
+                    usage="%prog [-n RUNS] [-d DIR] IMAGE.tar.lzrw")
+    parser.add_option('-n', '--runs', type='int', default=5,
+                      help='number of deployments to measure')
+    parser.add_option('-d', '--dir', default='.',
+                      help='directory for deployed images')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("image is required")
+
+    bench(args[0], opts.dir, opts.runs)
+
+
+if __name__ == '__main__':
+    main()
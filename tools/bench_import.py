@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright (c) 2013-2014 Parallels, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure the cost of importing the driver and of SDK constant lookups.
+
+Each import is measured in a fresh interpreter. The script also reports,
+whether the import pulled in prlsdkapi, which should be loaded only when
+the driver talks to the dispatcher.
+
+    python tools/bench_import.py [-n RUNS] [module]
+"""
+
+import optparse
+import subprocess
+import sys
+import timeit
+
+IMPORT_SCRIPT = """
+import sys
+import time
+start = time.time()
+__import__(%r)
+print time.time() - start, 'prlsdkapi' in sys.modules
+"""
+
+
+def bench_import(module, runs):
+    times = []
+    sdk_loaded = False
+    for i in xrange(runs):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       IMPORT_SCRIPT % module])
+        elapsed, loaded = out.split()
+        times.append(float(elapsed))
+        sdk_loaded = sdk_loaded or loaded == 'True'
+    times.sort()
+    print "import %s: min %.3fs, median %.3fs, prlsdkapi loaded: %s" % \
+        (module, times[0], times[len(times) // 2], sdk_loaded)
+
+
+def bench_lookup(number):
+    setup = "from pcsnovadriver.pcs import prlsdkapi_proxy\n" \
+            "pc = prlsdkapi_proxy.consts\n" \
+            "pc.VMS_RUNNING"
+    try:
+        t = timeit.timeit('pc.VMS_RUNNING', setup, number=number)
+    except ImportError as e:
+        print "constant lookup: skipped (%s)" % e
+        return
+    print "constant lookup: %.1f ns" % (t / number * 1e9)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-n RUNS] [module]")
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='number of imports to measure')
+    opts, args = parser.parse_args()
+    module = args[0] if args else 'pcsnovadriver.pcs.driver'
+
+    bench_import(module, opts.runs)
+    bench_lookup(1000000)
+
+
+if __name__ == '__main__':
+    main()